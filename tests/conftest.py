@@ -0,0 +1,76 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import types
+from collections import namedtuple
+
+import pytest
+
+# thermo reads its configuration from thermo/local_settings.py, which is written on each unit. The tests install a
+# throwaway one before anything from thermo is imported, with every file the code writes kept in a temporary directory.
+SETTINGS_DIR = tempfile.mkdtemp(prefix='thermo-tests-')
+
+local_settings = types.ModuleType('thermo.local_settings')
+local_settings.DATABASE = namedtuple('GenericDict', 'TYPE HOST PORT USERNAME PASSWORD NAME')(
+    'sqlite', '', '', '', '', '')
+local_settings.LOCAL_DATABASE_PATH = os.path.join(SETTINGS_DIR, 'local.db')
+local_settings.USER_NUMBER = 1
+local_settings.UNIT_NUMBER = 2
+local_settings.GPIO_MODE = 11
+local_settings.GPIO_PINS = {'HEAT': 17}
+local_settings.FALLBACK = {'LOCATION': 'Living Room', 'SERIAL NUMBER': '28-0000000000aa', 'ZONE': 1}
+local_settings.LOGGING = {'level': logging.DEBUG}
+local_settings.JOURNAL_PATH = os.path.join(SETTINGS_DIR, 'journal.log')
+local_settings.ARCHIVE_PATH = os.path.join(SETTINGS_DIR, 'archive')
+local_settings.PROFILE_PATH = os.path.join(SETTINGS_DIR, 'profile')
+local_settings.CONTROL_SOCKET = os.path.join(SETTINGS_DIR, 'control.sock')
+local_settings.EVENT_SOCKET = os.path.join(SETTINGS_DIR, 'events.sock')
+local_settings.METRICS = {'port': 0, 'summary_path': ''}
+
+import thermo
+
+thermo.local_settings = local_settings
+sys.modules['thermo.local_settings'] = local_settings
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(SETTINGS_DIR, ignore_errors=True)
+
+
+
+@pytest.fixture
+def databases(tmpdir, monkeypatch):
+    """
+    Empty SQLite files standing in for the remote and the local database, with every table created
+    :return: (remote engine, local engine)
+    """
+    from sqlalchemy import create_engine
+
+    from thermo.common import models
+
+    paths = {False: str(tmpdir.join('remote.db')), True: str(tmpdir.join('local.db'))}
+    monkeypatch.setattr(models, '_create_engine', lambda local=False: create_engine(
+        'sqlite:///' + paths[bool(local)], connect_args={'check_same_thread': False}))
+    monkeypatch.setattr(models, 'remote_breaker', models.CircuitBreaker('remote'))
+
+    models.dispose_engines()
+    engines = models.get_engine(local=False), models.get_engine(local=True)
+    for engine in engines:
+        models.Base.metadata.create_all(engine)
+
+    yield engines
+    models.dispose_engines()
+
+
+@pytest.fixture
+def journal(tmpdir, monkeypatch):
+    """
+    An empty journal, used by write_rows in place of the unit's
+    """
+    from thermo.common import journal
+
+    empty = journal.Journal(str(tmpdir.join('journal.log')))
+    monkeypatch.setattr(journal, 'journal', empty)
+    return empty
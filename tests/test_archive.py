@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+
+from thermo.analysis.archive import Archive
+from thermo.common.journal import insert_rows
+from thermo.common.models import Sensor, Temperature
+
+START = datetime(2017, 1, 1)
+
+
+def readings(start, n, sensors=(1, 2)):
+    return [{'sensor': sensor, 'record_time': start + timedelta(minutes=10 * i), 'value': 60. + i % 10 / 4.,
+             'location': 'Sensor {0}'.format(sensor)} for i in range(n) for sensor in sensors]
+
+
+def counts(archive):
+    return {(int(sensor), chunk): span['count'] for sensor, entry in archive.index['sensors'].items()
+            for chunk, span in entry['chunks'].items()}
+
+
+def test_export(tmpdir, databases):
+    remote, local = databases
+    remote.execute(Sensor.__table__.insert(), [{'id': 1, 'location': 'Kitchen', 'user': 1},
+                                               {'id': 2, 'location': 'Bedroom', 'user': 1}])
+    # January and the start of February
+    rows = readings(START, 6 * 24 * 33)
+    insert_rows(Temperature.__table__, rows)
+
+    archive = Archive(str(tmpdir.join('archive')))
+    assert archive.export(START, START + timedelta(days=40), batch_size=1000) == len(rows)
+
+    assert counts(archive) == {(1, '2017-01'): 6 * 24 * 31, (1, '2017-02'): 6 * 24 * 2,
+                               (2, '2017-01'): 6 * 24 * 31, (2, '2017-02'): 6 * 24 * 2}
+    df = Archive(archive.path).read(sensors=[2])
+    assert list(df['location'].unique()) == ['Bedroom']
+    assert list(df['value']) == [r['value'] for r in rows if r['sensor'] == 2]
+    assert list(df['record_time']) == [r['record_time'] for r in rows if r['sensor'] == 2]
+
+
+def test_export_again_after_compaction(tmpdir, databases):
+    remote, local = databases
+    insert_rows(Temperature.__table__, readings(START, 6 * 24 * 20))
+    archive = Archive(str(tmpdir.join('archive')))
+    archive.export(START, START + timedelta(days=20))
+    before = archive.read()
+
+    # the first ten days are compacted away, and later readings arrive
+    raw = Temperature.__table__
+    remote.execute(raw.delete().where(raw.c.record_time < START + timedelta(days=10)))
+    later = readings(START + timedelta(days=20), 6 * 24 * 5)
+    insert_rows(Temperature.__table__, later)
+
+    assert archive.export(START, START + timedelta(days=25)) == 2 * 6 * 24 * 15
+    assert counts(archive) == {(1, '2017-01'): 6 * 24 * 25, (2, '2017-01'): 6 * 24 * 25}
+
+    after = archive.read()
+    assert len(after) == len(before) + len(later)
+    expected = readings(START, 6 * 24 * 25, sensors=(1,))
+    assert list(after[after['sensor'] == 1]['record_time']) == [r['record_time'] for r in expected]
+    assert list(after[after['sensor'] == 1]['value']) == [r['value'] for r in expected]
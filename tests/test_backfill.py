@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from thermo.analysis import backfill_database
+from thermo.analysis.backfill_database import backfill, read_checkpoint
+from thermo.common.models import Sensor, Temperature, TemperatureDay
+
+START = datetime(2017, 1, 1)
+
+
+@pytest.fixture
+def csv(tmpdir, databases):
+    remote, local = databases
+    remote.execute(Sensor.__table__.insert(), [{'id': 1, 'location': 'Kitchen', 'user': 1, 'indoors': True, 'bias': 0},
+                                               {'id': 2, 'location': 'Bedroom', 'user': 1, 'indoors': True, 'bias': 0}])
+
+    # three days of readings every 30 minutes, one day per 96 lines
+    path = str(tmpdir.join('temps.csv'))
+    with open(path, 'w') as f:
+        for i in range(3 * 48):
+            record_time = START + timedelta(minutes=30 * i)
+            for location in ('Kitchen', 'Bedroom'):
+                f.write('{0},{1},{2}\n'.format(70. + i % 4, record_time.strftime('%Y-%m-%d %H:%M:%S'), location))
+    return path
+
+
+def day_samples(engine):
+    table = TemperatureDay.__table__
+    return sorted((r.sensor, r.bucket, r.samples) for r in engine.execute(select([table])))
+
+
+def test_backfill(csv, databases):
+    remote, local = databases
+
+    assert backfill(csv, 1, chunk_size=50, checkpoint=csv + '.checkpoint', progress=None) == (288, 0)
+    assert day_samples(remote) == [(s, START + timedelta(days=d), 48) for s in (1, 2) for d in range(3)]
+    assert read_checkpoint(csv + '.checkpoint')[1] == [START, START + timedelta(days=3) - timedelta(minutes=30)]
+
+    # repeating a load skips every row
+    assert backfill(csv, 1, chunk_size=50, progress=None) == (0, 288)
+
+
+def test_resumed_backfill_rebuilds_rollups_of_earlier_run(csv, databases, monkeypatch):
+    remote, local = databases
+    checkpoint = csv + '.checkpoint'
+    insert = backfill_database.insert_rows_idempotent
+    chunks = []
+
+    def interrupted(table, rows, local=False):
+        chunks.append(len(rows))
+        if len(chunks) == 3:
+            raise KeyboardInterrupt()
+        return insert(table, rows, local=local)
+
+    with monkeypatch.context() as m:
+        m.setattr(backfill_database, 'insert_rows_idempotent', interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            backfill(csv, 1, chunk_size=100, checkpoint=checkpoint, progress=None)
+
+    assert read_checkpoint(checkpoint)[0] > 0
+    assert day_samples(remote) == []
+
+    assert backfill(csv, 1, chunk_size=100, checkpoint=checkpoint, progress=None) == (88, 0)
+    assert day_samples(remote) == [(s, START + timedelta(days=d), 48) for s in (1, 2) for d in range(3)]
+
+
+def test_resume_from_checkpoint_without_span(csv, databases):
+    remote, local = databases
+    checkpoint = csv + '.checkpoint'
+    backfill(csv, 1, chunk_size=100, checkpoint=checkpoint, progress=None)
+    remote.execute(TemperatureDay.__table__.delete())
+
+    # a checkpoint holding only the offset, half way through the first day
+    with open(csv, 'r') as f:
+        for _ in range(48):
+            f.readline()
+        offset = f.tell()
+    with open(checkpoint, 'w') as f:
+        f.write(str(offset))
+    raw = Temperature.__table__
+    remote.execute(raw.delete().where(raw.c.record_time >= START + timedelta(hours=12)))
+
+    backfill(csv, 1, chunk_size=100, checkpoint=checkpoint, progress=None)
+    assert day_samples(remote) == [(s, START + timedelta(days=d), 48) for s in (1, 2) for d in range(3)]
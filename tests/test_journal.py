@@ -0,0 +1,211 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from thermo.common import journal as journal_module
+from thermo.common.journal import write_rows
+from thermo.common.models import Temperature, TemperatureMinute
+from thermo.sensor.ingest import TemperatureQueue
+
+START = datetime(2017, 1, 2, 12, 0, 0)
+
+
+def temperature_rows(n, start=START, sensor=1):
+    return [{'sensor': sensor, 'record_time': start + timedelta(seconds=10 * i), 'value': 70. + i % 3,
+             'location': 'Kitchen'} for i in range(n)]
+
+
+def stored(engine):
+    raw = Temperature.__table__
+    return [(r.sensor, r.record_time) for r in engine.execute(select([raw.c.sensor, raw.c.record_time])
+                                                              .order_by(raw.c.record_time))]
+
+
+def test_write_rows(databases, journal):
+    remote, local = databases
+    rows = temperature_rows(12)
+
+    assert write_rows(Temperature.__table__, rows)
+
+    assert len(stored(remote)) == 12
+    assert len(stored(local)) == 12
+    minute = TemperatureMinute.__table__
+    assert remote.execute(select([minute.c.samples])).fetchall() == [(6,), (6,)]
+    assert not journal.pending()
+
+
+def test_rejected_row_costs_only_itself(databases, journal):
+    remote, local = databases
+    rows = temperature_rows(20)
+    write_rows(Temperature.__table__, rows[7:8])
+
+    # the seventh row is a duplicate key in both databases
+    assert write_rows(Temperature.__table__, rows)
+
+    assert stored(remote) == [(r['sensor'], r['record_time']) for r in rows]
+    assert stored(local) == [(r['sensor'], r['record_time']) for r in rows]
+    # the duplicate did not reach the rollups twice
+    minute = TemperatureMinute.__table__
+    assert sum(r.samples for r in remote.execute(select([minute.c.samples]))) == 20
+    assert not journal.pending()
+
+
+def test_queue_writes_batch_with_rejected_row(databases, journal):
+    remote, local = databases
+    rows = temperature_rows(50)
+    write_rows(Temperature.__table__, rows[30:31])
+
+    queue = TemperatureQueue(batch_size=50, max_delay=0.1)
+    for row in rows:
+        queue.put(row['record_time'], row['value'], row['location'], row['sensor'])
+    queue.flush()
+
+    assert len(stored(remote)) == 50
+    assert len(stored(local)) == 50
+
+
+@pytest.fixture
+def remote_down(monkeypatch):
+    """
+    Make every insert into the remote database fail as if it could not be reached
+    """
+    insert = journal_module.insert_accepted_rows
+
+    def unreachable(table, rows, local=False, **kwargs):
+        if not local:
+            raise OperationalError('INSERT', {}, Exception("Can't connect to MySQL server"))
+        return insert(table, rows, local=local, **kwargs)
+
+    monkeypatch.setattr(journal_module, 'insert_accepted_rows', unreachable)
+    return lambda: monkeypatch.setattr(journal_module, 'insert_accepted_rows', insert)
+
+
+def test_rows_are_journaled_while_remote_is_down(databases, journal, remote_down, monkeypatch):
+    remote, local = databases
+    rows = temperature_rows(30)
+
+    assert not write_rows(Temperature.__table__, rows[:10])
+    assert journal.pending()
+
+    # later rows queue behind the journaled ones without replaying them, even once the remote database is back
+    remote_down()
+    with monkeypatch.context() as m:
+        m.setattr(journal, 'replay', lambda *args, **kwargs: pytest.fail('write_rows replayed the journal'))
+        assert not write_rows(Temperature.__table__, rows[10:])
+
+    assert stored(remote) == []
+    assert len(stored(local)) == 30
+
+    assert journal.replay() == 30
+    assert stored(remote) == [(r['sensor'], r['record_time']) for r in rows]
+    assert not journal.pending()
+    minute = TemperatureMinute.__table__
+    assert sum(r.samples for r in remote.execute(select([minute.c.samples]))) == 30
+
+
+def test_replay_is_idempotent(databases, journal):
+    remote, local = databases
+    rows = temperature_rows(30)
+    journal.append(Temperature.__table__, rows)
+
+    # a replay that was interrupted after writing some of its rows, before saving its offset
+    journal_module.insert_rows(Temperature.__table__, rows[:12])
+
+    assert journal.replay(chunk_size=7) == 30
+    assert stored(remote) == [(r['sensor'], r['record_time']) for r in rows]
+    assert journal.replay() == 0
+
+    journal.append(Temperature.__table__, rows)
+    assert journal.replay() == 30
+    assert len(stored(remote)) == 30
+    minute = TemperatureMinute.__table__
+    assert sum(r.samples for r in remote.execute(select([minute.c.samples]))) == 30
+
+
+def test_replay_resumes_after_failure(databases, journal, monkeypatch):
+    remote, local = databases
+    rows = temperature_rows(30)
+    journal.append(Temperature.__table__, rows)
+
+    insert = journal_module.insert_rows_idempotent
+    calls = []
+
+    def fails_third_chunk(table, rows, local=False):
+        calls.append(len(rows))
+        if len(calls) == 3:
+            raise OperationalError('INSERT', {}, Exception('Lost connection to MySQL server during query'))
+        return insert(table, rows, local=local)
+
+    with monkeypatch.context() as m:
+        m.setattr(journal_module, 'insert_rows_idempotent', fails_third_chunk)
+        assert journal.replay(chunk_size=10) == 20
+        assert journal.pending()
+
+    assert journal.replay(chunk_size=10) == 10
+    assert stored(remote) == [(r['sensor'], r['record_time']) for r in rows]
+    assert not journal.pending()
+
+
+def test_replay_drops_rejected_rows(databases, journal, monkeypatch):
+    remote, local = databases
+    rows = temperature_rows(10)
+    journal.append(Temperature.__table__, rows)
+
+    insert = journal_module.insert_rows_idempotent
+
+    def rejects_fifth_row(table, chunk, local=False):
+        if rows[4]['record_time'] in [row['record_time'] for row in chunk]:
+            raise IntegrityError('INSERT', {}, Exception('Cannot add or update a child row'))
+        return insert(table, chunk, local=local)
+
+    monkeypatch.setattr(journal_module, 'insert_rows_idempotent', rejects_fifth_row)
+
+    assert journal.replay() == 9
+    assert not journal.pending()
+    assert len(stored(remote)) == 9
+
+
+def test_append_does_not_wait_for_replay(journal):
+    appended = threading.Event()
+
+    def append():
+        journal.append(Temperature.__table__, temperature_rows(1))
+        appended.set()
+
+    with journal._replaying():
+        thread = threading.Thread(target=append)
+        thread.start()
+        assert appended.wait(2.)
+    thread.join()
+    assert journal.pending()
+
+
+def test_replay_rebuilds_rollups_once(databases, journal, monkeypatch):
+    remote, local = databases
+    # readings either side of midnight, the first few of which reached the remote database and its rollups before the
+    # outage
+    midnight = START.replace(hour=0)
+    rows = temperature_rows(40, start=midnight - timedelta(minutes=3))
+    assert write_rows(Temperature.__table__, rows[:5])
+    journal.append(Temperature.__table__, rows)
+
+    rebuild = journal_module.rebuild_rollups
+    spans = []
+
+    def counted(start, end, local=False):
+        spans.append((start, end))
+        return rebuild(start, end, local=local)
+
+    monkeypatch.setattr(journal_module, 'rebuild_rollups', counted)
+
+    assert journal.replay(chunk_size=7) == 40
+    assert spans == [(rows[0]['record_time'], rows[-1]['record_time'])]
+
+    minute = TemperatureMinute.__table__
+    samples = {r.bucket: r.samples for r in remote.execute(select([minute.c.bucket, minute.c.samples]))}
+    assert sum(samples.values()) == 40
+    assert samples[midnight - timedelta(minutes=3)] == 6
+    assert samples[midnight] == 6
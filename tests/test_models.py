@@ -0,0 +1,110 @@
+import socket
+import time
+
+import pytest
+from sqlalchemy.exc import DataError, IntegrityError, OperationalError, ProgrammingError
+
+from thermo.common import models
+from thermo.common.models import CircuitBreaker, CircuitOpenError, call_remote, is_connection_error
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = CircuitBreaker('remote', failure_threshold=3, backoff=0.05, max_backoff=0.2)
+    monkeypatch.setattr(models, 'remote_breaker', breaker)
+    return breaker
+
+
+def failing(error):
+    def function(local=False):
+        raise error
+
+    return function
+
+
+def succeeding(local=False):
+    return 'remote' if not local else 'local'
+
+
+def test_connection_errors():
+    assert is_connection_error(OperationalError('SELECT 1', {}, Exception('Lost connection to MySQL server')))
+    assert is_connection_error(socket.timeout('timed out'))
+    assert not is_connection_error(IntegrityError('INSERT', {}, Exception('Duplicate entry')))
+    assert not is_connection_error(ProgrammingError('SELECT', {}, Exception('Unknown column')))
+    assert not is_connection_error(DataError('INSERT', {}, Exception('Out of range value')))
+    assert not is_connection_error(ValueError())
+
+    invalidated = ProgrammingError('SELECT 1', {}, Exception('Gone'), connection_invalidated=True)
+    assert is_connection_error(invalidated)
+
+
+def test_breaker_opens_after_consecutive_connection_failures(breaker):
+    down = failing(OperationalError('SELECT 1', {}, Exception("Can't connect")))
+
+    for _ in range(3):
+        with pytest.raises(OperationalError):
+            call_remote(down)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        call_remote(succeeding)
+    assert breaker.rejected == 1
+
+
+def test_breaker_ignores_statement_errors(breaker):
+    duplicate = failing(IntegrityError('INSERT', {}, Exception('Duplicate entry')))
+
+    for _ in range(5):
+        with pytest.raises(IntegrityError):
+            call_remote(duplicate)
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+    assert call_remote(succeeding) == 'remote'
+
+
+def test_success_resets_failure_count(breaker):
+    down = failing(OperationalError('SELECT 1', {}, Exception("Can't connect")))
+
+    for _ in range(2):
+        with pytest.raises(OperationalError):
+            call_remote(down)
+    call_remote(succeeding)
+    with pytest.raises(OperationalError):
+        call_remote(down)
+
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_probe(breaker):
+    down = failing(OperationalError('SELECT 1', {}, Exception("Can't connect")))
+    for _ in range(3):
+        with pytest.raises(OperationalError):
+            call_remote(down)
+
+    time.sleep(0.06)
+    # one probe is let through; a failed probe re-opens the breaker with the backoff doubled
+    with pytest.raises(OperationalError):
+        call_remote(down)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.current_backoff == 0.1
+
+    time.sleep(0.11)
+    assert call_remote(succeeding) == 'remote'
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.current_backoff == 0.05
+
+
+def test_fallback_locally(breaker):
+    calls = []
+
+    @models.fallback_locally
+    def query(local=False):
+        calls.append(local)
+        if not local:
+            raise OperationalError('SELECT 1', {}, Exception("Can't connect"))
+        return 'local'
+
+    assert [query() for _ in range(4)] == ['local'] * 4
+    # the fourth call skipped the remote database
+    assert calls == [False, True, False, True, False, True, True]
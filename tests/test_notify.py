@@ -0,0 +1,78 @@
+import os
+import socket
+import stat
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+import pytest
+
+from thermo.common import notify
+
+
+@pytest.fixture
+def listener(tmpdir):
+    received = Queue()
+    listener = notify.Listener(str(tmpdir.join('run', 'control.sock')), received.put, lambda: 'secret')
+    listener.start()
+    yield listener, received
+    listener.stop()
+
+
+def test_socket_is_only_open_to_owner_and_group(listener):
+    listener, received = listener
+
+    assert stat.S_IMODE(os.stat(listener.path).st_mode) == 0o660
+    assert stat.S_IMODE(os.stat(os.path.dirname(listener.path)).st_mode) == 0o2770
+
+
+def test_messages_without_the_key_are_dropped(listener):
+    listener, received = listener
+
+    assert notify.send(listener.path, {'type': 'schedule changed', 'zone': 1}, None)
+    assert notify.send(listener.path, {'type': 'schedule changed', 'zone': 2}, 'guess')
+    assert notify.send(listener.path, {'type': 'schedule changed', 'zone': 3, 'key': 'secret'}, None)
+    assert notify.send(listener.path, {'type': 'schedule changed', 'zone': 4}, 'secret')
+
+    assert received.get(timeout=2.) == {'type': 'schedule changed', 'zone': 4}
+    with pytest.raises(Empty):
+        received.get(timeout=.2)
+
+
+def test_second_listener_does_not_take_over_the_socket(listener):
+    listener, received = listener
+
+    with pytest.raises(socket.error):
+        notify.Listener(listener.path, lambda message: None, lambda: 'secret').start()
+
+    assert notify.send(listener.path, {'type': 'schedule changed', 'zone': 1}, 'secret')
+    assert received.get(timeout=2.) == {'type': 'schedule changed', 'zone': 1}
+
+
+def test_stale_socket_is_replaced(tmpdir):
+    path = str(tmpdir.join('events.sock'))
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stale.bind(path)
+    stale.close()
+
+    received = Queue()
+    listener = notify.Listener(path, received.put, lambda: 'secret')
+    listener.start()
+    try:
+        assert notify.send(path, {'type': 'relay', 'zone': 1}, 'secret')
+        assert received.get(timeout=2.) == {'type': 'relay', 'zone': 1}
+    finally:
+        listener.stop()
+
+
+def test_check_access(tmpdir, caplog, monkeypatch):
+    directory = str(tmpdir.mkdir('run'))
+    assert notify.check_access(directory)
+    assert notify.check_access(str(tmpdir.join('missing')))
+
+    # a directory created by the master, running as another user, without a group in common
+    monkeypatch.setattr(os, 'access', lambda path, mode: False)
+    assert not notify.check_access(directory)
+    assert 'SOCKET_GROUP' in caplog.text
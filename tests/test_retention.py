@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+from thermo.common import retention
+from thermo.common.journal import insert_rows, write_rows
+from thermo.common.models import Temperature, TemperatureDay, TemperatureHour, TemperatureMinute
+from thermo.common.rollup import history, rebuild_rollups
+
+START = datetime(2017, 1, 1)
+# readings per sensor per day
+PER_DAY = 144
+
+
+def readings(start, days, sensors=(1, 2)):
+    seconds = 24 * 60 * 60 // PER_DAY
+    n = days * PER_DAY
+    return [{'sensor': sensor, 'record_time': start + timedelta(seconds=seconds * i), 'value': 60. + i % 10,
+             'location': 'Sensor {0}'.format(sensor)} for i in range(n) for sensor in sensors]
+
+
+def rollup_samples(engine, rollup):
+    """
+    :return: {day: samples} of <rollup>
+    """
+    table = rollup.__table__
+    samples = {}
+    for bucket, count in engine.execute(select([table.c.bucket, table.c.samples])):
+        day = bucket.replace(hour=0, minute=0, second=0)
+        samples[day] = samples.get(day, 0) + count
+    return samples
+
+
+def raw_count(engine):
+    raw = Temperature.__table__
+    return engine.execute(select([func.count()]).select_from(raw)).scalar()
+
+
+def test_compaction(databases, journal):
+    remote, local = databases
+    write_rows(Temperature.__table__, readings(START, 5))
+
+    retention.compact(START + timedelta(days=3, hours=12), batch_size=1000)
+
+    # only whole days before the cutoff are compacted
+    assert raw_count(remote) == 2 * 2 * PER_DAY
+    raw = Temperature.__table__
+    assert remote.execute(select([func.min(raw.c.record_time)])).scalar() == START + timedelta(days=3)
+    for rollup in (TemperatureMinute, TemperatureHour, TemperatureDay):
+        assert rollup_samples(remote, rollup) == {START + timedelta(days=d): 2 * PER_DAY for d in range(5)}
+
+
+def test_compaction_keeps_rollups_of_compacted_days(databases, journal):
+    remote, local = databases
+    write_rows(Temperature.__table__, readings(START, 6))
+    retention.compact(START + timedelta(days=4), batch_size=1000)
+    compacted = rollup_samples(remote, TemperatureMinute)
+
+    # a reading of a compacted day arrives late, e.g. from a unit that was offline
+    stray = {'sensor': 1, 'record_time': START + timedelta(hours=12, seconds=30), 'value': 65., 'location': 'Sensor 1'}
+    write_rows(Temperature.__table__, [stray])
+
+    retention.compact(START + timedelta(days=5), batch_size=1000)
+    retention.compact(START + timedelta(days=5), batch_size=1000)
+
+    assert raw_count(remote) == 2 * PER_DAY
+    for rollup in (TemperatureMinute, TemperatureHour, TemperatureDay):
+        samples = rollup_samples(remote, rollup)
+        # the late reading was added to its day's rollups when it was written, and nothing was rebuilt from raw
+        assert samples[START] == compacted[START] + 1
+        assert all(samples[START + timedelta(days=d)] == 2 * PER_DAY for d in range(1, 6))
+
+    daily = history([1, 2], START, START + timedelta(days=6), 86400)
+    assert [point['count'] for point in daily if point['sensor'] == 2] == [PER_DAY] * 6
+
+
+def test_rebuild_leaves_compacted_days_alone(databases):
+    remote, local = databases
+    insert_rows(Temperature.__table__, readings(START, 3))
+    rebuild_rollups(START, START + timedelta(days=3))
+    before = rollup_samples(remote, TemperatureMinute)
+
+    raw = Temperature.__table__
+    remote.execute(raw.delete().where(raw.c.record_time < START + timedelta(days=2)))
+    # a late reading of a compacted day, not yet in its rollups
+    insert_rows(Temperature.__table__, [{'sensor': 1, 'record_time': START + timedelta(hours=1, seconds=30),
+                                         'value': 65., 'location': 'Sensor 1'}])
+
+    assert rebuild_rollups(START, START + timedelta(days=3)) == 1
+    assert rollup_samples(remote, TemperatureMinute) == before
@@ -0,0 +1,38 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from thermo.common.journal import insert_rows
+from thermo.common.models import Temperature
+from thermo.common.rollup import bucket_start, history, rebuild_rollups
+
+WEEK = 7 * 24 * 60 * 60
+
+
+def test_bucket_start():
+    dt = datetime(2017, 1, 4, 13, 47, 12, 500)
+    assert bucket_start(dt, 60) == datetime(2017, 1, 4, 13, 47)
+    assert bucket_start(dt, 15 * 60) == datetime(2017, 1, 4, 13, 45)
+    assert bucket_start(dt, 24 * 60 * 60) == datetime(2017, 1, 4)
+    # weeks start on Thursdays, like the epoch
+    assert bucket_start(dt, WEEK) == datetime(2016, 12, 29)
+    assert bucket_start(datetime(1969, 12, 31, 12), 24 * 60 * 60) == datetime(1969, 12, 31)
+
+
+def test_weekly_history(databases):
+    start = datetime(2016, 12, 29)
+    # one reading per sensor every 3 hours for three weeks
+    rows = [{'sensor': 1, 'record_time': start + timedelta(hours=3 * i), 'value': 60. + i % 7, 'location': 'Kitchen'}
+            for i in range(8 * 21)]
+    insert_rows(Temperature.__table__, rows)
+    rebuild_rollups(start, start + timedelta(days=21))
+
+    weekly = history([1], start, start + timedelta(days=21), WEEK)
+    assert [(point['time'], point['count']) for point in weekly] == \
+        [(start + timedelta(days=7 * w), 56) for w in range(3)]
+    assert weekly[0]['min'] == 60. and weekly[0]['max'] == 66.
+
+
+def test_history_rejects_non_positive_resolution(databases):
+    with pytest.raises(ValueError):
+        history([1], datetime(2017, 1, 1), datetime(2017, 1, 2), 0)
@@ -0,0 +1,142 @@
+import threading
+import time
+
+from thermo.control.scheduler import PeriodicTask, Scheduler, monotonic
+
+
+def run_for(scheduler, seconds):
+    scheduler.start()
+    time.sleep(seconds)
+    scheduler.stop()
+
+
+def test_runs_at_fixed_rate():
+    scheduler = Scheduler()
+    starts = []
+
+    def work():
+        starts.append(monotonic())
+        time.sleep(0.02)  # the period does not stretch by the time each run takes
+
+    task = scheduler.add('work', work, interval=0.1, offset=0.05)
+    run_for(scheduler, 0.62)
+
+    assert 5 <= task.runs <= 6
+    assert task.skipped == 0
+    gaps = [b - a for a, b in zip(starts, starts[1:])]
+    assert abs(sum(gaps) / len(gaps) - 0.1) < 0.02
+
+
+def test_late_runs_are_skipped():
+    scheduler = Scheduler()
+    task = scheduler.add('slow', lambda: time.sleep(0.25), interval=0.1, deadline=0.2)
+    run_for(scheduler, 0.6)
+
+    assert task.runs in (2, 3)
+    assert task.overruns >= 2
+    assert task.skipped >= 2
+    assert task.status()['max_duration'] >= 0.25
+
+
+def test_failures_are_counted_and_the_task_keeps_running():
+    scheduler = Scheduler()
+
+    def fail():
+        raise ValueError('no sensors')
+
+    task = scheduler.add('fail', fail, interval=0.05)
+    run_for(scheduler, 0.22)
+
+    assert task.runs >= 3
+    assert task.failures == task.runs
+
+
+def test_slow_task_does_not_hold_up_others():
+    scheduler = Scheduler()
+    release = threading.Event()
+    scheduler.add('stuck', lambda: release.wait(2.), interval=0.05)
+    fast = scheduler.add('fast', lambda: None, interval=0.05)
+
+    scheduler.start()
+    time.sleep(0.3)
+    release.set()
+    scheduler.stop()
+
+    assert fast.runs >= 5
+
+
+def test_trigger_runs_early_and_keeps_the_schedule():
+    scheduler = Scheduler()
+    ran = threading.Event()
+    task = scheduler.add('control', ran.set, interval=10., offset=5.)
+
+    scheduler.start()
+    scheduler.trigger('control')
+    assert ran.wait(1.)
+    time.sleep(0.1)
+    scheduler.stop()
+
+    assert task.runs == 1
+    assert task.skipped == 0
+    assert task.last_lateness == 0.
+
+
+def test_metrics():
+    task = PeriodicTask('persist', lambda: None, interval=60)
+    task.run_once()
+    scheduler = Scheduler()
+    scheduler.tasks['persist'] = task
+
+    samples = {(name, kind): value for name, kind, labels, value in scheduler.metrics()}
+    assert samples[('task_runs_total', 'counter')] == 1
+    assert samples[('task_overruns_total', 'counter')] == 0
+    assert samples[('task_deadline_seconds', 'gauge')] == 60.
+
+
+class Clock(object):
+    def __init__(self, jumps):
+        """
+        Stands in for the scheduler's clock and waits. A wait moves the clock on by its timeout straight away; the wait
+        after the n-th run also sets the clock by jumps[n] seconds.
+        """
+        self.now = 1000.
+        self.jumps = jumps
+        self.runs = 0
+
+    def monotonic(self):
+        return self.now
+
+    def wait(self, event, timeout):
+        jump = self.jumps.pop(self.runs, 0.)
+        if jump < 0:
+            self.now += jump  # a wait that measures its own time ends as soon as it sees the clock go back
+        else:
+            self.now += timeout + jump
+        return False
+
+
+def test_clock_jumps(monkeypatch):
+    from thermo.control import scheduler
+
+    clock = Clock({3: -3600., 6: 3600.})
+    monkeypatch.setattr(scheduler, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(scheduler, 'wait', clock.wait)
+
+    stop = threading.Event()
+    starts = []
+
+    def work():
+        starts.append(clock.now)
+        clock.runs += 1
+        clock.now += 1.
+        if clock.runs == 9:
+            stop.set()
+
+    task = PeriodicTask('control', work, interval=10., deadline=2., offset=3.)
+    task.loop(clock.now, stop)
+
+    # the first run after each jump follows straight away, and the interval is kept from there on
+    gaps = [b - a for a, b in zip(starts, starts[1:])]
+    assert gaps == [10., 10., 1. - 3600., 10., 10., 10. + 3600., 10., 10.]
+    assert task.skipped == 0
+    assert task.overruns == 0
@@ -0,0 +1,269 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from thermo.common.models import Sensor
+from thermo.sensor import thermal
+from thermo.sensor.recent import RecentTemperatures
+from thermo.sensor.thermal import SensorSweep, read_temp_sensor, trigger_bulk_read, validate_temperature
+from thermo.sensor.window import ZoneWindows
+
+# a DS18B20 resolves 1/16 C, 0.1125 F
+STEP = 0.1125
+
+
+def write_device(base_path, serial_number, millidegrees=21500, crc='YES'):
+    """
+    Write a w1_slave file the way the w1_therm driver presents a DS18B20
+    """
+    directory = os.path.join(base_path, serial_number)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, 'w1_slave'), 'w') as f:
+        f.write('58 01 4b 46 7f ff 08 10 6d : crc=6d {0}\n'.format(crc))
+        f.write('58 01 4b 46 7f ff 08 10 6d t={0}\n'.format(millidegrees))
+
+
+def stuck_device(base_path, serial_number):
+    """
+    A w1_slave that blocks its reader until release() is called, like a device that holds the bus
+    :return: release function
+    """
+    directory = os.path.join(base_path, serial_number)
+    os.makedirs(directory)
+    path = os.path.join(directory, 'w1_slave')
+    os.mkfifo(path)
+
+    def release():
+        # opening the other end lets the blocked open return; the reader then sees an empty file and fails
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+        except OSError:
+            pass  # nothing is reading
+
+    return release
+
+
+def set_bulk_status(trigger, status):
+    # replaced atomically, so that a poll never sees the file empty
+    with open(trigger + '.tmp', 'w') as f:
+        f.write('{0}\n'.format(status))
+    os.rename(trigger + '.tmp', trigger)
+
+
+def replace_stuck_device(base_path, serial_number, millidegrees=21500):
+    os.remove(os.path.join(base_path, serial_number, 'w1_slave'))
+    write_device(base_path, serial_number, millidegrees=millidegrees)
+
+
+def sensor(serial_number, location):
+    return Sensor(id=int(serial_number[-4:], 16), serial_number=serial_number, location=location, user=1, zone=1)
+
+
+@pytest.fixture
+def w1(tmpdir):
+    return str(tmpdir.mkdir('w1'))
+
+
+def test_read_temp_sensor(w1):
+    write_device(w1, '28-000000000001', millidegrees=21500)
+    write_device(w1, '28-000000000002', millidegrees=-1250)
+
+    assert read_temp_sensor('28-000000000001', units='C', base_path=w1) == ('YES', 21.5)
+    assert read_temp_sensor('28-000000000001', base_path=w1) == ('YES', pytest.approx(70.7))
+    assert read_temp_sensor('28-000000000002', units='C', base_path=w1) == ('YES', -1.25)
+
+
+def test_read_temp_sensor_failed_crc(w1):
+    write_device(w1, '28-000000000001', crc='NO')
+
+    with pytest.raises(Exception):
+        read_temp_sensor('28-000000000001', base_path=w1)
+
+
+def test_sweep_reads_every_device(w1):
+    write_device(w1, '28-000000000001', millidegrees=20000)
+    write_device(w1, '28-000000000002', millidegrees=25000)
+    devices = [sensor('28-000000000001', 'Kitchen'), sensor('28-000000000002', 'Bedroom')]
+
+    batch = SensorSweep(base_path=w1, timeout=2., bulk=False, units='C').sweep(devices)
+
+    assert sorted((r.sensor.location, r.value) for r in batch.readings) == [('Bedroom', 25.), ('Kitchen', 20.)]
+    assert batch.failures == {}
+
+
+def test_sweep_reports_missing_device(w1):
+    write_device(w1, '28-000000000001')
+    devices = [sensor('28-000000000001', 'Kitchen'), sensor('28-000000000009', 'Attic')]
+
+    batch = SensorSweep(base_path=w1, timeout=2., bulk=False).sweep(devices)
+
+    assert [r.sensor.location for r in batch.readings] == ['Kitchen']
+    assert list(batch.failures) == ['28-000000000009']
+
+
+def test_sweep_times_out_stuck_device(w1):
+    write_device(w1, '28-000000000001')
+    release = stuck_device(w1, '28-000000000002')
+    devices = [sensor('28-000000000001', 'Kitchen'), sensor('28-000000000002', 'Bedroom')]
+    sweep = SensorSweep(base_path=w1, timeout=0.3, bulk=False)
+
+    try:
+        start = time.time()
+        batch = sweep.sweep(devices)
+        elapsed = time.time() - start
+
+        assert elapsed < 1.5
+        assert [r.sensor.location for r in batch.readings] == ['Kitchen']
+        assert 'Timed out' in str(batch.failures['28-000000000002'])
+    finally:
+        release()
+
+
+def test_sweep_skips_device_whose_read_is_still_stuck(w1):
+    write_device(w1, '28-000000000001')
+    release = stuck_device(w1, '28-000000000002')
+    devices = [sensor('28-000000000001', 'Kitchen'), sensor('28-000000000002', 'Bedroom')]
+    sweep = SensorSweep(base_path=w1, timeout=0.3, bulk=False)
+
+    try:
+        sweep.sweep(devices)
+        reader_threads = [t for t in threading.enumerate() if t.name == 'w1-28-000000000002']
+
+        batch = sweep.sweep(devices)
+
+        # no second thread was started for the stuck device
+        assert [t for t in threading.enumerate() if t.name == 'w1-28-000000000002'] == reader_threads
+        assert 'has not returned' in str(batch.failures['28-000000000002'])
+        assert [r.sensor.location for r in batch.readings] == ['Kitchen']
+    finally:
+        release()
+
+    for thread in reader_threads:
+        thread.join(2.)
+
+    # once the stuck read has returned, the device is read again
+    replace_stuck_device(w1, '28-000000000002')
+    batch = sweep.sweep(devices)
+    assert sorted(r.sensor.location for r in batch.readings) == ['Bedroom', 'Kitchen']
+
+
+def test_bulk_read(w1):
+    write_device(w1, '28-000000000001')
+    os.makedirs(os.path.join(w1, 'w1_bus_master1'))
+    trigger = os.path.join(w1, 'w1_bus_master1', 'therm_bulk_read')
+    set_bulk_status(trigger, 0)
+
+    assert trigger_bulk_read(w1, timeout=1., poll=0.01)
+    with open(trigger, 'r') as f:
+        assert f.read() == 'trigger\n'
+
+    batch = SensorSweep(base_path=w1, timeout=1., bulk=True).sweep([sensor('28-000000000001', 'Kitchen')])
+    assert len(batch.readings) == 1
+
+
+def test_bulk_read_waits_for_conversion(w1):
+    os.makedirs(os.path.join(w1, 'w1_bus_master1'))
+    trigger = os.path.join(w1, 'w1_bus_master1', 'therm_bulk_read')
+
+    def convert():
+        # the driver reports -1 while the conversion runs, then 1
+        time.sleep(0.02)
+        set_bulk_status(trigger, -1)
+        time.sleep(0.2)
+        set_bulk_status(trigger, 1)
+
+    set_bulk_status(trigger, 0)
+    thread = threading.Thread(target=convert)
+    thread.start()
+    try:
+        start = time.time()
+        assert trigger_bulk_read(w1, timeout=2., poll=0.05)
+        assert time.time() - start >= 0.2
+    finally:
+        thread.join()
+
+
+def test_bulk_read_times_out(w1):
+    os.makedirs(os.path.join(w1, 'w1_bus_master1'))
+    trigger = os.path.join(w1, 'w1_bus_master1', 'therm_bulk_read')
+    stop = threading.Event()
+
+    def converting():
+        while not stop.is_set():
+            set_bulk_status(trigger, -1)
+            time.sleep(0.005)
+
+    thread = threading.Thread(target=converting)
+    thread.start()
+    try:
+        assert not trigger_bulk_read(w1, timeout=0.2, poll=0.02)
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_bulk_read_unsupported_falls_back(w1):
+    write_device(w1, '28-000000000001', millidegrees=22000)
+
+    assert not trigger_bulk_read(w1)
+
+    batch = SensorSweep(base_path=w1, timeout=1., bulk=True, units='C').sweep([sensor('28-000000000001', 'Kitchen')])
+    assert [r.value for r in batch.readings] == [22.]
+
+
+def test_bulk_read_failure_falls_back(w1):
+    write_device(w1, '28-000000000001', millidegrees=22000)
+    # a trigger that cannot be written to makes the bulk conversion fail
+    os.makedirs(os.path.join(w1, 'w1_bus_master1', 'therm_bulk_read'))
+
+    batch = SensorSweep(base_path=w1, timeout=1., bulk=True, units='C').sweep([sensor('28-000000000001', 'Kitchen')])
+    assert [r.value for r in batch.readings] == [22.]
+    assert batch.failures == {}
+
+
+def steady_zone(kitchen, start, values):
+    windows = ZoneWindows(lookback=5, limit=50)
+    for i, value in enumerate(values):
+        windows.add(kitchen, start + timedelta(seconds=10 * i), value)
+    return windows
+
+
+def test_validation_accepts_small_step_of_steady_zone():
+    kitchen = sensor('28-000000000001', 'Kitchen')
+    start = datetime(2017, 1, 2, 12)
+    # a steady zone alternates between two quantized values, with a standard deviation of about 0.056 F
+    windows = steady_zone(kitchen, start, [70.25 + STEP * (i % 2) for i in range(20)])
+    now = start + timedelta(seconds=200)
+
+    assert validate_temperature(70.25 + 3 * STEP, kitchen, now, windows=windows)
+    assert not validate_temperature(80., kitchen, now, windows=windows)
+
+
+class FakeQueue(object):
+    def __init__(self):
+        self.rows = []
+
+    def put(self, record_time, value, location, sensor_id):
+        self.rows.append((record_time, value, location, sensor_id))
+
+
+def test_flagged_reading_reaches_hot_tier(w1, monkeypatch):
+    kitchen = sensor('28-000000000001', 'Kitchen')
+    start = datetime.now() - timedelta(seconds=200)
+    windows = steady_zone(kitchen, start, [70.25] * 20)
+    recent = RecentTemperatures()
+    monkeypatch.setattr(thermal, 'zone_windows', windows)
+    monkeypatch.setattr(thermal, 'recent_temperatures', recent)
+
+    # 30 C is 86 F, far outside the window
+    write_device(w1, '28-000000000001', millidegrees=30000)
+    queue = FakeQueue()
+    thermal.main(1, 2, [kitchen], queue=queue, sweep=SensorSweep(base_path=w1, timeout=1., bulk=False))
+
+    assert [row[1] for row in queue.rows] == [pytest.approx(86.)]
+    assert recent.averages(1, 1, now=datetime.now() + timedelta(seconds=1)) == {'Kitchen': pytest.approx(86.)}
+    assert len(windows.get(1, 1)) == 21
@@ -0,0 +1,45 @@
+import threading
+
+from thermo.analysis import simulate  # noqa: F401, installs the fake RPi.GPIO off the Raspberry Pi
+from thermo.control.zones import ZoneControllers
+
+
+class Controller(object):
+    def __init__(self, events):
+        self.events = events
+
+    def heat_relay_is_on(self):
+        return False
+
+    def turn_heat_off(self):
+        self.events.append('off')
+
+
+def test_controller_is_not_removed_during_a_late_decision():
+    events = []
+    controllers = ZoneControllers(log=False)
+    controllers.controllers = {(1, 'HEAT'): Controller(events), (2, 'HEAT'): Controller(events)}
+
+    deciding, release = threading.Event(), threading.Event()
+
+    def decide(zone, zone_controllers, verbosity=0):
+        if zone == 1:
+            deciding.set()
+            release.wait(5.)
+            events.append('decided')
+
+    controllers.decide = decide
+
+    # zone 1's decision outlives the control tick
+    controllers.run(timeout=0.1)
+    assert deciding.is_set() and events == []
+
+    remove = threading.Thread(target=controllers.remove, args=(1, 'HEAT'))
+    remove.start()
+    remove.join(0.2)
+    assert remove.is_alive()  # waiting for the decision
+
+    release.set()
+    remove.join(5.)
+    assert events == ['decided', 'off']
+    assert controllers.get(1, 'HEAT') is None
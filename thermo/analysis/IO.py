@@ -2,15 +2,29 @@ from datetime import datetime, timedelta
 import matplotlib as mat
 import matplotlib.pyplot as plt
 import pandas as pd
-from sqlalchemy.orm import sessionmaker
 
-from thermo.common.models import Temperature, get_engine
-
-
-def get_dataframe(hours=24):
-    engine = get_engine()
-    Session = sessionmaker(bind=engine)
-    session = Session()
+from thermo.analysis.archive import Archive
+from thermo.common.models import Sensor, Temperature, get_session
+from thermo.common.rollup import history
+
+
+def get_dataframe(hours=24, archive=None, start=None, end=None, sensors=None):
+    """
+    :param hours: lookback, used when <start> is not given
+    :param archive: thermo.analysis.archive.Archive (or its path) to read from instead of the database
+    :param start: datetime
+    :param end: datetime
+    :param sensors: list of sensor ids to read from the archive, or None for all
+    :return: pandas.DataFrame indexed by record_time with a column per location
+    """
+    if archive is not None:
+        if not isinstance(archive, Archive):
+            archive = Archive(archive)
+        start = start or datetime.now() - timedelta(hours=hours)
+        df = archive.read(start=start, end=end, sensors=sensors)
+        return df.pivot_table(index='record_time', columns='location', values='value')
+
+    session = get_session()
 
     q = session.query(Temperature).filter(Temperature.record_time >= datetime.now() - timedelta(hours=hours))
     df = pd.read_sql(q.statement, q.session.bind)
@@ -20,6 +34,26 @@ def get_dataframe(hours=24):
     return df
 
 
+def get_history_dataframe(hours=24, resolution=3600, field='mean'):
+    """
+    Like get_dataframe, but read from the temperature rollups, so long lookbacks do not load every raw reading.
+    :param hours: lookback
+    :param resolution: seconds between points
+    :param field: 'min', 'mean', 'max' or 'count'
+    :return: pandas.DataFrame indexed by time with a column per location
+    """
+    session = get_session()
+    locations = dict(session.query(Sensor.id, Sensor.location).all())
+    session.close()
+
+    now = datetime.now()
+    rows = history(list(locations.keys()), now - timedelta(hours=hours), now, resolution)
+    df = pd.DataFrame([{'time': r['time'], 'location': locations[r['sensor']], field: r[field]} for r in rows],
+                      columns=['time', 'location', field])
+
+    return df.pivot_table(index='time', columns='location', values=field)
+
+
 def get_plotting_dataframe(hours=24, resolution='60S', interpolation='linear'):
     mat.style.use('ggplot')
     df = get_dataframe(hours=hours)
@@ -0,0 +1,282 @@
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, select
+
+from thermo import local_settings
+from thermo.common.models import Sensor, Temperature, get_engine, get_session
+
+ARCHIVE_PATH = getattr(local_settings, 'ARCHIVE_PATH', '/home/pi/thermo_archive')
+
+# Values are stored as int16 hundredths of a degree, which covers -327.67 to 327.67
+SCALE = 100.
+MISSING = np.iinfo(np.int16).min
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_seconds(times):
+    """
+    :param times: numpy datetime64 array
+    :return: int64 seconds since the epoch
+    """
+    return np.asarray(times, dtype='datetime64[s]').astype(np.int64)
+
+
+def month_start(dt, months=0):
+    month = dt.month - 1 + months
+    return datetime(dt.year + month // 12, month % 12 + 1, 1)
+
+
+class Archive(object):
+    def __init__(self, path=ARCHIVE_PATH):
+        """
+        Columnar archive of temperatures, one chunk per sensor per month. Each chunk is a pair of .npy files that are
+        memory-mapped when read: the seconds between consecutive readings (the first relative to the chunk's start), in
+        the smallest unsigned integer type that holds them, and the values as int16 hundredths of a degree. index.json
+        lists every chunk with its time span, so reads skip the chunks outside the requested times and sensors without
+        opening them.
+
+        :param path: directory of the archive
+        """
+        self.path = path
+        self.index_path = os.path.join(path, 'index.json')
+        self.index = self._read_index()
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except IOError:
+            return {'sensors': {}}
+
+    def _write_index(self):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.index_path)
+
+    def _chunk_path(self, sensor, chunk, column):
+        return os.path.join(self.path, str(sensor), '{0}.{1}.npy'.format(chunk, column))
+
+    def write_chunk(self, sensor, location, month, times, values):
+        """
+        Write (or replace) the chunk of <sensor> for <month>.
+        :param sensor: sensor id
+        :param location: sensor location, stored in the index so the archive can be read without the database
+        :param month: datetime of the first day of the month
+        :param times: int64 seconds since the epoch, sorted
+        :param values: float temperatures
+        :return:
+        """
+        chunk = month.strftime('%Y-%m')
+        start = int((month - EPOCH).total_seconds())
+
+        deltas = np.diff(np.concatenate([[start], times]))
+        dtype = np.uint16 if len(deltas) == 0 or deltas.max() <= np.iinfo(np.uint16).max else np.uint32
+
+        quantized = np.round(np.asarray(values, dtype=np.float64) * SCALE)
+        quantized[~np.isfinite(quantized) | (np.abs(quantized) >= -MISSING)] = MISSING
+
+        directory = os.path.join(self.path, str(sensor))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # write beside the old chunk and rename over it, so a reader never sees half a chunk
+        for column, data in (('times', deltas.astype(dtype)), ('values', quantized.astype(np.int16))):
+            path = self._chunk_path(sensor, chunk, column)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, data)
+            os.rename(path + '.tmp', path)
+
+        entry = self.index['sensors'].setdefault(str(sensor), {'location': location, 'chunks': {}})
+        entry['location'] = location
+        entry['chunks'][chunk] = {
+            'start': int(times[0]) if len(times) > 0 else start,
+            'end': int(times[-1]) if len(times) > 0 else start,
+            'count': len(times),
+        }
+        self._write_index()
+
+    def _load_chunk(self, sensor, chunk):
+        """
+        :return: (int64 seconds since the epoch, int16 hundredths of a degree) of every reading in the chunk
+        """
+        month = datetime.strptime(chunk, '%Y-%m')
+        deltas = np.load(self._chunk_path(sensor, chunk, 'times'), mmap_mode='r')
+        values = np.load(self._chunk_path(sensor, chunk, 'values'), mmap_mode='r')
+
+        return np.cumsum(deltas, dtype=np.int64) + int((month - EPOCH).total_seconds()), values
+
+    def read_chunk(self, sensor, chunk, start=None, end=None):
+        """
+        :param sensor: sensor id
+        :param chunk: '%Y-%m'
+        :param start: seconds since the epoch, inclusive
+        :param end: seconds since the epoch, inclusive
+        :return: (int64 seconds since the epoch, float values) of the readings from <start> to <end>
+        """
+        times, values = self._load_chunk(sensor, chunk)
+        i = 0 if start is None else np.searchsorted(times, start, side='left')
+        j = len(times) if end is None else np.searchsorted(times, end, side='right')
+
+        times, values = times[i:j], np.asarray(values[i:j])
+        keep = values != MISSING
+        return times[keep], values[keep] / SCALE
+
+    def merge_chunk(self, sensor, location, month, times, values):
+        """
+        Add readings to the chunk of <sensor> for <month>, keeping the readings it already holds, so that exporting a
+        month again after its raw temperatures have been compacted away never loses archived readings. A reading at a
+        time that is already archived replaces the archived one.
+        :param sensor: sensor id
+        :param location: sensor location
+        :param month: datetime of the first day of the month
+        :param times: int64 seconds since the epoch, sorted
+        :param values: float temperatures
+        :return:
+        """
+        chunk = month.strftime('%Y-%m')
+        if chunk in self.index['sensors'].get(str(sensor), {'chunks': {}})['chunks']:
+            archived_times, archived = self._load_chunk(sensor, chunk)
+            archived_values = np.where(archived == MISSING, np.nan, archived / SCALE)
+
+            keep = ~np.isin(archived_times, times)
+            times = np.concatenate([archived_times[keep], times])
+            values = np.concatenate([archived_values[keep], values])
+            order = np.argsort(times, kind='mergesort')
+            times, values = times[order], values[order]
+
+        self.write_chunk(sensor, location, month, times, values)
+
+    def read(self, start=None, end=None, sensors=None):
+        """
+        :param start: datetime, inclusive
+        :param end: datetime, inclusive
+        :param sensors: list of sensor ids, or None for all
+        :return: pandas.DataFrame with record_time, sensor, location and value columns
+        """
+        start_s = None if start is None else int((start - EPOCH).total_seconds())
+        end_s = None if end is None else int((end - EPOCH).total_seconds())
+        wanted = None if sensors is None else set(str(s) for s in sensors)
+
+        frames = []
+        for sensor, entry in sorted(self.index['sensors'].items()):
+            if wanted is not None and sensor not in wanted:
+                continue
+
+            for chunk, span in sorted(entry['chunks'].items()):
+                if span['count'] == 0 or (start_s is not None and span['end'] < start_s) or \
+                        (end_s is not None and span['start'] > end_s):
+                    continue
+
+                times, values = self.read_chunk(sensor, chunk, start_s, end_s)
+                frames.append(pd.DataFrame({
+                    'record_time': pd.to_datetime(times, unit='s'),
+                    'sensor': int(sensor),
+                    'location': entry['location'],
+                    'value': values,
+                }, columns=['record_time', 'sensor', 'location', 'value']))
+
+        if len(frames) == 0:
+            return pd.DataFrame(columns=['record_time', 'sensor', 'location', 'value'])
+        return pd.concat(frames, ignore_index=True)
+
+    def export(self, start, end=None, local=False, batch_size=10000):
+        """
+        Copy the temperatures from <start> to <end> out of the database, one month at a time. Months already in the
+        archive are merged with the readings in the database, so the current month can be exported again as it fills
+        up, and a month whose raw temperatures have since been compacted keeps what was archived. The readings are
+        streamed from the database, so only one sensor-month is held in memory at a time.
+        :param start: datetime
+        :param end: datetime, defaults to now
+        :param local: Use the local SQLite database if true
+        :param batch_size: rows fetched from the database at a time
+        :return: number of readings written
+        """
+        end = end or datetime.now()
+        raw = Temperature.__table__
+        engine = get_engine(local=local)
+
+        session = get_session(local=local)
+        locations = dict(session.query(Sensor.id, Sensor.location).all())
+        session.close()
+
+        written = 0
+        month = month_start(start)
+        while month <= end:
+            next_month = month_start(month, 1)
+            exported = 0
+
+            with engine.connect() as connection:
+                # a server side cursor on MySQL, rather than the whole month in the client's memory
+                result = connection.execution_options(stream_results=True).execute(
+                    select([raw.c.sensor, raw.c.record_time, raw.c.value])
+                        .where(and_(raw.c.record_time >= month, raw.c.record_time < next_month))
+                        .order_by(raw.c.sensor, raw.c.record_time)
+                )
+
+                for sensor, times, values in sensor_runs(result, batch_size):
+                    self.merge_chunk(sensor, locations.get(sensor), month, times, values)
+                    exported += len(times)
+
+            written += exported
+            logging.info('Archived {0} temperatures from {1:%Y-%m}.'.format(exported, month))
+            month = next_month
+
+        return written
+
+
+def sensor_runs(result, batch_size=10000):
+    """
+    Group a query's rows by sensor while fetching them <batch_size> at a time
+    :param result: result of a query for sensor, record_time and value, ordered by sensor
+    :param batch_size: rows fetched at a time
+    :return: generator of (sensor id, int64 seconds since the epoch, float values), one per sensor
+    """
+    sensor, times, values = None, [], []
+    while True:
+        rows = result.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+
+        sensor_ids = np.array([r[0] for r in rows])
+        batch_times = to_seconds(np.array([r[1] for r in rows], dtype='datetime64[us]'))
+        batch_values = np.array([np.nan if r[2] is None else r[2] for r in rows], dtype=np.float64)
+
+        # rows are ordered by sensor, so each sensor's readings are one contiguous run
+        boundaries = np.flatnonzero(np.diff(sensor_ids)) + 1
+        for i, j in zip(np.concatenate([[0], boundaries]), np.concatenate([boundaries, [len(rows)]])):
+            if sensor_ids[i] != sensor:
+                if sensor is not None:
+                    yield sensor, np.concatenate(times), np.concatenate(values)
+                sensor, times, values = int(sensor_ids[i]), [], []
+
+            times.append(batch_times[i:j])
+            values.append(batch_values[i:j])
+
+    if sensor is not None:
+        yield sensor, np.concatenate(times), np.concatenate(values)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export temperatures from the database to the columnar archive.')
+    parser.add_argument('start', help='%Y-%m-%d')
+    parser.add_argument('end', help='%Y-%m-%d', nargs='?', default=None)
+    parser.add_argument('--path', default=ARCHIVE_PATH)
+    parser.add_argument('--local', default=False, action='store_true', help='export from the local SQLite database')
+    args = parser.parse_args()
+
+    logging.basicConfig(**local_settings.LOGGING)
+    archive = Archive(args.path)
+    n = archive.export(
+        datetime.strptime(args.start, '%Y-%m-%d'),
+        datetime.strptime(args.end, '%Y-%m-%d') + timedelta(days=1) if args.end else None,
+        local=args.local
+    )
+    print('Archived {0} temperatures to {1}.'.format(n, args.path))
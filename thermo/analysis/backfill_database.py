@@ -1,42 +1,191 @@
+import logging
+import os
+import sys
+import time
 from datetime import datetime
-from sys import stdout
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import sessionmaker
-from thermo.common.models import Temperature, get_engine
-
-engine = get_engine()
-Session = sessionmaker(bind=engine)
-session = Session()
-
-backfill = []
-with open('/home/pi/temps.csv', 'r') as f:
-    line = f.readline()
-    i = 0
-    while line:
-        temperature, record_time, location = line.split(',')
-        location = location.replace('\n', '')
-        record_time = datetime.strptime(record_time, '%Y-%m-%d %H:%M:%S')
-        temperature = float(temperature)
-        backfill.append(
-            Temperature(value=temperature, record_time=record_time, location=location)
-        )
+
+from thermo import local_settings
+from thermo.common.journal import insert_rows_idempotent
+from thermo.common.models import Sensor, Temperature, get_session
+from thermo.common.rollup import rebuild_rollups
+
+
+def get_sensor_ids(user, local=False):
+    """
+    :param user: user id
+    :param local: Use the local SQLite database if true
+    :return: {location: sensor id}
+    """
+    session = get_session(local=local)
+    results = session.query(Sensor.location, Sensor.id).filter(Sensor.user == user).all()
+    session.close()
+
+    return {location: sensor_id for location, sensor_id in results}
+
+
+CHECKPOINT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def read_checkpoint(path):
+    """
+    :param path: checkpoint file
+    :return: (byte offset, [first, last] record_time of the rows loaded so far, or [] if none or not recorded)
+    """
+    try:
+        with open(path, 'r') as f:
+            fields = f.read().split()
+    except IOError:
+        return 0, []
+
+    if len(fields) == 0:
+        return 0, []
+    return int(fields[0]), [datetime.strptime(field, CHECKPOINT_TIME_FORMAT) for field in fields[1:3]]
+
+
+def write_checkpoint(path, offset, span):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(' '.join([str(offset)] + [t.strftime(CHECKPOINT_TIME_FORMAT) for t in span]))
+    os.rename(tmp, path)
+
+
+def file_span(path, end):
+    """
+    :param path: temperature CSV
+    :param end: byte offset to stop at
+    :return: [first, last] record_time of the lines before <end>, or [] if there are none
+    """
+    span = []
+    with open(path, 'r') as f:
         line = f.readline()
-        i += 1
+        while line and f.tell() <= end:
+            try:
+                _, record_time, _ = parse_line(line)
+                span = [min(span + [record_time]), max(span + [record_time])]
+            except ValueError:
+                pass
+            line = f.readline()
+    return span
+
+
+def parse_line(line):
+    """
+    :param line: 'temperature,%Y-%m-%d %H:%M:%S,location', the format of the sensors' CSV logs
+    :return: (temperature, record_time, location)
+    """
+    temperature, record_time, location = line.rstrip('\r\n').split(',', 2)
+    return float(temperature), datetime.strptime(record_time, '%Y-%m-%d %H:%M:%S'), location
+
+
+def backfill(path, user, chunk_size=5000, checkpoint=None, local=False, progress=sys.stderr):
+    """
+    Stream a temperature CSV into the temperature table in chunks of <chunk_size> rows. Rows that are already in the
+    database are skipped, so a load can be repeated or resumed safely. The byte offset of the last loaded chunk, and the
+    span of the rows loaded so far, are written to <checkpoint>, and a later call with the same checkpoint resumes from
+    there. The rollups are rebuilt over the span of every loaded row, including those of earlier, interrupted calls,
+    once the load is complete.
 
-        stdout.write('\r{}\t\t'.format(str(i)))
-        if i % 100 == 0:
+    :param path: CSV file of temperature,record_time,location lines
+    :param user: user id, used to resolve each location to its sensor id
+    :param chunk_size: rows per insert
+    :param checkpoint: path of the checkpoint file, or None to always start from the beginning
+    :param local: Load into the local SQLite database if true
+    :param progress: file that progress is reported to, or None
+    :return: (rows inserted, rows skipped)
+    """
+    sensor_ids = get_sensor_ids(user, local=local)
+    table = Temperature.__table__
+
+    offset, span = read_checkpoint(checkpoint) if checkpoint is not None else (0, [])
+    if offset > 0 and len(span) == 0:
+        # a checkpoint that does not record the span of the rows it has loaded
+        span = file_span(path, offset)
+    size = os.path.getsize(path)
+    inserted, skipped, unknown = 0, 0, set()
+    start = time.time()
+
+    def load(rows, offset):
+        n = insert_rows_idempotent(table, rows, local=local)
+        times = [row['record_time'] for row in rows]
+        span[:] = [min(span + times), max(span + times)]
+        if checkpoint is not None:
+            write_checkpoint(checkpoint, offset, span)
+        return n
+
+    def report(offset):
+        if progress is not None:
+            progress.write('\r{0:.1f}% {1} inserted, {2} skipped, {3:.0f} rows/s\t'.format(
+                100. * offset / max(size, 1), inserted, skipped, (inserted + skipped) / max(time.time() - start, 1e-6)
+            ))
+            progress.flush()
+
+    with open(path, 'r') as f:
+        f.seek(offset)
+        rows = []
+
+        line = f.readline()
+        while line:
             try:
-                session.add_all(backfill)
-                session.commit()
-            except IntegrityError:
-                session.rollback()
-            finally:
-                backfill = []
-
-try:
-    session.add_all(backfill)
-    session.commit()
-except IntegrityError:
-    session.rollback()
-finally:
-    backfill = []
+                temperature, record_time, location = parse_line(line)
+            except ValueError:
+                logging.warning('Skipping malformed line: {0}'.format(line.strip()))
+                skipped += 1
+                line = f.readline()
+                continue
+
+            if location in sensor_ids:
+                rows.append({'value': temperature, 'record_time': record_time, 'location': location,
+                             'sensor': sensor_ids[location]})
+            else:
+                unknown.add(location)
+                skipped += 1
+
+            # the checkpoint is the end of the last line of the chunk, so a resumed load starts with the next line
+            if len(rows) >= chunk_size:
+                n = load(rows, f.tell())
+                inserted += n
+                skipped += len(rows) - n
+                rows = []
+                report(f.tell())
+            line = f.readline()
+
+        if len(rows) > 0:
+            n = load(rows, f.tell())
+            inserted += n
+            skipped += len(rows) - n
+        elif checkpoint is not None:
+            write_checkpoint(checkpoint, f.tell(), span)
+        report(f.tell())
+
+    if progress is not None:
+        progress.write('\n')
+
+    if len(span) > 0:
+        rebuild_rollups(span[0], span[1], local=local)
+
+    for location in unknown:
+        logging.warning('No sensor found for location {0}; its rows were skipped.'.format(location))
+
+    return inserted, skipped
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Bulk load a temperature CSV into the database.')
+    parser.add_argument('path', nargs='?', default='/home/pi/temps.csv')
+    parser.add_argument('--user', type=int, default=local_settings.USER_NUMBER)
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--checkpoint', default=None,
+                        help='checkpoint file used to resume an interrupted load, defaults to <path>.checkpoint')
+    parser.add_argument('--restart', default=False, action='store_true', help='ignore an existing checkpoint')
+    parser.add_argument('--local', default=False, action='store_true', help='load into the local SQLite database')
+    args = parser.parse_args()
+
+    checkpoint = args.checkpoint or args.path + '.checkpoint'
+    if args.restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    inserted, skipped = backfill(args.path, args.user, chunk_size=args.chunk_size, checkpoint=checkpoint,
+                                 local=args.local)
+    print('Inserted {0} rows, skipped {1}.'.format(inserted, skipped))
@@ -0,0 +1,525 @@
+import importlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+
+class FakeGPIO(types.ModuleType):
+    """
+    Stand-in for RPi.GPIO that keeps the pin states in memory and records every change of an output pin.
+    """
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, clock=None):
+        types.ModuleType.__init__(self, 'RPi.GPIO')
+        self.clock = clock
+        self.mode = None
+        self.pins = {}
+        self.transitions = []  # (time, pin, value)
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, initial=LOW):
+        self.pins.setdefault(pin, initial)
+
+    def output(self, pin, value):
+        value = int(bool(value))
+        if self.pins.get(pin) != value:
+            self.transitions.append((self.clock.now() if self.clock is not None else datetime.now(), pin, value))
+        self.pins[pin] = value
+
+    def input(self, pin):
+        return self.pins.get(pin, self.LOW)
+
+    def cleanup(self):
+        self.pins.clear()
+
+
+# The control modules import RPi.GPIO when they are loaded; off the Raspberry Pi, give them the fake one
+if 'RPi.GPIO' not in sys.modules:
+    try:
+        importlib.import_module('RPi.GPIO')  # only to find out whether the real one is available
+    except (ImportError, RuntimeError):
+        _rpi = types.ModuleType('RPi')
+        _rpi.GPIO = FakeGPIO()
+        sys.modules['RPi'], sys.modules['RPi.GPIO'] = _rpi, _rpi.GPIO
+
+from thermo import local_settings
+from thermo.common.models import *
+from thermo.common.rollup import history
+from thermo.control import thermostat
+from thermo.control.lag import LagLearner
+from thermo.sensor import recent, thermal
+
+SimulatedSensor = namedtuple('SimulatedSensor', 'user zone location bias serial_number indoors')
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class VirtualClock(object):
+    def __init__(self, start):
+        """
+        Simulated time, which only moves when advanced. While patched into modules (see Simulation.patched), their
+        datetime.now(), time.time() and time.sleep() follow this clock.
+
+        :param start: datetime
+        """
+        self.current = start
+        clock = self
+
+        class VirtualDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return clock.current
+
+        class VirtualTime(object):
+            def __getattr__(self, name):
+                return getattr(time, name)
+
+            def time(self):
+                return clock.time()
+
+            def sleep(self, seconds):
+                clock.advance(seconds)
+
+        self.datetime = VirtualDatetime
+        self.time_module = VirtualTime()
+
+    def now(self):
+        return self.current
+
+    def time(self):
+        return (self.current - EPOCH).total_seconds()
+
+    def advance(self, seconds):
+        self.current += timedelta(seconds=seconds)
+
+
+class ThermalModel(object):
+    def __init__(self, rooms, tau=120.):
+        """
+        First-order thermal model of a zone. Each room loses heat to the outside in proportion to the temperature
+        difference, and gains it from the furnace in proportion to the furnace's output, which follows the relay with a
+        time constant of <tau> seconds:
+
+            dT/dt = loss * (outside - T) + gain * output + drift
+            d(output)/dt = (relay - output) / tau
+
+        :param rooms: {location: (loss, gain, drift)} in 1/s, degrees/s and degrees/s
+        :param tau: seconds
+        """
+        self.locations = sorted(rooms.keys())
+        self.loss, self.gain, self.drift = [np.array([rooms[l][i] for l in self.locations]) for i in range(3)]
+        self.tau = tau
+        self.output = 0.
+
+    @property
+    def rooms(self):
+        return {l: (self.loss[i], self.gain[i], self.drift[i]) for i, l in enumerate(self.locations)}
+
+    def step(self, temps, outside, relay, dt):
+        """
+        :param temps: numpy array of room temperatures, in the order of self.locations
+        :param outside: outside temperature
+        :param relay: 1 if the heat is on
+        :param dt: seconds
+        :return: room temperatures after <dt> seconds
+        """
+        self.output += (relay - self.output) * (min(1., dt / self.tau) if self.tau > 0 else 1.)
+        return temps + dt * (self.loss * (outside - temps) + self.gain * self.output + self.drift)
+
+    def equilibrium(self, outside, output=0.):
+        return outside + (self.gain * output + self.drift) / self.loss
+
+
+def fit_model(temps, relay, outside, taus=(0., 60., 120., 240., 480., 900.)):
+    """
+    Fit a ThermalModel by least squares, choosing the furnace time constant with the smallest residual.
+    :param temps: pandas.DataFrame of room temperatures on a regular DatetimeIndex, a column per location
+    :param relay: pandas.Series of the relay state (0/1) on the same index
+    :param outside: pandas.Series of the outside temperature on the same index
+    :param taus: candidate time constants in seconds
+    :return: ThermalModel
+    """
+    dt = (temps.index[1] - temps.index[0]).total_seconds()
+    u = relay.values.astype(np.float64)
+
+    best = None
+    for tau in taus:
+        output = np.zeros(len(u))
+        for k in range(1, len(u)):
+            output[k] = output[k - 1] + (u[k - 1] - output[k - 1]) * (min(1., dt / tau) if tau > 0 else 1.)
+
+        rooms, residual = {}, 0.
+        for location in temps.columns:
+            t = temps[location].values
+            dTdt = np.diff(t) / dt
+            X = np.column_stack([outside.values[:-1] - t[:-1], output[:-1], np.ones(len(t) - 1)])
+            ok = np.isfinite(dTdt) & np.all(np.isfinite(X), axis=1)
+            if ok.sum() < 10:
+                continue
+
+            coefficients, _, _, _ = np.linalg.lstsq(X[ok], dTdt[ok], rcond=None)
+            rooms[location] = (max(coefficients[0], 1e-6), max(coefficients[1], 0.), coefficients[2])
+            residual += np.sum((X[ok].dot(coefficients) - dTdt[ok]) ** 2)
+
+        if len(rooms) > 0 and (best is None or residual < best[0]):
+            best = (residual, ThermalModel(rooms, tau=tau))
+
+    if best is None:
+        raise ValueError('Not enough history to fit a thermal model.')
+
+    return best[1]
+
+
+@fallback_locally
+def load_history(user, zone, start, end, local=False):
+    """
+    Minute temperatures of a zone's rooms and of the outdoor sensors, and the state of the zone's heat relay.
+    :param user: user id
+    :param zone: zone id
+    :param start: datetime
+    :param end: datetime
+    :param local: Use the local SQLite database if true
+    :return: (temps DataFrame, relay Series, outside Series) on a one-minute index
+    """
+    session = get_session(local=local)
+    sensors = session.query(Sensor).filter(Sensor.user == user).all()
+    action = session.query(Action.id) \
+        .filter(Action.zone == zone) \
+        .filter(Action.name == 'HEAT') \
+        .first()
+    logs = session.query(ActionLog.record_time, ActionLog.value) \
+        .filter(ActionLog.action == action.id) \
+        .filter(ActionLog.record_time >= start - timedelta(days=1)) \
+        .filter(ActionLog.record_time <= end) \
+        .order_by(ActionLog.record_time) \
+        .all()
+    session.close()
+
+    indoor = {s.id: s for s in sensors if s.zone == zone and s.indoors}
+    outdoor = {s.id: s for s in sensors if not s.indoors}
+    rows = history(list(indoor.keys()) + list(outdoor.keys()), start, end, 60, local=local)
+
+    index = pd.date_range(start.replace(second=0, microsecond=0), end, freq='1min')
+    df = pd.DataFrame([
+        {'time': r['time'], 'sensor': r['sensor'], 'value': r['mean'] - (indoor.get(r['sensor']) or
+                                                                         outdoor[r['sensor']]).bias}
+        for r in rows
+    ], columns=['time', 'sensor', 'value']).pivot_table(index='time', columns='sensor', values='value')
+    df = df.reindex(index).interpolate(limit=10)
+
+    temps = pd.DataFrame({indoor[s].location: df[s] for s in indoor if s in df}, index=index)
+    outside = df[[s for s in outdoor if s in df]].mean(axis=1)
+
+    if len(logs) > 0:
+        states = pd.Series([value for _, value in logs], index=pd.DatetimeIndex([t for t, _ in logs]))
+        relay = states.groupby(level=0).last().reindex(index, method='ffill').fillna(0)
+    else:
+        relay = pd.Series(0., index=index)
+
+    return temps, relay, outside
+
+
+def fit_from_database(zone, start, end, user=None, local=False):
+    temps, relay, outside = load_history(user or local_settings.USER_NUMBER, zone, start, end, local=local)
+    return fit_model(temps, relay, outside)
+
+
+def synthetic_weather(mean=30., swing=10., coldest_hour=5):
+    """
+    :return: function of a datetime giving an outside temperature that swings by <swing> degrees around <mean> over the
+        day, coldest at <coldest_hour>
+    """
+    def weather(t):
+        hours = t.hour + t.minute / 60. - coldest_hour
+        return mean - swing / 2. * np.cos(2 * np.pi * hours / 24.)
+
+    return weather
+
+
+def historical_weather(outside):
+    """
+    :param outside: pandas.Series of outside temperatures on a DatetimeIndex
+    :return: function of a datetime giving the recorded temperature, repeating the record when it runs out
+    """
+    outside = outside.dropna()
+    seconds = (outside.index - outside.index[0]).total_seconds().values
+    values = outside.values
+    period = seconds[-1] + 60.
+
+    def weather(t):
+        return np.interp((t - outside.index[0].to_pydatetime()).total_seconds() % period, seconds, values)
+
+    return weather
+
+
+class SimulatedSchedule(thermostat.Schedule):
+    def __init__(self, zone, schedule, name='simulated'):
+        """
+        A Schedule that reads <schedule> instead of the database, and never has messages to poll.
+        """
+        self.raw = json.dumps(schedule)
+        self.name = name
+        thermostat.Schedule.__init__(self, zone, refresh_interval=24 * 60 * 60)
+
+    def get_schedule_source(self, local=False):
+        return self.raw, self.name
+
+    def get_override_messages(self, local=False):
+        pass
+
+
+class Simulation(object):
+    def __init__(self, model, schedule, weather, start, zone=1, tick=10., buffer=0.5, lags=(0., 0.), learn=True,
+                 noise=0.05, sysfs=False, seed=0, initial=None):
+        """
+        Run the thermostat control code (thermostat.main) against a ThermalModel, on a virtual clock that advances
+        <tick> seconds per pass of the loop rather than waiting for them.
+
+        Sensor readings are generated from the model's room temperatures with Gaussian noise and go through the same
+        hot tier the control loop reads; with <sysfs>, they are first written as w1_slave files to a temporary
+        directory and read back with thermal.read_temp_sensor. The heat relay is a FakeGPIO pin.
+
+        :param model: ThermalModel
+        :param schedule: {room: {'<weekday>': [['HHMM', target], ...]}}; rooms should match the model's locations
+        :param weather: function of a datetime giving the outside temperature
+        :param start: datetime
+        :param zone: zone id
+        :param tick: seconds per pass of the control loop
+        :param buffer: hysteresis buffer passed to thermostat.main
+        :param lags: initial (heat off lag, heat on lag)
+        :param learn: update the lags online with LagLearner, as the control loop does
+        :param noise: standard deviation of the sensor noise
+        :param sysfs: read the readings through a fake 1-Wire sysfs tree
+        :param seed: random seed of the sensor noise
+        :param initial: initial room temperatures, defaults to the scheduled targets
+        """
+        self.model = model
+        self.weather = weather
+        self.zone = zone
+        self.tick = tick
+        self.buffer = buffer
+        self.noise = noise
+        self.random = np.random.RandomState(seed)
+
+        self.clock = VirtualClock(start)
+        self.gpio = FakeGPIO(self.clock)
+        self.recent = recent.RecentTemperatures(retention=5)
+        self.user = local_settings.USER_NUMBER
+
+        self.sensors = [
+            SimulatedSensor(self.user, zone, location, 0., '28-sim{0:06d}'.format(i), True)
+            for i, location in enumerate(model.locations)
+        ]
+        self.sysfs = tempfile.mkdtemp(prefix='thermo_w1_') if sysfs else None
+        if self.sysfs is not None:
+            for sensor in self.sensors:
+                os.makedirs(os.path.join(self.sysfs, sensor.serial_number))
+
+        with self.patched():
+            self.schedule = SimulatedSchedule(zone, schedule)
+            self.hvac = self.make_hvac(lags, learn)
+
+            targets = self.schedule.current_target_temps()
+            self.temps = np.array([
+                (initial or {}).get(l, targets.get(l) if targets.get(l) is not None else 68.) for l in model.locations
+            ], dtype=np.float64)
+
+    def make_hvac(self, lags, learn):
+        """
+        An HVAC set up as HVAC.__init__ would for a zone whose sensors are all attached to this unit, without the
+        database
+        """
+        hvac = thermostat.HVAC.__new__(thermostat.HVAC)
+        hvac.log = False
+        hvac.zone = self.zone
+        hvac.user = self.user
+        hvac.unit = local_settings.UNIT_NUMBER
+        hvac.zone_is_local = True
+        hvac.temperatures = None
+        hvac.fallback_sensors = []
+        hvac.heat_pin = local_settings.GPIO_PINS.get('HEAT', 17)
+        hvac.heat_action_id = None
+        hvac.schedule = self.schedule
+
+        self.gpio.setup(hvac.heat_pin, self.gpio.OUT)
+        hvac.heat_off_lag, hvac.heat_on_lag = lags
+        hvac.lag_learner = LagLearner(lags[0], lags[1], **getattr(local_settings, 'LAG_LEARNER', {}))
+        hvac.save_lags = lambda *args, **kwargs: None
+        if not learn:
+            hvac.learn_lags = lambda *args, **kwargs: None
+            hvac.lag_learner.switch = lambda *args, **kwargs: False
+
+        return hvac
+
+    @contextmanager
+    def patched(self):
+        """
+        Point the control code at the virtual clock, the fake GPIO and this simulation's hot tier
+        """
+        patches = [
+            (thermostat, 'GPIO', self.gpio),
+            (thermostat, 'datetime', self.clock.datetime),
+            (thermostat, 'time', self.clock.time_module),
+            (thermostat, 'recent_temperatures', self.recent),
+            (recent, 'datetime', self.clock.datetime),
+        ]
+        saved = [(module, name, getattr(module, name)) for module, name, _ in patches]
+        try:
+            for module, name, value in patches:
+                setattr(module, name, value)
+            yield
+        finally:
+            for module, name, value in saved:
+                setattr(module, name, value)
+
+    def read_sensors(self):
+        values = self.temps + self.random.normal(0., self.noise, len(self.temps))
+        if self.sysfs is None:
+            return values
+
+        readings = []
+        for sensor, value in zip(self.sensors, values):
+            with open(os.path.join(self.sysfs, sensor.serial_number, 'w1_slave'), 'w') as f:
+                f.write('00 00 00 00 00 00 00 00 00 : crc=00 YES\n'
+                        '00 00 00 00 00 00 00 00 00 t={0:d}\n'.format(int(round((value - 32.) * 5. / 9. * 1000.))))
+            readings.append(thermal.read_temp_sensor(sensor.serial_number, base_path=self.sysfs)[1])
+        return np.array(readings)
+
+    def run(self, end, progress=None):
+        """
+        :param end: datetime
+        :param progress: file that the simulated date is reported to once per simulated day, or None
+        :return: dict of runtime and comfort metrics
+        """
+        pin = self.hvac.heat_pin
+        ticks, on_ticks, cycles = 0, 0, 0
+        errors, cold, hot = [], 0., 0.
+        previous = self.gpio.input(pin)
+        day = None
+        wall = time.time()
+
+        with self.patched():
+            while self.clock.current < end:
+                now = self.clock.current
+                self.temps = self.model.step(self.temps, self.weather(now), self.gpio.input(pin), self.tick)
+
+                for sensor, value in zip(self.sensors, self.read_sensors()):
+                    self.recent.add(sensor, now, value)
+
+                thermostat.main(self.hvac, buffer=self.buffer)
+
+                relay = self.gpio.input(pin)
+                on_ticks += relay
+                cycles += relay and not previous
+                previous = relay
+
+                targets = self.schedule.current_target_temps(now)
+                scheduled = [(t, targets[l]) for t, l in zip(self.temps, self.model.locations)
+                             if targets.get(l) is not None]
+                if len(scheduled) > 0:
+                    error = np.median([t for t, _ in scheduled]) - np.median([target for _, target in scheduled])
+                    errors.append(error)
+                    cold += max(-error, 0.) * self.tick / 3600.
+                    hot += max(error, 0.) * self.tick / 3600.
+
+                ticks += 1
+                self.clock.advance(self.tick)
+
+                if progress is not None and now.date() != day:
+                    day = now.date()
+                    progress.write('\r{0:%Y-%m-%d}\t'.format(now))
+                    progress.flush()
+
+        if self.sysfs is not None:
+            shutil.rmtree(self.sysfs, ignore_errors=True)
+
+        errors = np.array(errors) if len(errors) > 0 else np.array([np.nan])
+        return {
+            'runtime_hours': on_ticks * self.tick / 3600.,
+            'cycles': cycles,
+            'mean_abs_error': float(np.mean(np.abs(errors))),
+            'max_overshoot': float(np.max(errors)),
+            'max_undershoot': float(np.min(errors)),
+            'cold_degree_hours': cold,
+            'hot_degree_hours': hot,
+            'heat_off_lag': self.hvac.heat_off_lag,
+            'heat_on_lag': self.hvac.heat_on_lag,
+            'ticks': ticks,
+            'ticks_per_second': ticks / max(time.time() - wall, 1e-6),
+        }
+
+
+def backtest(model, schedule, weather, start, end, buffers=(0.5,), lags=((0., 0.),), learn=(True,), **kwargs):
+    """
+    Simulate every combination of <buffers>, <lags> and <learn> over the same period and weather.
+    :return: pandas.DataFrame of the metrics of each combination
+    """
+    results = []
+    for buffer, lag, l in itertools.product(buffers, lags, learn):
+        sim = Simulation(model, schedule, weather, start, buffer=buffer, lags=lag, learn=l, **kwargs)
+        metrics = sim.run(end)
+        metrics.update({'buffer': buffer, 'initial_lags': lag, 'learn': l})
+        results.append(metrics)
+        logging.info('Simulated buffer {0}, lags {1}, learn {2}: {3:.1f} h of heat, {4} cycles.'.format(
+            buffer, lag, l, metrics['runtime_hours'], metrics['cycles']))
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Backtest thermostat settings against a thermal model of a zone.')
+    parser.add_argument('--zone', type=int, default=1)
+    parser.add_argument('--fit-days', type=int, default=30, help='days of history the thermal model is fit to')
+    parser.add_argument('--start', default=None, help='%%Y-%%m-%%d of the simulated period, defaults to today')
+    parser.add_argument('--days', type=float, default=90)
+    parser.add_argument('--buffer', type=float, nargs='+', default=[0.5])
+    parser.add_argument('--lags', type=float, nargs=2, action='append', metavar=('OFF', 'ON'),
+                        help='initial heat off and heat on lags; repeat to compare several')
+    parser.add_argument('--no-learn', default=False, action='store_true', help='keep the lags fixed')
+    parser.add_argument('--outside', type=float, default=None,
+                        help='mean outside temperature of a synthetic winter, instead of the recorded weather')
+    parser.add_argument('--sysfs', default=False, action='store_true', help='read sensors through a fake sysfs')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    now = datetime.now()
+    temps, relay, outside = load_history(local_settings.USER_NUMBER, args.zone, now - timedelta(days=args.fit_days),
+                                         now)
+    model = fit_model(temps, relay, outside)
+    print('Fit thermal model: tau {0:.0f} s, rooms {1}'.format(model.tau, model.rooms))
+
+    schedule = thermostat.Schedule(args.zone).schedule
+    start = datetime.strptime(args.start, '%Y-%m-%d') if args.start else now.replace(hour=0, minute=0, second=0,
+                                                                                    microsecond=0)
+    weather = synthetic_weather(args.outside) if args.outside is not None else historical_weather(outside)
+
+    results = backtest(model, schedule, weather, start, start + timedelta(days=args.days), buffers=args.buffer,
+                       lags=[tuple(l) for l in args.lags] if args.lags else [(0., 0.)],
+                       learn=[not args.no_learn], sysfs=args.sysfs)
+    pd.set_option('display.width', 200)
+    print(results)
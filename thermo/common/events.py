@@ -0,0 +1,67 @@
+import logging
+import threading
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+
+class Publisher(object):
+    def __init__(self, max_pending=100):
+        """
+        In-process fan-out of events (sensor batches, relay changes) to any number of subscribers. Each subscriber gets
+        its own queue; a subscriber that falls more than <max_pending> events behind misses the newer ones rather than
+        holding up the publisher.
+
+        :param max_pending: queue size of each subscriber
+        """
+        self.max_pending = max_pending
+        self.subscribers = set()
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        """
+        :return: Queue that receives every event published from now on; pass it to unsubscribe when done
+        """
+        queue = Queue(maxsize=self.max_pending)
+        with self.lock:
+            self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            self.subscribers.discard(queue)
+
+    def add_listener(self, callback):
+        """
+        Call <callback> with each event, on the publishing thread.
+        """
+        with self.lock:
+            self.listeners.append(callback)
+
+    def publish(self, event):
+        """
+        :param event: JSON serializable dict with a 'type' key
+        :return:
+        """
+        with self.lock:
+            subscribers = list(self.subscribers)
+            listeners = list(self.listeners)
+
+        for queue in subscribers:
+            try:
+                queue.put_nowait(event)
+            except Full:
+                pass
+
+        for callback in listeners:
+            try:
+                callback(event)
+            except Exception as e:
+                logging.error('Event listener failed.')
+                logging.exception(e)
+
+
+publisher = Publisher()
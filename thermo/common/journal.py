@@ -0,0 +1,333 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import DateTime, and_, select
+
+from thermo import local_settings
+from thermo.common.metrics import metrics
+from thermo.common.models import Base, call_remote, CircuitOpenError, get_engine, is_connection_error, Temperature
+from thermo.common.rollup import rebuild_rollups, update_rollups
+
+JOURNAL_PATH = getattr(local_settings, 'JOURNAL_PATH', '/home/pi/thermo_journal.log')
+
+# Columns that identify a row independently of its auto-increment id. Replayed rows that already exist in the remote
+# database with the same key are skipped, so a replay that is interrupted and repeated never duplicates rows.
+NATURAL_KEYS = {
+    'temperature': ('sensor', 'record_time'),
+    'action_log': ('action', 'record_time'),
+    'message': ('user', 'type', 'record_time'),
+}
+
+
+def insert_rows(table, rows, local=False):
+    """
+    Insert <rows> into <table> with a single executemany.
+    :param table: sqlalchemy Table
+    :param rows: list of dicts, all with the same keys
+    :param local: Use the local SQLite database if true
+    :return:
+    """
+    engine = get_engine(local=local)
+    with engine.begin() as connection:
+        connection.execute(table.insert(), rows)
+
+
+def insert_accepted_rows(table, rows, local=False, insert=insert_rows):
+    """
+    Insert <rows>, splitting them in halves whenever the database rejects a statement, so that a row the database will
+    never accept (e.g. a duplicate key) costs only itself rather than the rows batched with it. Rejected rows are logged
+    and dropped; connection errors are raised, since retrying smaller batches cannot help.
+    :param table: sqlalchemy Table
+    :param rows: list of dicts, all with the same keys
+    :param local: Use the local SQLite database if true
+    :param insert: function(table, rows, local) that inserts the rows in one transaction
+    :return: the rows that were not rejected
+    """
+    try:
+        insert(table, rows, local=local)
+        return rows
+    except Exception as e:
+        if is_connection_error(e):
+            raise
+        if len(rows) == 1:
+            logging.error('The {0} database rejected a row of {1}, dropping it: {2}'.format(
+                'local' if local else 'remote', table.name, rows[0]))
+            logging.exception(e)
+            metrics.increment('rejected_rows_total', table=table.name, database='local' if local else 'remote')
+            return []
+
+    half = len(rows) // 2
+    return (insert_accepted_rows(table, rows[:half], local=local, insert=insert) +
+            insert_accepted_rows(table, rows[half:], local=local, insert=insert))
+
+
+def insert_rows_idempotent(table, rows, local=False):
+    """
+    Insert the rows of <rows> whose natural key is not already present in <table>.
+    :param table: sqlalchemy Table listed in NATURAL_KEYS
+    :param rows: list of dicts, all with the same keys
+    :param local: Use the local SQLite database if true
+    :return: number of rows inserted
+    """
+    key_columns = NATURAL_KEYS[table.name]
+
+    # MySQL DATETIME columns do not keep fractional seconds, so keys are compared to the second
+    rows = [dict(row, record_time=row['record_time'].replace(microsecond=0)) for row in rows]
+    start = min([row['record_time'] for row in rows])
+    end = max([row['record_time'] for row in rows])
+
+    engine = get_engine(local=local)
+    with engine.begin() as connection:
+        existing = connection.execute(
+            select([table.c[k] for k in key_columns]).where(
+                and_(table.c.record_time >= start, table.c.record_time <= end)
+            )
+        )
+        seen = set()
+        for key in existing:
+            key = tuple(key)
+            seen.add(key[:-1] + (key[-1].replace(microsecond=0),))
+
+        new_rows = []
+        for row in rows:
+            key = tuple([row[k] for k in key_columns])
+            if key not in seen:
+                seen.add(key)
+                new_rows.append(row)
+
+        if len(new_rows) > 0:
+            connection.execute(table.insert().prefix_with('IGNORE', dialect='mysql'), new_rows)
+
+    return len(new_rows)
+
+
+class Journal(object):
+    def __init__(self, path=JOURNAL_PATH):
+        """
+        Append-only journal of rows that could not be written to the remote database. Each line is a JSON object with
+        the table name and the row. Replay reads the journal in order from the last checkpoint, which is stored next to
+        it in <path>.offset, and the journal is truncated once it has been replayed completely. The journal is shared by
+        every process on the unit through two lock files: <path>.lock is held briefly to append or truncate, and
+        <path>.replay.lock for the whole of a replay, so that appending never waits on a replay's database writes.
+
+        :param path: location of the journal file
+        """
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.lock_path = path + '.lock'
+        self.replay_lock_path = path + '.replay.lock'
+        self.thread_lock = threading.RLock()
+        self.replay_thread_lock = threading.RLock()
+
+    @staticmethod
+    @contextmanager
+    def _file_lock(thread_lock, path):
+        with thread_lock:
+            with open(path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _locked(self):
+        return self._file_lock(self.thread_lock, self.lock_path)
+
+    def _replaying(self):
+        return self._file_lock(self.replay_thread_lock, self.replay_lock_path)
+
+    def append(self, table, rows):
+        lines = []
+        for row in rows:
+            encoded = {k: v.isoformat() if isinstance(v, datetime) else v for k, v in row.items()}
+            lines.append(json.dumps({'table': table.name, 'row': encoded}) + '\n')
+
+        with self._locked():
+            with open(self.path, 'a') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path, 'r') as f:
+                return int(f.read().strip() or 0)
+        except IOError:
+            return 0
+
+    def _write_offset(self, offset):
+        tmp = self.offset_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.offset_path)
+
+    def pending(self):
+        try:
+            return os.path.getsize(self.path) > self._read_offset()
+        except OSError:
+            return False
+
+    def _decode(self, table, row):
+        for column in table.columns:
+            if isinstance(column.type, DateTime) and row.get(column.name) is not None:
+                try:
+                    row[column.name] = datetime.strptime(row[column.name], '%Y-%m-%dT%H:%M:%S.%f')
+                except ValueError:
+                    row[column.name] = datetime.strptime(row[column.name], '%Y-%m-%dT%H:%M:%S')
+        return row
+
+    def replay(self, chunk_size=500):
+        """
+        Write the journaled rows to the remote database in order, in chunks of up to <chunk_size> consecutive rows of
+        the same table. Rows the database rejects are dropped. Stops at the first chunk that cannot be written; the next
+        replay resumes from there. Some of the temperatures may already have reached the rollups, so once the replay
+        stops, the rollups of the days the replayed temperatures span are rebuilt, once.
+        :param chunk_size:
+        :return: number of rows replayed, including rows that were already in the remote database
+        """
+        with self._replaying():
+            if not self.pending():
+                return 0
+
+            span = []  # earliest and latest record_time of the replayed temperatures
+            try:
+                inserted, offset = self._replay(chunk_size, span)
+            finally:
+                self._rebuild_rollups(span)
+
+            if offset is None:
+                return inserted
+
+            # rows may have been appended since the end of the journal was read
+            with self._locked():
+                if offset == os.path.getsize(self.path):
+                    open(self.path, 'w').close()
+                    self._write_offset(0)
+
+        if inserted > 0:
+            logging.info('Replayed {0} journaled rows to the remote database.'.format(inserted))
+
+        return inserted
+
+    def _replay(self, chunk_size, span):
+        """
+        :param chunk_size:
+        :param span: widened to the earliest and latest record_time of the replayed temperatures
+        :return: (number of rows replayed, offset of the end of the journal or None if the replay stopped early)
+        """
+        inserted = 0
+        offset = self._read_offset()
+        with open(self.path, 'r') as f:
+            f.seek(offset)
+
+            table, rows = None, []
+            while True:
+                line = f.readline()
+                entry = None
+                if line.endswith('\n'):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logging.warning('Skipping unreadable journal entry: {0}'.format(line.strip()))
+                        offset = f.tell()
+                        continue
+
+                if len(rows) > 0 and (entry is None or entry['table'] != table.name or len(rows) >= chunk_size):
+                    try:
+                        accepted = call_remote(insert_accepted_rows, table, rows, insert=insert_rows_idempotent)
+                        inserted += len(accepted)
+                    except Exception as e:
+                        if not isinstance(e, CircuitOpenError):
+                            logging.error('Failed to replay the journal to the remote database.')
+                            logging.exception(e)
+                        return inserted, None
+
+                    if table.name == Temperature.__tablename__:
+                        times = [row['record_time'] for row in rows] + span
+                        span[:] = [min(times), max(times)]
+
+                    self._write_offset(offset)
+                    rows = []
+
+                if entry is None:
+                    # end of the journal, or a partially written last line
+                    break
+
+                table = Base.metadata.tables[entry['table']]
+                rows.append(self._decode(table, entry['row']))
+                offset = f.tell()
+
+        return inserted, offset
+
+    @staticmethod
+    def _rebuild_rollups(span):
+        if len(span) == 0:
+            return
+
+        try:
+            call_remote(rebuild_rollups, span[0], span[1])
+        except Exception as e:
+            logging.error('Failed to rebuild the rollups from {0} to {1} after replaying the journal.'.format(*span))
+            logging.exception(e)
+
+journal = Journal()
+
+
+def write_rows(table, rows):
+    """
+    Insert <rows> into the remote database and the local SQLite database. Rows that cannot be written to the remote
+    database are journaled, and replayed once it is reachable again. While older rows are waiting in the journal, new
+    rows are journaled behind them so that the remote database receives everything in order. The journal is replayed
+    by thermo.control.master's persist task, never by the caller, so that a sensor batch, a relay decision or a web
+    request is not held up by a long replay.
+    :param table: sqlalchemy Table
+    :param rows: list of dicts, all with the same keys
+    :return: True if the rows reached the remote database
+    """
+    remote = False
+    start = time.time()
+    if journal.pending():
+        journal.append(table, rows)
+        metrics.increment('journaled_rows_total', len(rows), table=table.name)
+    else:
+        try:
+            accepted = call_remote(insert_accepted_rows, table, rows)
+            remote = True
+            if table.name == Temperature.__tablename__ and len(accepted) > 0:
+                # if this fails the rows are journaled too; replaying them skips the raw rows and rebuilds the rollups
+                call_remote(update_rollups, accepted)
+        except Exception as e:
+            if isinstance(e, CircuitOpenError):
+                logging.debug(str(e))
+            else:
+                logging.error('Error during insert of {0} rows into {1}, journaling them.'.format(len(rows), table.name))
+                logging.exception(e)
+            journal.append(table, rows)
+            metrics.increment('journaled_rows_total', len(rows), table=table.name)
+    metrics.observe('database_write_seconds', time.time() - start, table=table.name, database='remote')
+
+    start = time.time()
+    try:
+        insert_accepted_rows(table, rows, local=True)
+    except Exception as e:
+        logging.info('Failed using local database.')
+        logging.exception(e)
+        metrics.increment('database_local_failures_total', function='write_rows')
+        raise (e)
+    finally:
+        metrics.observe('database_write_seconds', time.time() - start, table=table.name, database='local')
+
+    return remote
+
+
+if __name__ == '__main__':
+    logging.basicConfig(**local_settings.LOGGING)
+    print('Replayed {0} rows.'.format(journal.replay()))
@@ -0,0 +1,273 @@
+import json
+import logging
+import logging.handlers
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from thermo import local_settings
+
+# The metrics endpoint listens on host:port; every summary_interval seconds the counters and timings are appended to
+# summary_path, which is rotated after summary_bytes, keeping summary_backups old files
+SETTINGS = {
+    'host': '127.0.0.1',
+    'port': 9105,
+    'summary_path': '/home/pi/thermo_metrics.log',
+    'summary_interval': 300,
+    'summary_bytes': 1024 * 1024,
+    'summary_backups': 5,
+}
+SETTINGS.update(getattr(local_settings, 'METRICS', {}))
+
+PREFIX = 'thermo_'
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join('{0}="{1}"'.format(k, v) for k, v in escaped) + '}'
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+class Metrics(object):
+    def __init__(self):
+        """
+        In-process counters and timings of the control loop's hot path. Recording one is a dictionary update under a
+        lock, cheap enough to leave on in production.
+
+        Timings are kept per name and labels as a count, a sum and a maximum of seconds. Collectors add samples that
+        are read when the metrics are rendered, e.g. the state of a circuit breaker.
+        """
+        self.counters = {}  # (name, labels): value
+        self.timings = {}  # (name, labels): [count, sum, max]
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        """
+        :param name: counter name, ending in _total
+        :param value: amount to add
+        :param labels: label values
+        """
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+        :param name: timing name, ending in _seconds
+        :param seconds: duration of one call
+        :param labels: label values
+        """
+        key = (name, _labels(labels))
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                self.timings[key] = [1, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                if seconds > timing[2]:
+                    timing[2] = seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def timed(self, name, **labels):
+        """
+        Decorator recording the duration of every call of the function
+        """
+
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(name, time.time() - start, **labels)
+
+            return wrapper
+
+        return decorator
+
+    def add_collector(self, collector):
+        """
+        :param collector: function returning a list of (name, type, labels, value) samples, type being 'counter' or
+            'gauge'
+        """
+        self.collectors.append(collector)
+
+    def collect(self):
+        """
+        :return: list of (name, type, labels tuple, value) samples of the counters, timings and collectors; a timing is
+            a 'summary' sample whose value is (count, sum)
+        """
+        with self.lock:
+            samples = [(name, 'counter', labels, value) for (name, labels), value in self.counters.items()]
+            for (name, labels), (count, total, longest) in self.timings.items():
+                samples.append((name, 'summary', labels, (count, total)))
+                samples.append((name + '_max', 'gauge', labels, longest))
+
+        for collector in list(self.collectors):
+            try:
+                for name, kind, labels, value in collector():
+                    samples.append((name, kind, _labels(labels), value))
+            except Exception as e:
+                logging.error('Metrics collector failed.')
+                logging.exception(e)
+
+        return samples
+
+    def render(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        families = {}
+        for name, kind, labels, value in self.collect():
+            families.setdefault((name, kind), []).append((labels, value))
+
+        lines = []
+        for (name, kind), samples in sorted(families.items()):
+            lines.append('# TYPE {0}{1} {2}'.format(PREFIX, name, kind))
+            for labels, value in sorted(samples):
+                if kind == 'summary':
+                    for suffix, v in zip(('_count', '_sum'), value):
+                        lines.append('{0}{1}{2}{3} {4}'.format(PREFIX, name, suffix, _format_labels(labels),
+                                                               _format_value(v)))
+                else:
+                    lines.append('{0}{1}{2} {3}'.format(PREFIX, name, _format_labels(labels), _format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        :return: {name{labels}: value} of every sample, with the mean of each timing
+        """
+        summary = {}
+        for name, kind, labels, value in self.collect():
+            if kind == 'summary':
+                count, total = value
+                summary[name + '_count' + _format_labels(labels)] = count
+                summary[name + '_mean' + _format_labels(labels)] = total / count
+            else:
+                summary[name + _format_labels(labels)] = value
+
+        return summary
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timings.clear()
+
+
+metrics = Metrics()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('Metrics request: ' + format % args)
+
+
+class MetricsServer(object):
+    def __init__(self, host=SETTINGS['host'], port=SETTINGS['port']):
+        """
+        Serve the metrics at http://<host>:<port>/metrics, for Prometheus or curl, on a background thread
+        """
+        self.host = host
+        self.port = port
+        self.server = None
+        self._thread = None
+
+    def start(self):
+        self.server = HTTPServer((self.host, self.port), _Handler)
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class SummaryWriter(object):
+    def __init__(self, path=SETTINGS['summary_path'], max_bytes=SETTINGS['summary_bytes'],
+                 backups=SETTINGS['summary_backups']):
+        """
+        Append a JSON line with every metric to <path> each time write() is called, rotating the file after
+        <max_bytes>, so that the history of a unit's timings survives restarts without filling its SD card.
+        """
+        self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def write(self):
+        record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'metrics': metrics.summary()}
+        self.handler.emit(logging.makeLogRecord({'msg': json.dumps(record, sort_keys=True), 'levelno': logging.INFO,
+                                                 'levelname': 'INFO'}))
+
+    def close(self):
+        self.handler.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Print the latest metrics summaries of this unit.')
+    parser.add_argument('--path', default=SETTINGS['summary_path'])
+    parser.add_argument('-n', type=int, default=1, help='number of summaries')
+    parser.add_argument('--match', default='', help='only show metrics whose name contains this')
+    args = parser.parse_args()
+
+    with open(args.path, 'r') as f:
+        lines = f.readlines()[-args.n:]
+
+    for line in lines:
+        record = json.loads(line)
+        print(record['time'])
+        for name, value in sorted(record['metrics'].items()):
+            if args.match in name:
+                print('    {0} {1}'.format(name, value))
@@ -1,31 +1,119 @@
 import logging
-from datetime import datetime, timedelta
+import socket
+import threading
+import time
 
-from sqlalchemy import create_engine, Column, Float, DateTime, Integer, String, ForeignKey, Boolean, BLOB
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy import create_engine, Column, Float, DateTime, Integer, String, ForeignKey, Boolean, BLOB, Index
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
+from sqlalchemy.orm import deferred, relationship, sessionmaker, scoped_session
 
+from thermo import local_settings
+from thermo.common.metrics import metrics
 from thermo.local_settings import DATABASE, LOCAL_DATABASE_PATH, USER_NUMBER
 
-
-def get_engine(local=False):
+# Connection pool settings for the remote database. Any of these can be overridden with a DATABASE_POOL dictionary
+# in local_settings.py. The connect timeout is kept short so that a dead Wi-Fi link fails fast instead of holding up
+# the control loop.
+POOL_SETTINGS = {
+    'pool_size': 5,
+    'max_overflow': 5,
+    'pool_recycle': 1800,
+    'pool_pre_ping': True,
+    'pool_timeout': 10,
+    'connect_timeout': 5,
+}
+POOL_SETTINGS.update(getattr(local_settings, 'DATABASE_POOL', {}))
+
+# Seconds to wait on a locked SQLite database before giving up
+LOCAL_DATABASE_TIMEOUT = getattr(local_settings, 'LOCAL_DATABASE_TIMEOUT', 15)
+
+# local: (engine, session factory, scoped session registry), published together so that a caller reading them
+# without the lock never sees an engine without its sessions
+_registries = {}
+_registry_lock = threading.Lock()
+
+
+def _create_engine(local=False):
     if local == True:
         connection_string = 'sqlite:///' + LOCAL_DATABASE_PATH
-
-    else:
-        connection_string = '{0}://{1}:{2}@{3}:{4}/{5}'.format(
-            DATABASE.TYPE, DATABASE.USERNAME, DATABASE.PASSWORD, DATABASE.HOST, DATABASE.PORT, DATABASE.NAME
+        return create_engine(
+            connection_string,
+            echo=False,
+            connect_args={'timeout': LOCAL_DATABASE_TIMEOUT, 'check_same_thread': False}
         )
 
-    engine = create_engine(connection_string, echo=False)
-    return engine
+    connection_string = '{0}://{1}:{2}@{3}:{4}/{5}'.format(
+        DATABASE.TYPE, DATABASE.USERNAME, DATABASE.PASSWORD, DATABASE.HOST, DATABASE.PORT, DATABASE.NAME
+    )
+
+    pool_settings = dict(POOL_SETTINGS)
+    connect_timeout = pool_settings.pop('connect_timeout')
+    return create_engine(connection_string, echo=False, connect_args={'connect_timeout': connect_timeout},
+                         **pool_settings)
+
+
+def _get_registry(local=False):
+    local = bool(local)
+    try:
+        return _registries[local]
+    except KeyError:
+        pass
+
+    with _registry_lock:
+        if local not in _registries:
+            engine = _create_engine(local=local)
+            factory = sessionmaker(bind=engine)
+            _registries[local] = (engine, factory, scoped_session(factory))
+
+        return _registries[local]
+
+
+def get_engine(local=False):
+    """
+    Return the process-wide engine for the remote database, or the local SQLite database if local is True.
+    Engines (and their connection pools) are created on first use and shared by every caller afterwards.
+    :param local: Use the local SQLite database if true
+    :return: sqlalchemy.engine.Engine
+    """
+    return _get_registry(local=local)[0]
 
 
 def get_session(local=False):
-    engine = get_engine(local=local)
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    return session
+    """
+    Create a new session bound to the shared engine. Sessions are cheap; the pooled connection behind them is reused.
+    :param local: Use the local SQLite database if true
+    :return: sqlalchemy.orm.Session
+    """
+    return _get_registry(local=local)[1]()
+
+
+def get_scoped_session(local=False):
+    """
+    Return the thread-local session registry for the requested database. Long-running threads (the web UI, background
+    workers) should use this and call remove_scoped_sessions() when they are done with a unit of work.
+    :param local: Use the local SQLite database if true
+    :return: sqlalchemy.orm.scoped_session
+    """
+    return _get_registry(local=local)[2]
+
+
+def remove_scoped_sessions():
+    for engine, factory, registry in list(_registries.values()):
+        registry.remove()
+
+
+def dispose_engines():
+    """
+    Close every pooled connection and forget the cached engines, e.g. after forking or when the database settings
+    have changed.
+    :return:
+    """
+    with _registry_lock:
+        remove_scoped_sessions()
+        for engine, factory, registry in _registries.values():
+            engine.dispose()
+        _registries.clear()
 
 
 def copy_data_to_local(user):
@@ -55,6 +143,181 @@ def copy_data_to_local(user):
     return
 
 
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold=3, backoff=15., max_backoff=300.):
+        """
+        Track the health of a backend. After <failure_threshold> consecutive connection failures the breaker opens and
+        calls are refused for <backoff> seconds. It then lets a single probe call through (half-open); a successful
+        probe closes the breaker, a failed one re-opens it with the backoff doubled, up to <max_backoff> seconds.
+
+        :param name: name used in log messages
+        :param failure_threshold: consecutive failures that open the breaker
+        :param backoff: seconds the breaker initially stays open
+        :param max_backoff: upper limit for the backoff
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.current_backoff = backoff
+        self.opened_at = None
+        self.probe_in_flight = False
+
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.last_success = None
+        self.last_failure = None
+        self.last_latency = None
+        self.total_latency = 0.
+
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        :return: True if a call should be attempted against the backend
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN and time.time() >= self.opened_at + self.current_backoff:
+                logging.info('Circuit breaker for the {0} database is half-open, probing.'.format(self.name))
+                self.state = self.HALF_OPEN
+                self.probe_in_flight = False
+
+            if self.state == self.HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+
+            self.rejected += 1
+            return False
+
+    def record_success(self, latency):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logging.info('Circuit breaker for the {0} database closed.'.format(self.name))
+
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.current_backoff = self.backoff
+            self.opened_at = None
+            self.probe_in_flight = False
+
+            self.successes += 1
+            self.last_success = time.time()
+            self.last_latency = latency
+            self.total_latency += latency
+
+    def record_failure(self, latency):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.failures += 1
+            self.last_failure = time.time()
+            self.last_latency = latency
+            self.total_latency += latency
+
+            if self.state == self.HALF_OPEN:
+                self.current_backoff = min(self.current_backoff * 2, self.max_backoff)
+                self._open()
+            elif self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold:
+                self.current_backoff = self.backoff
+                self._open()
+
+    def _open(self):
+        logging.warning('Circuit breaker for the {0} database opened for {1:.0f} seconds.'.format(
+            self.name, self.current_backoff))
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        self.probe_in_flight = False
+
+    def status(self):
+        """
+        :return: dictionary describing the state of the breaker and the backend's call timings
+        """
+        with self.lock:
+            calls = self.successes + self.failures
+            return {
+                'name': self.name,
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'successes': self.successes,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'backoff': self.current_backoff,
+                'retry_at': self.opened_at + self.current_backoff if self.opened_at is not None else None,
+                'last_success': self.last_success,
+                'last_failure': self.last_failure,
+                'last_latency': self.last_latency,
+                'mean_latency': self.total_latency / calls if calls > 0 else None,
+            }
+
+
+remote_breaker = CircuitBreaker('remote', **getattr(local_settings, 'CIRCUIT_BREAKER', {}))
+
+
+def _breaker_metrics():
+    status = remote_breaker.status()
+    labels = {'database': status['name']}
+    return [
+        ('database_circuit_open', 'gauge', labels, status['state'] != CircuitBreaker.CLOSED),
+        ('database_calls_total', 'counter', dict(labels, outcome='success'), status['successes']),
+        ('database_calls_total', 'counter', dict(labels, outcome='failure'), status['failures']),
+        ('database_calls_total', 'counter', dict(labels, outcome='rejected'), status['rejected']),
+    ]
+
+
+metrics.add_collector(_breaker_metrics)
+
+
+def is_connection_error(e):
+    """
+    :param e: exception raised by a database call
+    :return: True if the database could not be reached or the connection was lost, False if the database answered and
+        rejected the statement (e.g. a duplicate key), which says nothing about its availability
+    """
+    if isinstance(e, (OperationalError, InterfaceError)):
+        return True
+    if isinstance(e, DBAPIError):
+        return e.connection_invalidated
+    return isinstance(e, socket.error)
+
+
+def call_remote(function, *args, **kwargs):
+    """
+    Call function(*args, local=False, **kwargs) through the remote database's circuit breaker.
+    Raises CircuitOpenError without calling the function while the breaker is open.
+    """
+    if not remote_breaker.allow():
+        raise CircuitOpenError('The remote database is unavailable; retrying after {0:.0f} seconds.'.format(
+            remote_breaker.current_backoff))
+
+    start = time.time()
+    try:
+        results = function(*args, local=False, **kwargs)
+    except Exception as e:
+        if is_connection_error(e):
+            remote_breaker.record_failure(time.time() - start)
+        else:
+            # the database answered; the error is the function's own
+            remote_breaker.record_success(time.time() - start)
+        raise
+
+    remote_breaker.record_success(time.time() - start)
+    return results
+
+
 def duplicate_locally(function):
     """
     Call the function with the local SQLite database in addition to the remote database
@@ -62,19 +325,32 @@ def duplicate_locally(function):
     :return:
     """
 
+    name = getattr(function, '__qualname__', function.__name__)
+
     def wrapper(*args, **kwargs):
+        start = time.time()
         try:
-            function(*args, local=False, **kwargs)
+            call_remote(function, *args, **kwargs)
+            metrics.observe('database_call_seconds', time.time() - start, function=name, database='remote')
+        except CircuitOpenError as e:
+            logging.debug(str(e))
+            metrics.increment('database_remote_skipped_total', function=name)
         except Exception as e:
+            metrics.observe('database_call_seconds', time.time() - start, function=name, database='remote')
             logging.error('Failed using remote database.')
             logging.exception(e)
+            metrics.increment('database_remote_failures_total', function=name)
 
+        start = time.time()
         try:
             function(*args, local=True, **kwargs)
         except Exception as e:
             logging.info('Failed using local database.')
             logging.exception(e)
+            metrics.increment('database_local_failures_total', function=name)
             raise (e)
+        finally:
+            metrics.observe('database_call_seconds', time.time() - start, function=name, database='local')
 
         return
 
@@ -83,24 +359,39 @@ def duplicate_locally(function):
 
 def fallback_locally(function):
     """
-    Call the function with the local SQLite database if the remote database connection fails
+    Call the function with the local SQLite database if the remote database connection fails, or straight away while
+    the remote database's circuit breaker is open
     :param function:
     :return:
     """
 
+    name = getattr(function, '__qualname__', function.__name__)
+
     def wrapper(*args, **kwargs):
+        start = time.time()
         try:
-            results = function(*args, local=False, **kwargs)
+            results = call_remote(function, *args, **kwargs)
+            metrics.observe('database_call_seconds', time.time() - start, function=name, database='remote')
         except Exception as e:
-            logging.error('Failed using remote database.')
-            logging.exception(e)
+            if isinstance(e, CircuitOpenError):
+                logging.debug(str(e))
+                metrics.increment('database_fallbacks_total', function=name, reason='circuit_open')
+            else:
+                metrics.observe('database_call_seconds', time.time() - start, function=name, database='remote')
+                logging.error('Failed using remote database.')
+                logging.exception(e)
+                metrics.increment('database_fallbacks_total', function=name, reason='error')
 
+            start = time.time()
             try:
                 results = function(*args, local=True, **kwargs)
             except Exception as e:
                 logging.error('Failed using local database.')
                 logging.exception(e)
+                metrics.increment('database_local_failures_total', function=name)
                 raise (e)
+            finally:
+                metrics.observe('database_call_seconds', time.time() - start, function=name, database='local')
 
         return results
 
@@ -205,6 +496,8 @@ class Action(Base):
     expected_overshoot_above = Column(Float, nullable=False, default=0.)
     expected_overshoot_below = Column(Float, nullable=False, default=0.)
     enabled = Column(Boolean, default=True)
+    # state of thermo.control.lag.LagLearner; deferred so that databases created without the column can still be read
+    lag_state = deferred(Column(String(250), nullable=True))
 
     def __repr__(self):
         return "{0}: {1} {2} {3}".format(self.id, self.name, self.unit, self.zone)
@@ -225,6 +518,9 @@ class Unit(Base):
 
 class Message(Base):
     __tablename__ = 'message'
+    __table_args__ = (
+        Index('ix_message_user_type_received', 'user', 'type', 'received'),
+    )
     id = Column(Integer, autoincrement=True, primary_key=True, index=True)
     record_time = Column(DateTime)
     user = Column(Integer, ForeignKey('user.id'), index=True)
@@ -234,12 +530,71 @@ class Message(Base):
     unit = Column(Integer, ForeignKey('unit.id'), index=True, nullable=True)
 
 
-def clean_old_temps_from_local():
-    session = get_session(local=True)
-    session.query(Temperature).filter(Temperature.record_time < datetime.now() - timedelta(hours=2)).delete()
-    session.commit()
+class TemperatureRollup(object):
+    """
+    Minimum, maximum, sum and number of a sensor's readings per time bucket, maintained by thermo.common.rollup
+    """
+    resolution = None  # bucket width in seconds
+
+    @declared_attr
+    def sensor(cls):
+        return Column(Integer, ForeignKey('sensor.id'), primary_key=True)
+
+    bucket = Column(DateTime, primary_key=True, index=True)
+    minimum = Column(Float, nullable=False)
+    maximum = Column(Float, nullable=False)
+    total = Column(Float, nullable=False)
+    samples = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return "<{0}(sensor={1}, bucket={2}, mean={3:.2f})>".format(
+            type(self).__name__, self.sensor, self.bucket.strftime('%Y-%m-%d %H:%M:%S'), self.total / self.samples
+        )
+
+
+class TemperatureMinute(TemperatureRollup, Base):
+    __tablename__ = 'temperature_minute'
+    resolution = 60
+
+
+class TemperatureHour(TemperatureRollup, Base):
+    __tablename__ = 'temperature_hour'
+    resolution = 60 * 60
+
+
+class TemperatureDay(TemperatureRollup, Base):
+    __tablename__ = 'temperature_day'
+    resolution = 24 * 60 * 60
+
+
+# finest to coarsest
+ROLLUPS = [TemperatureMinute, TemperatureHour, TemperatureDay]
+
+
+@fallback_locally
+def _query_api_key(user, local=False):
+    session = get_session(local=local)
+    results = session.query(User.api_key).filter(User.id == user).all()[0]
     session.close()
 
+    return results.api_key
+
+
+_api_key = {'key': None, 'expires': 0}
+
+
+def get_api_key(ttl=300):
+    """
+    The user's API key, cached for <ttl> seconds. It authenticates requests to the web UI and the messages between the
+    web UI and the master control process.
+    :param ttl:
+    :return:
+    """
+    if _api_key['key'] is None or time.time() >= _api_key['expires']:
+        _api_key['key'], _api_key['expires'] = _query_api_key(USER_NUMBER), time.time() + ttl
+
+    return _api_key['key']
+
 
 if __name__ == '__main__':
     engine = get_engine()
@@ -0,0 +1,161 @@
+import errno
+import grp
+import hmac
+import json
+import logging
+import os
+import socket
+import threading
+
+from thermo import local_settings
+
+# The sockets live in a directory that only the owner and SOCKET_GROUP may use. The listener creates it if needed,
+# which the master control process (running as root) does at start up.
+SOCKET_DIR = getattr(local_settings, 'SOCKET_DIR', '/run/thermo')
+# Group of the web UI's user, e.g. 'www-data'. When it is not set, the sockets keep the group of the process that binds
+# them, which only works if the web UI and the master control process run as the same user.
+SOCKET_GROUP = getattr(local_settings, 'SOCKET_GROUP', None)
+# The master control process listens on this socket for messages from the web UI
+CONTROL_SOCKET = getattr(local_settings, 'CONTROL_SOCKET', os.path.join(SOCKET_DIR, 'control.sock'))
+# ... and the web UI listens on this one for live events from the master control process
+EVENT_SOCKET = getattr(local_settings, 'EVENT_SOCKET', os.path.join(SOCKET_DIR, 'events.sock'))
+
+
+def _set_group(path):
+    if SOCKET_GROUP is not None:
+        os.chown(path, -1, grp.getgrnam(SOCKET_GROUP).gr_gid)
+
+
+def check_access(directory=SOCKET_DIR):
+    """
+    Log an error if this process cannot use the sockets' directory, which is usually because it runs as a different
+    user than the process that created the directory and SOCKET_GROUP is not set to a group it is in
+    :param directory:
+    :return: False if the directory exists and this process cannot use it
+    """
+    if os.path.isdir(directory) and not os.access(directory, os.W_OK | os.X_OK):
+        logging.error('This process (uid {0}) cannot use {1}, so the web UI and the master control process cannot '
+                      'notify each other. Set SOCKET_GROUP to a group of both users.'.format(os.getuid(), directory))
+        return False
+    return True
+
+
+def _encode(value):
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def send(path, message, key):
+    """
+    Send <message> as a JSON datagram to the Unix socket at <path>. Delivery is best effort; nothing is raised if no
+    process is listening.
+    :param path: path of the listener's socket
+    :param message: JSON serializable dict
+    :param key: the user's API key, which the listener checks before accepting the message
+    :return: True if the message was delivered
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(False)  # drop the message rather than wait on a listener that is not keeping up
+    try:
+        sock.sendto(json.dumps(dict(message, key=key)).encode('utf-8'), path)
+        return True
+    except socket.error as e:
+        if e.errno in (errno.EACCES, errno.EPERM):
+            logging.error('Not allowed to send to {0}; check SOCKET_GROUP.'.format(path))
+        else:
+            logging.debug('No listener at {0}: {1}'.format(path, e))
+        return False
+    finally:
+        sock.close()
+
+
+class Listener(object):
+    def __init__(self, path, callback, key):
+        """
+        Receive JSON datagrams on a Unix socket and pass each decoded message to <callback> on a background thread.
+        Messages that do not carry the API key are dropped.
+
+        :param path: path of the socket to bind
+        :param callback: function called with each message
+        :param key: function returning the API key that messages must carry
+        """
+        self.path = path
+        self.callback = callback
+        self.key = key
+        self.sock = None
+        self._thread = None
+
+    def start(self):
+        """
+        Bind the socket and start receiving. Only one process can listen on a socket, so the web UI must run as a single
+        process; a second one fails here rather than take the events away from the first.
+        """
+        if os.path.exists(self.path):
+            if self.in_use():
+                raise socket.error(errno.EADDRINUSE, 'Another process is listening on {0}.'.format(self.path))
+            os.unlink(self.path)  # left behind by a previous process
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            if SOCKET_GROUP is None and os.getuid() == 0:
+                logging.warning('SOCKET_GROUP is not set, so only processes in group {0} can reach {1}.'.format(
+                    grp.getgrgid(os.getgid()).gr_name, directory))
+            os.makedirs(directory)
+            os.chmod(directory, 0o2770)  # setgid, so that the other process's socket gets the same group
+            _set_group(directory)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o660)  # the web UI may run as a different user in SOCKET_GROUP
+        _set_group(self.path)
+
+        self._thread = threading.Thread(target=self._run, name='notify-' + os.path.basename(self.path))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def in_use(self):
+        """
+        :return: True if a process is listening on the socket at <path>, False if the socket is stale
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.connect(self.path)
+            return True
+        except socket.error as e:
+            return e.errno not in (errno.ECONNREFUSED, errno.ENOENT)
+        finally:
+            sock.close()
+
+    def stop(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _run(self):
+        while self.sock is not None:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error:
+                break  # the socket was closed by stop()
+
+            try:
+                message = json.loads(data.decode('utf-8'))
+                if not self.authenticate(message):
+                    logging.warning('Dropped a message without a valid key on {0}.'.format(self.path))
+                    continue
+                self.callback(message)
+            except Exception as e:
+                logging.error('Failed to handle notification on {0}.'.format(self.path))
+                logging.exception(e)
+
+    def authenticate(self, message):
+        """
+        :param message: decoded message, from which the key is removed
+        :return: True if <message> carries the API key
+        """
+        key = message.pop('key', None)
+        expected = self.key()
+        if key is None or expected is None:
+            return False
+        return hmac.compare_digest(_encode(key), _encode(expected))
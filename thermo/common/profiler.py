@@ -0,0 +1,183 @@
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+from thermo import local_settings
+
+PROFILE_PATH = getattr(local_settings, 'PROFILE_PATH', '/home/pi/thermo_profile')
+
+# Innermost frames of a thread that is blocked waiting rather than working: (module, function). A sample ending in
+# one of these is dropped unless the profiler is asked to keep idle samples.
+IDLE_FRAMES = set([
+    ('threading', 'wait'),
+    ('threading', '_wait_for_tstate_lock'),
+    ('threading', 'join'),
+    ('selectors', 'select'),
+    ('SocketServer', '_eintr_retry'),
+    ('thermo.common.notify', '_run'),
+])
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return '{0}:{1}'.format(frame.f_globals.get('__name__', '?'), getattr(code, 'co_qualname', code.co_name))
+
+
+class SamplingProfiler(object):
+    def __init__(self, interval=0.01, idle=False):
+        """
+        Statistical profiler of every thread of the process. A background thread wakes every <interval> seconds and
+        records the Python stack of each other thread, so the cost does not depend on how many calls the profiled code
+        makes, and the threads of the scheduler's tasks, the zones and the sensor reads are all seen (cProfile only
+        follows the thread that enabled it).
+
+        The samples are written as collapsed stacks, the input of flamegraph.pl and speedscope, and as a table of the
+        time spent in (self) and under (total) each function.
+
+        :param interval: seconds between samples
+        :param idle: keep the samples of threads blocked waiting on a lock, event, queue or socket
+        """
+        self.interval = interval
+        self.idle = idle
+
+        self.stacks = {}  # 'thread;outer;...;inner': samples
+        self.samples = 0
+        self.ticks = 0
+        self.tick_limit = None
+        self.started = None
+        self.elapsed = 0.
+
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, ticks=None):
+        """
+        Discard earlier samples and start sampling
+        :param ticks: stop after tick() has been called this many times
+        """
+        if self.running:
+            return
+
+        with self.lock:
+            self.stacks, self.samples, self.ticks, self.elapsed = {}, 0, 0, 0.
+        self.tick_limit = ticks
+        self.started = time.time()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='profiler')
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info('Started profiling every {0:.0f} ms{1}.'.format(
+            self.interval * 1000, '' if ticks is None else ' for {0} ticks'.format(ticks)))
+
+    def stop(self):
+        if not self.running:
+            return
+
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        self.elapsed = time.time() - self.started
+        logging.info('Stopped profiling after {0} samples.'.format(self.samples))
+
+    def tick(self):
+        """
+        Count one run of the profiled loop
+        :return: True if this tick reached the tick limit, which stops the profiler
+        """
+        if not self.running:
+            return False
+
+        self.ticks += 1
+        if self.tick_limit is not None and self.ticks >= self.tick_limit:
+            self.stop()
+            return True
+        return False
+
+    def _run(self):
+        me = threading.current_thread().ident
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+
+            stacks = []
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+
+                labels = []
+                innermost = frame
+                while frame is not None:
+                    labels.append(frame_label(frame))
+                    frame = frame.f_back
+
+                if not self.idle and (innermost.f_globals.get('__name__'), innermost.f_code.co_name) in IDLE_FRAMES:
+                    continue
+
+                labels.append(names.get(ident, 'thread-{0}'.format(ident)).replace(';', ':').replace(' ', '_'))
+                stacks.append(';'.join(reversed(labels)))
+
+            with self.lock:
+                self.samples += 1
+                for stack in stacks:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def functions(self):
+        """
+        :return: list of (function, self samples, total samples), the most total samples first
+        """
+        with self.lock:
+            stacks = dict(self.stacks)
+
+        own, total = {}, {}
+        for stack, count in stacks.items():
+            frames = stack.split(';')[1:]  # the first label is the thread
+            if len(frames) == 0:
+                continue
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for f in set(frames):
+                total[f] = total.get(f, 0) + count
+
+        return sorted([(f, own.get(f, 0), t) for f, t in total.items()], key=lambda x: (-x[2], -x[1], x[0]))
+
+    def write(self, prefix=PROFILE_PATH):
+        """
+        Write the samples so far to <prefix>-<time>.collapsed and <prefix>-<time>.txt. The profiler keeps running if
+        it is.
+        :param prefix: path and start of the file names
+        :return: (path of the collapsed stacks, path of the summary)
+        """
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        collapsed, summary = '{0}-{1}.collapsed'.format(prefix, stamp), '{0}-{1}.txt'.format(prefix, stamp)
+        directory = os.path.dirname(prefix)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with self.lock:
+            stacks, samples, ticks = dict(self.stacks), self.samples, self.ticks
+        elapsed = time.time() - self.started if self.running else self.elapsed
+
+        with open(collapsed, 'w') as f:
+            for stack, count in sorted(stacks.items()):
+                f.write('{0} {1}\n'.format(stack, count))
+
+        # a function's share is of the sampling periods, so time spent on several threads at once can exceed 100%
+        with open(summary, 'w') as f:
+            f.write('{0} samples every {1:.0f} ms over {2:.1f} s, {3} ticks\n\n'.format(
+                samples, self.interval * 1000, elapsed, ticks))
+            f.write('{0:>8} {1:>8} {2:>8} {3:>8}  {4}\n'.format('self', 'self%', 'total', 'total%', 'function'))
+            for function, own, total in self.functions():
+                f.write('{0:>8} {1:>7.1f}% {2:>8} {3:>7.1f}%  {4}\n'.format(
+                    own, 100. * own / max(samples, 1), total, 100. * total / max(samples, 1), function))
+
+        logging.info('Wrote profile to {0} and {1}.'.format(collapsed, summary))
+        return collapsed, summary
@@ -0,0 +1,247 @@
+import logging
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select, text
+
+from thermo import local_settings
+from thermo.common.models import Temperature, TemperatureMinute, get_engine
+from thermo.common.rollup import bucket_start, rebuild_rollups
+
+SETTINGS = {
+    'raw_days': 90,  # days of raw readings kept in the remote database; older days are compacted into the rollups
+    'minute_days': 400,  # days of minute rollups kept; hour and day rollups are kept forever
+    'local_hours': 2,  # hours of raw readings kept in the local SQLite database
+    'local_interval': 300,  # seconds between prunes of the local database
+    'batch_size': 5000,  # rows per DELETE
+}
+SETTINGS.update(getattr(local_settings, 'RETENTION', {}))
+
+# Name of the catch-all partition that new monthly partitions are split from
+FUTURE_PARTITION = 'pfuture'
+
+
+def delete_before(table, column, cutoff, local=False, batch_size=5000):
+    """
+    Delete the rows of <table> with <column> before <cutoff>, oldest first, in transactions of about <batch_size> rows
+    so that neither database holds long locks.
+    :param table: sqlalchemy Table
+    :param column: indexed DateTime column of <table>
+    :param cutoff: datetime
+    :param local: Use the local SQLite database if true
+    :param batch_size: rows per DELETE
+    :return: number of rows deleted
+    """
+    engine = get_engine(local=local)
+    deleted = 0
+
+    while True:
+        with engine.begin() as connection:
+            # the time of the <batch_size>th oldest row bounds this batch, and is found from the index alone
+            bound = connection.execute(
+                select([column]).where(column < cutoff).order_by(column).offset(batch_size - 1).limit(1)
+            ).scalar()
+
+            if bound is None:
+                result = connection.execute(table.delete().where(column < cutoff))
+            else:
+                result = connection.execute(table.delete().where(column <= bound))
+            deleted += result.rowcount
+
+        if bound is None:
+            return deleted
+
+
+def compact(cutoff, local=False, batch_size=5000):
+    """
+    Rebuild the rollups of every whole day of raw readings before <cutoff>, then delete those readings. When the table
+    is partitioned, only whole months are compacted, by dropping their partitions.
+    :param cutoff: datetime; rounded down to midnight, so only complete days are compacted
+    :param local: Use the local SQLite database if true
+    :param batch_size: rows per DELETE
+    :return:
+    """
+    raw = Temperature.__table__
+    cutoff = bucket_start(cutoff, 24 * 60 * 60)
+
+    partitioned = len(get_partitions(local=local)) > 0
+    partitions = [
+        (name, bound) for name, bound in get_partitions(local=local) if name != FUTURE_PARTITION and bound <= cutoff
+    ]
+    if partitioned:
+        if len(partitions) == 0:
+            return
+        cutoff = partitions[-1][1]
+
+    oldest = get_engine(local=local).execute(select([func.min(raw.c.record_time)])).scalar()
+    if oldest is None or oldest >= cutoff:
+        return
+
+    logging.info('Compacting raw temperatures from {0} to {1}.'.format(oldest, cutoff))
+    rebuild_rollups(oldest, cutoff - timedelta(microseconds=1), local=local)
+
+    if partitioned:
+        logging.info('Dropping temperature partitions {0}.'.format(', '.join(name for name, _ in partitions)))
+        get_engine().execute(text('ALTER TABLE {0} DROP PARTITION {1}'.format(
+            Temperature.__tablename__, ', '.join(name for name, _ in partitions)
+        )))
+    else:
+        deleted = delete_before(raw, raw.c.record_time, cutoff, local=local, batch_size=batch_size)
+        logging.info('Deleted {0} compacted temperatures.'.format(deleted))
+
+
+def get_partitions(local=False):
+    """
+    :param local: Use the local SQLite database if true
+    :return: [(partition name, upper bound)] of the temperature table, oldest first, with None as the bound of the
+        catch-all partition; empty if the table is not partitioned
+    """
+    engine = get_engine(local=local)
+    if engine.dialect.name != 'mysql':
+        return []
+
+    results = engine.execute(text(
+        'SELECT partition_name, partition_description FROM information_schema.partitions '
+        'WHERE table_schema = DATABASE() AND table_name = :table AND partition_name IS NOT NULL '
+        'ORDER BY partition_ordinal_position'
+    ), table=Temperature.__tablename__).fetchall()
+
+    return [
+        (name, None if description == 'MAXVALUE' else datetime.strptime(description.strip("'")[:10], '%Y-%m-%d'))
+        for name, description in results
+    ]
+
+
+def _month_start(dt, months=0):
+    month = dt.month - 1 + months
+    return datetime(dt.year + month // 12, month % 12 + 1, 1)
+
+
+def _partition_clause(month):
+    return "PARTITION p{0} VALUES LESS THAN ('{1}')".format(
+        month.strftime('%Y%m'), _month_start(month, 1).strftime('%Y-%m-%d')
+    )
+
+
+def partition_table(months_ahead=2):
+    """
+    Partition the remote temperature table by month of record_time, from its oldest reading to <months_ahead> months
+    from now. MySQL does not allow foreign keys on partitioned tables, so the sensor foreign key must be dropped first.
+    :param months_ahead:
+    :return:
+    """
+    engine = get_engine()
+    oldest = engine.execute(select([func.min(Temperature.__table__.c.record_time)])).scalar() or datetime.now()
+
+    month, last = _month_start(oldest), _month_start(datetime.now(), months_ahead)
+    clauses = []
+    while month <= last:
+        clauses.append(_partition_clause(month))
+        month = _month_start(month, 1)
+    clauses.append('PARTITION {0} VALUES LESS THAN (MAXVALUE)'.format(FUTURE_PARTITION))
+
+    engine.execute(text('ALTER TABLE {0} PARTITION BY RANGE COLUMNS(record_time) ({1})'.format(
+        Temperature.__tablename__, ', '.join(clauses)
+    )))
+
+
+def add_partitions(months_ahead=2):
+    """
+    Split monthly partitions off the catch-all partition, up to <months_ahead> months from now.
+    :param months_ahead:
+    :return: number of partitions added
+    """
+    partitions = get_partitions()
+    if len(partitions) < 2:
+        return 0
+
+    # the last monthly partition holds everything before its upper bound, the first day of the next month
+    month = partitions[-2][1]
+    last = _month_start(datetime.now(), months_ahead)
+
+    clauses = []
+    while month <= last:
+        clauses.append(_partition_clause(month))
+        month = _month_start(month, 1)
+
+    if len(clauses) > 0:
+        get_engine().execute(text('ALTER TABLE {0} REORGANIZE PARTITION {1} INTO ({2}, {3})'.format(
+            Temperature.__tablename__, FUTURE_PARTITION, ', '.join(clauses),
+            'PARTITION {0} VALUES LESS THAN (MAXVALUE)'.format(FUTURE_PARTITION)
+        )))
+
+    return len(clauses)
+
+
+def apply_retention(now=None):
+    """
+    Compact raw readings older than the raw horizon into the rollups, and delete minute rollups older than theirs.
+    Meant to be run daily against the remote database, e.g. from cron.
+    :param now: datetime
+    :return:
+    """
+    now = now or datetime.now()
+    batch_size = SETTINGS['batch_size']
+
+    if get_partitions():
+        add_partitions()
+
+    compact(now - timedelta(days=SETTINGS['raw_days']), batch_size=batch_size)
+
+    minute = TemperatureMinute.__table__
+    delete_before(minute, minute.c.bucket, now - timedelta(days=SETTINGS['minute_days']), batch_size=batch_size)
+
+
+class LocalPruner(object):
+    def __init__(self, hours=2, interval=300., batch_size=5000):
+        """
+        Keeps the local SQLite database to the last <hours> of raw readings, deleting in batches at most once every
+        <interval> seconds rather than on every pass of the control loop.
+
+        :param hours: hours of readings to keep
+        :param interval: seconds between prunes
+        :param batch_size: rows per DELETE
+        """
+        self.hours = hours
+        self.interval = interval
+        self.batch_size = batch_size
+        self.last_run = None
+
+    def due(self):
+        return self.last_run is None or time.time() - self.last_run >= self.interval
+
+    def prune(self):
+        """
+        :return: number of rows deleted, or None if the last prune was less than <interval> seconds ago
+        """
+        if not self.due():
+            return None
+        self.last_run = time.time()
+
+        raw = Temperature.__table__
+        deleted = delete_before(raw, raw.c.record_time, datetime.now() - timedelta(hours=self.hours), local=True,
+                                batch_size=self.batch_size)
+        logging.debug('Pruned {0} temperatures from the local database.'.format(deleted))
+        return deleted
+
+
+local_pruner = LocalPruner(
+    hours=SETTINGS['local_hours'],
+    interval=SETTINGS['local_interval'],
+    batch_size=SETTINGS['batch_size'],
+)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Apply the retention policy to the remote temperature tables.')
+    parser.add_argument('--partition', default=False, action='store_true',
+                        help='partition the temperature table by month (MySQL only) instead')
+    args = parser.parse_args()
+
+    logging.basicConfig(**local_settings.LOGGING)
+    if args.partition:
+        partition_table()
+    else:
+        apply_retention()
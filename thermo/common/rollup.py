@@ -0,0 +1,241 @@
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, case, func, select
+
+from thermo.common.models import ROLLUPS, Temperature, get_engine
+from thermo.sensor.recent import POWER_ON_RESET_VALUE
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_start(dt, seconds):
+    """
+    :param dt: datetime
+    :param seconds: bucket width, a positive whole number of seconds. Buckets are aligned to the epoch, so widths that
+    divide a day start at midnight.
+    :return: start of the bucket containing <dt>
+    """
+    since_epoch = dt - EPOCH
+    offset = (since_epoch.days * 86400 + since_epoch.seconds) % seconds
+    return dt - timedelta(seconds=offset, microseconds=dt.microsecond)
+
+
+def aggregate(rows, seconds):
+    """
+    :param rows: iterable of dicts with sensor, record_time and value keys
+    :param seconds: bucket width
+    :return: {(sensor, bucket): [minimum, maximum, total, samples]}
+    """
+    aggregates = {}
+    for row in rows:
+        value = row['value']
+        if value is None or value == POWER_ON_RESET_VALUE:
+            continue
+
+        key = (row['sensor'], bucket_start(row['record_time'], seconds))
+        if key in aggregates:
+            a = aggregates[key]
+            a[0] = min(a[0], value)
+            a[1] = max(a[1], value)
+            a[2] += value
+            a[3] += 1
+        else:
+            aggregates[key] = [value, value, value, 1]
+
+    return aggregates
+
+
+def _merge_mysql(connection, table, rows):
+    from sqlalchemy.dialects.mysql import insert
+
+    stmt = insert(table).values(rows)
+    connection.execute(stmt.on_duplicate_key_update(
+        minimum=case([(table.c.minimum < stmt.inserted.minimum, table.c.minimum)], else_=stmt.inserted.minimum),
+        maximum=case([(table.c.maximum > stmt.inserted.maximum, table.c.maximum)], else_=stmt.inserted.maximum),
+        total=table.c.total + stmt.inserted.total,
+        samples=table.c.samples + stmt.inserted.samples,
+    ))
+
+
+def _merge_generic(connection, table, rows):
+    for row in rows:
+        result = connection.execute(
+            table.update()
+                .where(and_(table.c.sensor == row['sensor'], table.c.bucket == row['bucket']))
+                .values(
+                minimum=case([(table.c.minimum < row['minimum'], table.c.minimum)], else_=row['minimum']),
+                maximum=case([(table.c.maximum > row['maximum'], table.c.maximum)], else_=row['maximum']),
+                total=table.c.total + row['total'],
+                samples=table.c.samples + row['samples'],
+            )
+        )
+        if result.rowcount == 0:
+            connection.execute(table.insert(), [row])
+
+
+def update_rollups(rows, local=False):
+    """
+    Add newly inserted temperature readings to the minute, hour and day rollups. Each reading must be added exactly
+    once; use rebuild_rollups for data that may already be included.
+    :param rows: list of dicts with sensor, record_time and value keys
+    :param local: Use the local SQLite database if true
+    :return:
+    """
+    engine = get_engine(local=local)
+    with engine.begin() as connection:
+        for rollup in ROLLUPS:
+            aggregates = aggregate(rows, rollup.resolution)
+            if len(aggregates) == 0:
+                continue
+
+            rollup_rows = [
+                {'sensor': sensor, 'bucket': bucket, 'minimum': a[0], 'maximum': a[1], 'total': a[2], 'samples': a[3]}
+                for (sensor, bucket), a in aggregates.items()
+            ]
+
+            if connection.dialect.name == 'mysql':
+                _merge_mysql(connection, rollup.__table__, rollup_rows)
+            else:
+                _merge_generic(connection, rollup.__table__, rollup_rows)
+
+
+def rebuild_rollups(start, end, local=False):
+    """
+    Recompute the rollups of every bucket that overlaps <start> to <end> from the raw temperatures, one day at a time.
+    Safe to repeat, e.g. after a journal replay or a bulk load.
+
+    Days whose raw temperatures have been compacted away are left alone, since their rollups are all that is left of
+    them: days without raw temperatures, and days whose rollups count more readings than there are raw temperatures,
+    i.e. compacted days that a few late readings have been written to since.
+    :param start: datetime
+    :param end: datetime
+    :param local: Use the local SQLite database if true
+    :return: number of days rebuilt
+    """
+    raw = Temperature.__table__
+    days = ROLLUPS[-1].__table__
+    engine = get_engine(local=local)
+
+    rebuilt = 0
+    day = bucket_start(start, 24 * 60 * 60)
+    while day <= end:
+        next_day = day + timedelta(days=1)
+
+        with engine.begin() as connection:
+            rows = [
+                {'sensor': r.sensor, 'record_time': r.record_time, 'value': r.value}
+                for r in connection.execute(
+                    select([raw.c.sensor, raw.c.record_time, raw.c.value])
+                        .where(and_(raw.c.record_time >= day, raw.c.record_time < next_day))
+                )
+            ]
+
+            if len(rows) == 0:
+                day = next_day
+                continue
+
+            rolled_up = connection.execute(
+                select([func.sum(days.c.samples)]).where(and_(days.c.bucket >= day, days.c.bucket < next_day))
+            ).scalar() or 0
+            if rolled_up > len(rows):
+                logging.info('Keeping the rollups of {0}: they count {1} readings, the raw table has {2}.'.format(
+                    day.strftime('%Y-%m-%d'), rolled_up, len(rows)))
+                day = next_day
+                continue
+
+            for rollup in ROLLUPS:
+                table = rollup.__table__
+                connection.execute(table.delete().where(and_(table.c.bucket >= day, table.c.bucket < next_day)))
+
+                aggregates = aggregate(rows, rollup.resolution)
+                if len(aggregates) > 0:
+                    connection.execute(table.insert(), [
+                        {'sensor': sensor, 'bucket': bucket, 'minimum': a[0], 'maximum': a[1], 'total': a[2],
+                         'samples': a[3]}
+                        for (sensor, bucket), a in aggregates.items()
+                    ])
+            rebuilt += 1
+
+        day = next_day
+
+    return rebuilt
+
+
+def choose_rollup(resolution):
+    """
+    :param resolution: seconds between points
+    :return: the coarsest rollup that is at least as fine as <resolution>, or None if only raw data is fine enough
+    """
+    candidates = [rollup for rollup in ROLLUPS if rollup.resolution <= resolution]
+    return candidates[-1] if len(candidates) > 0 else None
+
+
+def history(sensors, start, end, resolution, local=False):
+    """
+    Minimum, mean, maximum and number of readings per sensor for every <resolution> seconds from <start> to <end>, read
+    from the coarsest rollup that is fine enough, or the raw temperatures for resolutions under a minute.
+    :param sensors: list of sensor ids
+    :param start: datetime
+    :param end: datetime
+    :param resolution: seconds between points
+    :param local: Use the local SQLite database if true
+    :return: list of dicts with sensor, time, min, mean, max and count keys, ordered by sensor and time
+    """
+    if resolution <= 0:
+        raise ValueError('The resolution must be a positive number of seconds.')
+
+    rollup = choose_rollup(resolution)
+    engine = get_engine(local=local)
+
+    with engine.connect() as connection:
+        if rollup is None:
+            raw = Temperature.__table__
+            results = connection.execute(
+                select([raw.c.sensor, raw.c.record_time, raw.c.value])
+                    .where(raw.c.sensor.in_(sensors))
+                    .where(and_(raw.c.record_time >= start, raw.c.record_time <= end))
+            )
+            buckets = aggregate(
+                [{'sensor': r.sensor, 'record_time': r.record_time, 'value': r.value} for r in results], resolution
+            )
+
+        else:
+            table = rollup.__table__
+            results = connection.execute(
+                select([table]).where(table.c.sensor.in_(sensors))
+                    .where(and_(table.c.bucket >= bucket_start(start, rollup.resolution), table.c.bucket <= end))
+            )
+
+            # re-bucket when the requested resolution is coarser than the rollup's
+            buckets = {}
+            for r in results:
+                key = (r.sensor, bucket_start(r.bucket, resolution))
+                if key in buckets:
+                    b = buckets[key]
+                    b[0] = min(b[0], r.minimum)
+                    b[1] = max(b[1], r.maximum)
+                    b[2] += r.total
+                    b[3] += r.samples
+                else:
+                    buckets[key] = [r.minimum, r.maximum, r.total, r.samples]
+
+    return [
+        {'sensor': sensor, 'time': bucket, 'min': b[0], 'mean': b[2] / b[3], 'max': b[1], 'count': b[3]}
+        for (sensor, bucket), b in sorted(buckets.items())
+    ]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from thermo import local_settings
+
+    parser = argparse.ArgumentParser(description='Rebuild the temperature rollups from the raw temperatures.')
+    parser.add_argument('start', help='%Y-%m-%d')
+    parser.add_argument('end', help='%Y-%m-%d', nargs='?', default=datetime.now().strftime('%Y-%m-%d'))
+    args = parser.parse_args()
+
+    logging.basicConfig(**local_settings.LOGGING)
+    rebuild_rollups(datetime.strptime(args.start, '%Y-%m-%d'), datetime.strptime(args.end, '%Y-%m-%d'))
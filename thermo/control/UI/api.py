@@ -1,31 +1,23 @@
 import json
+from datetime import datetime
 
-from sqlalchemy import func
-
-from thermo import local_settings
+from thermo.common import notify
+from thermo.common.journal import write_rows
 from thermo.common.models import *
-from thermo.control.thermostat import Schedule
-from thermo.sensor.thermal import read_temp_sensor
 
 
-@duplicate_locally
-def set_constant_temperature(user, zone, temperature, expiration, local=False):
+def set_constant_temperature(user, zone, temperature, expiration):
     """
     Send message to override temperature schedule for all sensors attached to the specified zone
     :param user: user id
     :param zone: zone affected
     :param temperature: float: temperature target
     :param expiration: datetime for expiration of temperature target
-    :param local: Use the local SQLite database if true
     :return:
     """
-    session = get_session(local=local)
-    results = session.query(Sensor).filter(Sensor.user == user).filter(Sensor.zone == zone)
-    session.close()
-
     target = {}
-    for sensor in results:
-        target[sensor.location] = temperature
+    for location in get_zone_locations(user, zone):
+        target[location] = temperature
 
     message = {
         'target': target,
@@ -35,33 +27,60 @@ def set_constant_temperature(user, zone, temperature, expiration, local=False):
 
     j = json.dumps(message)
 
-    session = get_session(local=local)
-    new_message = Message(record_time=datetime.now(), user=user, json=j, type='temperature override')
-    session.add(new_message)
-    session.commit()
-    session.close()
+    row = {'record_time': datetime.now(), 'user': user, 'json': j, 'type': 'temperature override', 'received': False}
+    write_rows(Message.__table__, [row])
+
+    # deliver the override to the control process straight away; it also polls the message table as a fallback
+    notify.send(notify.CONTROL_SOCKET, {'type': 'temperature override', 'user': user, 'message': message},
+                get_api_key())
     return
 
 
-@fallback_locally
-def get_available_schedules(user, zone, local=False):
+def notify_schedule_changed(user, zone):
     """
-
+    Tell the control process to check for a changed schedule now, rather than at its next refresh
     :param user:
     :param zone:
-    :param local:
-    :return: [(name, id), ...]
+    :return:
+    """
+    notify.send(notify.CONTROL_SOCKET, {'type': 'schedule changed', 'user': user, 'zone': zone}, get_api_key())
+
+
+def notify_action_changed(user, action_id):
     """
+    Tell the control process to reload its actions now, rather than at its next configuration refresh
+    :param user:
+    :param action_id:
+    :return:
+    """
+    notify.send(notify.CONTROL_SOCKET, {'type': 'action changed', 'user': user, 'action': action_id}, get_api_key())
+
+
+@fallback_locally
+def get_zone_locations(user, zone, local=False):
     session = get_session(local=local)
-    results = session.query(ThermostatSchedule) \
-        .filter(ThermostatSchedule.zone == zone) \
-        .filter(ThermostatSchedule.user == user) \
-        .all()
+    results = session.query(Sensor).filter(Sensor.user == user).filter(Sensor.zone == zone).all()
     session.close()
 
-    names = [(r.name, r.id) for r in results]
+    return [sensor.location for sensor in results]
 
-    return names
+
+@fallback_locally
+def get_zone_sensors(user, zone, local=False):
+    """
+    :param user: user id
+    :param zone: zone id
+    :param local: Use the local SQLite database if true
+    :return: {sensor id: (location, bias)}
+    """
+    session = get_session(local=local)
+    results = session.query(Sensor.id, Sensor.location, Sensor.bias) \
+        .filter(Sensor.user == user) \
+        .filter(Sensor.zone == zone) \
+        .all()
+    session.close()
+
+    return {sensor_id: (location, bias or 0) for sensor_id, location, bias in results}
 
 
 @fallback_locally
@@ -225,123 +244,12 @@ def update_schedule(user, zone, name, schedule, local=False):
     return
 
 
-def get_action_status(user, zone):
-    engine = get_engine()
-    result = engine.execute(
-        '''select record_time, value, target, unit.name as unit, action.name as name
-from action, action_log, unit
-where unit.user = {0}
-and action.unit = unit.id
-and action_log.action = action.id
-and action_log.record_time >= (NOW() - INTERVAL 12 HOUR )
-and action.zone = {1}
-order by record_time desc
-limit 1'''.format(user, zone)
-    )
-
-    last_action = result.fetchall()
-
-    status_dict = {}
-    for action in last_action:
-        status_dict[action.name.title()] = {'status': action.value == 1, 'time': action.record_time}
-
-    return status_dict
-
-
-def get_current_room_temperatures(user, zone, minutes=1):
-    try:
-        session = get_session()
-        indoor_temperatures = session.query(
-            Temperature.location,
-            func.sum(Temperature.value - Sensor.bias) / func.count(Temperature.value)
-        ) \
-            .filter(Temperature.record_time > datetime.now() - timedelta(minutes=minutes)) \
-            .join(Sensor) \
-            .filter(Sensor.user == user) \
-            .filter(Sensor.zone == zone) \
-            .group_by(Temperature.location) \
-            .all()
-        session.close()
-
-        room_temps = {i[0]: i[1] for i in indoor_temperatures}
-
-    except Exception as e:
-        logging.exception('Exception, falling back to local sensor.')
-        room_temps = {}
-        try:
-            is_on, room_temps[local_settings.FALLBACK['LOCATION']] = read_temp_sensor(
-                local_settings.FALLBACK['SERIAL NUMBER'])
-            if not is_on:
-                raise Exception
-
-        except Exception as e2:
-            logging.error('EMERGENCY: Fallback sensor unavailable!')
-            logging.error('Parent Exception:')
-            logging.exception(e)
-            logging.error('Nested Exception:')
-            logging.exception(e2)
-
-    return room_temps
-
-
-def get_thermostat_schedule(zone):
-    schedule = ScheduleAPI(zone)
-    schedule.get_override_messages()
-    targets = schedule.current_target_temps()
-    next_targets = schedule.get_next_target_temps()
-
-    return targets, next_targets, schedule.schedule_name
-
-
-class ScheduleAPI(Schedule):
-    def __init__(self, zone):
-        super(ScheduleAPI, self).__init__(zone)
-
-    def get_override_messages(self):
-        try:
-            session = get_session()
-            results = session.query(Message) \
-                .filter(Message.user == local_settings.USER_NUMBER) \
-                .filter(Message.received == True) \
-                .filter(Message.type == 'temperature override') \
-                .order_by(Message.record_time.asc()) \
-                .all()
-
-            for msg in results:
-                msg_dict = json.loads(msg.json)
-                target = msg_dict['target']
-                try:
-                    expiration = datetime.strptime(msg_dict['expiration'], "%Y-%m-%dT%H:%M:%S.%f")
-                except ValueError:
-                    expiration = datetime.strptime(msg_dict['expiration'], "%Y-%m-%dT%H:%M:%S")
-                zone = int(msg_dict['zone'])
-
-                for location, tgt in target.iteritems():
-                    target[str(location)] = float(tgt)
-
-                if zone == self.zone:
-                    self.override = target
-                    self.override_expiration = expiration
-
-        except IndexError:
-            # This error will occur if there are no unread messages
-            pass
-
-        finally:
-            session.close()
-
-        return
-
-
 def check_local(request, token=None):
     s = request.remote_addr.split('.')
     if s[0] == '192' and s[1] == '168':
         return
     else:
-        session = get_session()
-        results = session.query(User).filter(User.id == local_settings.USER_NUMBER).all()[0]
-        key = results.api_key
-        session.close()
+        key = get_api_key()
 
         if request.args.get('controltoken', token) == key:
             return
@@ -364,13 +272,3 @@ def toggle_action(action_id, local=False):
     session.close()
     return result
 
-
-@fallback_locally
-def action_is_enabled(action_id, local=False):
-    session = get_session(local=local)
-    actions = session.query(Action).filter(Action.id == action_id).all()
-
-    if len(actions) > 1:
-        raise ValueError('Multiple actions found')
-
-    return actions[0].enabled
@@ -1,9 +1,20 @@
+import threading
 import urllib
+from datetime import datetime, timedelta
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
 
 import numpy as np
-from flask import Flask, render_template, request, redirect, url_for
+from flask import Flask, render_template, request, redirect, url_for, jsonify, Response, abort
 
+from thermo import local_settings
+from thermo.common.events import publisher
+from thermo.common.rollup import history
 from thermo.control.UI.api import *
+from thermo.control.UI.dashboard import snapshots, zone_status
 
 
 def aggregate_temperatures(schedule_dict, method='Median'):
@@ -20,58 +31,82 @@ def aggregate_temperatures(schedule_dict, method='Median'):
 
 
 app = Flask(__name__, template_folder='templates')
-zone = 1
+
+# the master control process creates the sockets' directory; say so now if this process is not allowed to use it
+notify.check_access()
+
+# The zone shown when a request does not name one with ?zone=<zone>
+DEFAULT_ZONE = getattr(local_settings, 'DEFAULT_ZONE', local_settings.FALLBACK.get('ZONE', 1))
+
+
+def request_zone():
+    return request.values.get('zone', DEFAULT_ZONE, type=int)
+
+
+def redirect_to_index(zone, controltoken=None):
+    params = {'zone': zone}
+    if controltoken is not None:
+        params['controltoken'] = controltoken
+
+    return redirect(url_for('index') + '?' + urllib.urlencode(params))
 
 
 @app.route('/', methods=['POST', 'GET'])
 @app.route('/index', methods=['POST', 'GET'])
 def index():
     check_local(request)
-    minutes = 1
 
-    room_temps = get_current_room_temperatures(local_settings.USER_NUMBER, zone, minutes)
-    room_targets, next_targets, schedule_name = get_thermostat_schedule(zone)
+    zone = request_zone()
+    snapshot = snapshots.get(local_settings.USER_NUMBER, zone)
+    room_temps = snapshot['room_temps']
+    room_targets, next_targets = snapshot['targets'], snapshot['next_targets']
     next_target_dates = {room: hour for room, (hour, target) in next_targets.iteritems()}
     next_target_temps = {room: target for room, (hour, target) in next_targets.iteritems()}
-    status = get_action_status(local_settings.USER_NUMBER, zone)
-    schedules = get_available_schedules(local_settings.USER_NUMBER, zone)
-    heat_status = action_is_enabled(1)
 
     context = {
         'current_temp': aggregate_temperatures(room_temps),
         'current_target': aggregate_temperatures(room_targets),
         'next_target': aggregate_temperatures(next_target_temps),
         'next_target_start_time': aggregate_temperatures(next_target_dates, method='DateMin').strftime('%I:%M %p'),
-        'status': status,
-        'active_schedule_name': schedule_name,
-        'schedules': schedules,
+        'status': snapshot['status'],
+        'active_schedule_name': snapshot['schedule_name'],
+        'schedules': snapshot['schedules'],
         'controltoken': request.args.get('controltoken', ''),
-        'heat_action': heat_status,
+        'zone': zone,
+        'actions': sorted((name, action['enabled']) for name, action in snapshot['actions'].items()),
     }
 
     return render_template('index.html', **context)
 
 
-@app.route('/toggle_action/heat', methods=['POST'])
-def toggle_heat():
+@app.route('/toggle_action/<name>', methods=['POST'])
+def toggle(name):
+    """
+    Enable or disable the zone's action <name> (heat, cool or fan)
+    """
     check_local(request, token=request.form.get('controltoken', False))
-    toggle_action(1)
-    ct = request.args.get('controltoken', None)
 
-    if ct is not None:
-        query_string = urllib.urlencode({'controltoken': ct})
-    else:
-        query_string = ''
+    zone = request_zone()
+    action = snapshots.get(local_settings.USER_NUMBER, zone)['actions'].get(name.upper())
+    if action is None:
+        abort(404)
 
-    return redirect(url_for('index') + '?' + query_string)
+    toggle_action(action['id'])
+    notify_action_changed(local_settings.USER_NUMBER, action['id'])
+    snapshots.invalidate(zone=zone)
+
+    return redirect_to_index(zone, request.form.get('controltoken', None))
 
 
 @app.route('/schedule/set_active', methods=['POST'])
 def set_active_schedule():
     check_local(request, token=request.form.get('controltoken', False))
 
+    zone = request_zone()
     schedule_id = request.form.get('schedule')
     activate_schedule(local_settings.USER_NUMBER, zone, schedule_id)
+    notify_schedule_changed(local_settings.USER_NUMBER, zone)
+    snapshots.invalidate(zone=zone)
 
     return redirect(url_for('index') + '?' + urllib.urlencode(request.form))
 
@@ -80,9 +115,11 @@ def set_active_schedule():
 def override():
     check_local(request, token=request.form.get('controltoken', False))
 
+    zone = request_zone()
     temperature = request.form.get('target')
     expiration = datetime.now() + timedelta(hours=float(request.form.get('hours')))
     set_constant_temperature(local_settings.USER_NUMBER, zone, temperature, expiration)
+    snapshots.invalidate(zone=zone)
 
     return redirect(url_for('index') + '?' + urllib.urlencode(request.form))
 
@@ -96,7 +133,8 @@ def schedule():
 
 @app.route('/skip-to-next', methods=['GET'])
 def skip():
-    room_targets, next_targets, schedule_name = get_thermostat_schedule(zone)
+    zone = request_zone()
+    next_targets = snapshots.get(local_settings.USER_NUMBER, zone)['next_targets']
     next_target_dates = {room: hour for room, (hour, target) in next_targets.iteritems()}
     next_target_temps = {room: target for room, (hour, target) in next_targets.iteritems()}
 
@@ -104,15 +142,163 @@ def skip():
     expiration = aggregate_temperatures(next_target_dates, method='DateMin')
 
     set_constant_temperature(local_settings.USER_NUMBER, zone, next_temp, expiration)
+    snapshots.invalidate(zone=zone)
 
-    ct = request.args.get('controltoken', None)
-    if ct is not None:
-        query_string = urllib.urlencode({'controltoken': ct})
-    else:
-        query_string = ''
+    return redirect_to_index(zone, request.args.get('controltoken', None))
+
+
+def json_response(payload, max_age=5):
+    """
+    JSON response with an ETag, so that a client polling with If-None-Match gets a 304 while nothing has changed
+    :param payload: JSON serializable object
+    :param max_age: seconds the client may reuse the response without revalidating
+    :return:
+    """
+    response = jsonify(payload)
+    response.cache_control.max_age = max_age
+    response.cache_control.private = True
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route('/api/zones/<int:zone_id>', methods=['GET'])
+def api_zone(zone_id):
+    check_local(request)
+
+    return json_response(zone_status(snapshots.get(local_settings.USER_NUMBER, zone_id)))
+
+
+@app.route('/api/zones/<int:zone_id>/temperatures', methods=['GET'])
+def api_zone_temperatures(zone_id):
+    check_local(request)
+    status = zone_status(snapshots.get(local_settings.USER_NUMBER, zone_id))
+
+    return json_response(status['room_temperatures'])
+
+
+@app.route('/api/zones/<int:zone_id>/targets', methods=['GET'])
+def api_zone_targets(zone_id):
+    check_local(request)
+    status = zone_status(snapshots.get(local_settings.USER_NUMBER, zone_id))
+
+    return json_response({'current': status['current_targets'], 'next': status['next_targets']})
+
+
+@app.route('/api/zones/<int:zone_id>/schedules', methods=['GET'])
+def api_zone_schedules(zone_id):
+    check_local(request)
+    status = zone_status(snapshots.get(local_settings.USER_NUMBER, zone_id))
+
+    return json_response({'active': status['active_schedule'], 'schedules': status['schedules']})
+
+
+@app.route('/api/schedules', methods=['GET'])
+def api_schedules():
+    check_local(request)
+
+    return json_response(get_schedules(local_settings.USER_NUMBER), max_age=60)
+
+
+@app.route('/api/zones/<int:zone_id>/history', methods=['GET'])
+def api_zone_history(zone_id):
+    """
+    Minimum, mean and maximum temperature per room over time, from the coarsest rollup that meets the requested
+    resolution. Query parameters: hours (default 24) or start and end (%Y-%m-%dT%H:%M:%S), and resolution in seconds
+    (default 300).
+    """
+    check_local(request)
+
+    try:
+        end = datetime.strptime(request.args['end'], '%Y-%m-%dT%H:%M:%S') if 'end' in request.args else datetime.now()
+        if 'start' in request.args:
+            start = datetime.strptime(request.args['start'], '%Y-%m-%dT%H:%M:%S')
+        else:
+            start = end - timedelta(hours=float(request.args.get('hours', 24)))
+        resolution = int(request.args.get('resolution', 300))
+        if resolution <= 0:
+            raise ValueError('resolution must be a positive number of seconds')
+    except ValueError as e:
+        return json_response({'error': str(e)}, max_age=0), 400
+
+    sensors = get_zone_sensors(local_settings.USER_NUMBER, zone_id)
+    points = {}
+    for row in history(list(sensors.keys()), start, end, resolution):
+        location, bias = sensors[row['sensor']]
+        points.setdefault(location, []).append({
+            'time': row['time'].isoformat(),
+            'min': row['min'] - bias,
+            'mean': row['mean'] - bias,
+            'max': row['max'] - bias,
+            'count': row['count'],
+        })
+
+    return json_response({'start': start.isoformat(), 'end': end.isoformat(), 'resolution': resolution,
+                          'rooms': points}, max_age=60)
+
+
+_event_listener = {'listener': None}
+_event_listener_lock = threading.Lock()
+
+
+def on_event(event):
+    if event['type'] == 'relay':
+        snapshots.invalidate(zone=event['zone'])
+    publisher.publish(event)
+
+
+def start_event_listener():
+    """
+    Start receiving events from the master control process, once per process. Every open stream is fed from this one
+    listener.
+    """
+    with _event_listener_lock:
+        if _event_listener['listener'] is None:
+            listener = notify.Listener(notify.EVENT_SOCKET, on_event, get_api_key)
+            listener.start()
+            _event_listener['listener'] = listener
+
+
+def filter_event(event, zone):
+    if zone is None:
+        return event
+    if event['type'] == 'relay':
+        return event if event['zone'] == zone else None
+    if event['type'] == 'temperatures':
+        readings = [r for r in event['readings'] if r['zone'] == zone]
+        return dict(event, readings=readings) if len(readings) > 0 else None
+    return event
+
+
+@app.route('/api/stream', methods=['GET'])
+def api_stream():
+    """
+    Server-Sent Events stream of sensor batches ('temperatures' events) and relay changes ('relay' events), optionally
+    limited to one zone with ?zone=<zone>
+    """
+    check_local(request)
+    start_event_listener()
+
+    zone_filter = request.args.get('zone', None, type=int)
+    queue = publisher.subscribe()
+
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = filter_event(queue.get(timeout=15), zone_filter)
+                except Empty:
+                    yield ': keepalive\n\n'
+                    continue
+
+                if event is not None:
+                    yield 'event: {0}\ndata: {1}\n\n'.format(event['type'], json.dumps(event))
+        finally:
+            publisher.unsubscribe(queue)
 
-    return redirect(url_for('index') + '?' + query_string)
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', debug=True)
+    app.run(host='0.0.0.0', debug=True, threaded=True)
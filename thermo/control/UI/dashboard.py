@@ -0,0 +1,172 @@
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func
+
+from thermo import local_settings
+from thermo.common.models import *
+from thermo.control.thermostat import Schedule
+from thermo.control.timeline import CompiledSchedule
+
+_compiled_schedules = {}
+
+
+def compile_schedule(raw):
+    """
+    Compile a schedule BLOB, reusing the compiled schedule when the same content has been seen before
+    :param raw: JSON schedule from thermostat_schedule
+    :return: CompiledSchedule
+    """
+    if not isinstance(raw, bytes):
+        raw = raw.encode('utf-8')
+    key = hashlib.sha1(raw).hexdigest()
+
+    if key not in _compiled_schedules:
+        if len(_compiled_schedules) > 16:
+            _compiled_schedules.clear()
+        _compiled_schedules[key] = CompiledSchedule(json.loads(raw))
+
+    return _compiled_schedules[key]
+
+
+@fallback_locally
+def build_snapshot(user, zone, minutes=1, override_lookback=20, local=False):
+    """
+    Assemble everything the dashboard shows for a zone, using a single session and four queries.
+    :param user: user id
+    :param zone: zone id
+    :param minutes: minutes of temperatures to average
+    :param override_lookback: number of recent override messages searched for one that applies to the zone
+    :param local: Use the local SQLite database if true
+    :return: dict
+    """
+    now = datetime.now()
+    session = get_session(local=local)
+
+    try:
+        room_temps = session.query(
+            Temperature.location,
+            func.sum(Temperature.value - Sensor.bias) / func.count(Temperature.value)
+        ) \
+            .filter(Temperature.record_time > now - timedelta(minutes=minutes)) \
+            .join(Sensor) \
+            .filter(Sensor.user == user) \
+            .filter(Sensor.zone == zone) \
+            .group_by(Temperature.location) \
+            .all()
+
+        schedules = session.query(
+            ThermostatSchedule.id, ThermostatSchedule.name, ThermostatSchedule.active, ThermostatSchedule.schedule
+        ) \
+            .filter(ThermostatSchedule.zone == zone) \
+            .filter(ThermostatSchedule.user == user) \
+            .all()
+
+        # each of the zone's actions, with its most recent log entry from the past 12 hours
+        latest = session.query(ActionLog.action, func.max(ActionLog.record_time).label('record_time')) \
+            .filter(ActionLog.record_time >= now - timedelta(hours=12)) \
+            .group_by(ActionLog.action) \
+            .subquery()
+        actions = session.query(Action.id, Action.name, Action.enabled, ActionLog.value, ActionLog.record_time) \
+            .join(Unit, Action.unit == Unit.id) \
+            .outerjoin(latest, latest.c.action == Action.id) \
+            .outerjoin(ActionLog, and_(ActionLog.action == latest.c.action,
+                                       ActionLog.record_time == latest.c.record_time)) \
+            .filter(Unit.user == user) \
+            .filter(Action.zone == zone) \
+            .all()
+
+        # overrides are read whether or not the control process has marked them received yet
+        overrides = session.query(Message.json) \
+            .filter(Message.user == user) \
+            .filter(Message.type == 'temperature override') \
+            .order_by(Message.record_time.desc()) \
+            .limit(override_lookback) \
+            .all()
+    finally:
+        session.close()
+
+    active = [s for s in schedules if s.active]
+    if len(active) == 0:
+        raise Exception('No active schedule for zone {0}.'.format(zone))
+    compiled = compile_schedule(active[0].schedule)
+
+    targets = compiled.current_targets(now)
+    for (j,) in overrides:
+        override_zone, override_target, expiration = Schedule.parse_override(json.loads(j))
+        if override_zone == zone:
+            if expiration > now:
+                targets = override_target
+            break
+
+    status = {}
+    last = sorted([a for a in actions if a.record_time is not None], key=lambda a: a.record_time)
+    if len(last) > 0:
+        status[last[-1].name.title()] = {'status': last[-1].value == 1, 'time': last[-1].record_time}
+
+    return {
+        'time': now,
+        'room_temps': {location: float(temp) for location, temp in room_temps},
+        'targets': targets,
+        'next_targets': compiled.next_targets(now),
+        'schedule_name': active[0].name,
+        'schedules': [(s.name, s.id) for s in schedules],
+        'status': status,
+        'actions': {a.name: {'id': a.id, 'enabled': bool(a.enabled)} for a in actions},
+    }
+
+
+def zone_status(snapshot):
+    """
+    The JSON form of a dashboard snapshot, which every /api/zones endpoint serves all or part of
+    :param snapshot: dict from build_snapshot
+    :return: JSON serializable dict
+    """
+    next_targets = snapshot['next_targets']
+    return {
+        'room_temperatures': snapshot['room_temps'],
+        'current_targets': snapshot['targets'],
+        'next_targets': {room: {'time': t.isoformat(), 'target': target} for room, (t, target) in next_targets.items()},
+        'relays': {name: {'on': d['status'], 'time': d['time'].isoformat()} for name, d in snapshot['status'].items()},
+        'actions': snapshot['actions'],
+        'active_schedule': snapshot['schedule_name'],
+        'schedules': [{'name': name, 'id': schedule_id} for name, schedule_id in snapshot['schedules']],
+    }
+
+
+class SnapshotCache(object):
+    def __init__(self, ttl=5.):
+        """
+        Dashboard snapshots by (user, zone), rebuilt when they are more than <ttl> seconds old or have been invalidated
+        by a write from the UI.
+
+        :param ttl: seconds a snapshot is served for
+        """
+        self.ttl = ttl
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    def get(self, user, zone):
+        key = (user, zone)
+        with self.lock:
+            if key in self.snapshots:
+                expires, snapshot = self.snapshots[key]
+                if time.time() < expires:
+                    return snapshot
+
+        snapshot = build_snapshot(user, zone)
+        with self.lock:
+            self.snapshots[key] = (time.time() + self.ttl, snapshot)
+        return snapshot
+
+    def invalidate(self, user=None, zone=None):
+        with self.lock:
+            for key in list(self.snapshots.keys()):
+                if (user is None or key[0] == user) and (zone is None or key[1] == zone):
+                    del self.snapshots[key]
+
+
+snapshots = SnapshotCache(ttl=getattr(local_settings, 'DASHBOARD_CACHE_SECONDS', 5.))
@@ -0,0 +1,199 @@
+import json
+import logging
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+
+def zone_series(times, locations, values, freq='10s', spike=5.):
+    """
+    Median temperature of a zone on a regular grid: each location is averaged per <freq>, readings more than <spike>
+    degrees from the rolling median of their location are dropped, gaps are interpolated, and the median is taken
+    across locations.
+    :param times: sequence of datetimes
+    :param locations: sequence of location names
+    :param values: sequence of temperatures
+    :param freq: pandas frequency string of the grid
+    :param spike: degrees from the rolling median beyond which a reading is discarded
+    :return: pandas.Series indexed by time
+    """
+    df = pd.DataFrame({'record_time': times, 'location': locations, 'value': values})
+    df = df.pivot_table(index='record_time', columns='location', values='value')
+
+    df = df.resample(freq).mean()
+    filled = df.ffill()
+    df[(filled - filled.rolling(5, min_periods=1).median()).abs() > spike] = np.nan
+
+    return df.interpolate('linear', limit_direction='both').median(axis=1)
+
+
+def overshoot(series, action_times, action_values, targets, minutes=3):
+    """
+    For every action at once, the extreme temperature reached within <minutes> of it: the minimum after the heat was
+    turned on, the maximum after it was turned off.
+
+    Each action's window is located on the series' regular grid with searchsorted, and all windows are gathered into
+    one (actions x samples) matrix, so the cost does not grow with a Python loop over the actions.
+
+    :param series: pandas.Series on a regular DatetimeIndex, e.g. from zone_series
+    :param action_times: sequence of datetimes
+    :param action_values: sequence of 1 (heat turned on) or 0 (heat turned off)
+    :param targets: sequence of the switching target logged with each action, NaN where unknown
+    :param minutes: length of the window after each action
+    :return: pandas.DataFrame indexed by action time with value, target, cusp_time (timedelta from the action to the
+        extreme), cusp_temp and overshoot (cusp_temp - target) columns; actions without readings in their window are
+        dropped
+    """
+    columns = ['value', 'target', 'cusp_time', 'cusp_temp', 'overshoot']
+    action_times = pd.DatetimeIndex(action_times)
+    action_values = np.asarray(action_values, dtype=np.float64)
+    targets = np.asarray([np.nan if t is None else t for t in targets], dtype=np.float64)
+
+    if len(series) < 2 or len(action_times) == 0:
+        return pd.DataFrame(columns=columns)
+
+    grid = series.index.values
+    step = grid[1] - grid[0]
+    width = int(np.timedelta64(minutes * 60, 's') // step) + 1
+
+    # pad with NaN so that windows running past the end of the series stay in bounds
+    temps = np.concatenate([series.values.astype(np.float64), np.full(width, np.nan)])
+    starts = np.searchsorted(grid, action_times.values, side='left')
+    windows = temps[starts[:, None] + np.arange(width)[None, :]]
+
+    # windows of actions that began before the series are only partly covered
+    windows[action_times.values < grid[0]] = np.nan
+
+    valid = ~np.all(np.isnan(windows), axis=1)
+    windows, starts = windows[valid], starts[valid]
+    action_times, action_values, targets = action_times[valid], action_values[valid], targets[valid]
+
+    on = action_values == 1
+    filled = np.where(np.isnan(windows), np.where(on[:, None], np.inf, -np.inf), windows)
+    cusp = np.where(on, np.argmin(filled, axis=1), np.argmax(filled, axis=1))
+    cusp_temp = windows[np.arange(len(windows)), cusp]
+
+    return pd.DataFrame({
+        'value': action_values,
+        'target': targets,
+        'cusp_time': pd.to_timedelta(grid[starts + cusp] - action_times.values) if len(starts) else [],
+        'cusp_temp': cusp_temp,
+        'overshoot': cusp_temp - targets,
+    }, index=action_times, columns=columns)
+
+
+class LagLearner(object):
+    def __init__(self, above=0., below=0., state=None, alpha=0.2, minutes=3, outlier=3.):
+        """
+        Online estimate of the heating overshoot, updated once per heat cycle from the live zone temperature.
+
+        After the heat is switched, the extreme temperature (the maximum after turning off, the minimum after turning
+        on) is tracked for <minutes>. Its difference from the switching target then updates an exponentially weighted
+        mean and variance of the overshoot above (heat off) or below (heat on) the target. Cycles more than <outlier>
+        standard deviations from the mean are skipped once there are enough of them to tell.
+
+        :param above: prior expected overshoot above the target after the heat is turned off
+        :param below: prior expected overshoot below the target after the heat is turned on (negative)
+        :param state: JSON string from a previous learner's state(), which takes the place of the priors
+        :param alpha: weight of each new cycle
+        :param minutes: time after a switch in which the extreme temperature is looked for
+        :param outlier: standard deviations beyond which a cycle is ignored
+        """
+        self.alpha = alpha
+        self.window = timedelta(minutes=minutes)
+        self.outlier = outlier
+
+        # [mean, variance, cycles]
+        self.estimates = {'above': [float(above), 0., 0], 'below': [float(below), 0., 0]}
+        if state:
+            try:
+                self.estimates.update(json.loads(state))
+            except ValueError:
+                logging.warning('Ignoring unreadable lag state: {0}'.format(state))
+
+        self.cycle = None  # [switch time, key, target, extreme]
+
+    @property
+    def above(self):
+        return self.estimates['above'][0]
+
+    @property
+    def below(self):
+        return self.estimates['below'][0]
+
+    def confidence(self, key):
+        """
+        :param key: 'above' or 'below'
+        :return: (standard deviation, number of cycles) of the estimate
+        """
+        mean, variance, n = self.estimates[key]
+        return np.sqrt(variance), n
+
+    def state(self):
+        return json.dumps({k: [round(m, 4), round(v, 4), n] for k, (m, v, n) in self.estimates.items()},
+                          separators=(',', ':'), sort_keys=True)
+
+    def switch(self, now, on, target):
+        """
+        The heat was switched at <now>; start tracking the new cycle.
+        :param now: datetime
+        :param on: True if the heat was turned on
+        :param target: switching target the zone temperature was compared with, or None if not switched on a target
+        :return: True if the previous cycle, cut short by this switch, updated an estimate
+        """
+        updated = self.finish()
+        if target is not None:
+            self.cycle = [now, 'below' if on else 'above', float(target), None]
+        return updated
+
+    def observe(self, now, temperature):
+        """
+        :param now: datetime
+        :param temperature: zone temperature at <now>
+        :return: True if a cycle completed and updated an estimate
+        """
+        if self.cycle is None:
+            return False
+
+        start, key, target, extreme = self.cycle
+        if now - start > self.window:
+            return self.finish()
+
+        if extreme is None or (key == 'above' and temperature > extreme) or (key == 'below' and temperature < extreme):
+            self.cycle[3] = temperature
+        return False
+
+    def finish(self):
+        if self.cycle is None:
+            return False
+
+        start, key, target, extreme = self.cycle
+        self.cycle = None
+        if extreme is None:
+            return False
+
+        return self.update(key, extreme - target)
+
+    def update(self, key, overshoot):
+        """
+        :param key: 'above' or 'below'
+        :param overshoot: extreme temperature minus the switching target of one cycle
+        :return: True if the estimate was updated
+        """
+        mean, variance, n = self.estimates[key]
+        delta = overshoot - mean
+
+        if n >= 5 and variance > 0 and abs(delta) > self.outlier * np.sqrt(variance):
+            logging.info('Ignoring outlying {0} overshoot of {1:.2f}.'.format(key, overshoot))
+            return False
+
+        # the prior counts as one cycle, so the first cycles are not swamped by it
+        alpha = max(self.alpha, 1. / (n + 2))
+        mean += alpha * delta
+        variance = (1 - alpha) * (variance + alpha * delta ** 2)
+        self.estimates[key] = [mean, variance, n + 1]
+
+        logging.debug('Updated {0} overshoot to {1:.2f} (+/- {2:.2f}) after {3} cycles.'.format(
+            key, mean, np.sqrt(variance), n + 1))
+        return True
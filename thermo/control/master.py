@@ -1,14 +1,21 @@
+import signal
 import time
 
 import RPi.GPIO as GPIO
 
 from thermo import local_settings
+from thermo.common import events, notify, retention
+from thermo.common.journal import journal
+from thermo.common.metrics import SETTINGS as METRICS, MetricsServer, SummaryWriter, metrics
+from thermo.common.profiler import PROFILE_PATH, SamplingProfiler
 from thermo.common.models import *
 from thermo.control import thermostat
+from thermo.control.scheduler import Scheduler
+from thermo.control.zones import ZoneControllers
 from thermo.sensor import thermal
 
 
-def main(available_actions, available_sensors, structs, **kwargs):
+def sense(available_sensors, **kwargs):
     # Assume all sensors are thermal for now
     # Check thermal sensors:
     try:
@@ -23,59 +30,111 @@ def main(available_actions, available_sensors, structs, **kwargs):
         logging.error('thermal.main error')
         logging.exception(e)
 
+
+def control(controllers, **kwargs):
+    # Check thermostat / HVAC of every zone:
+    controllers.run(verbosity=kwargs.get('verbosity', 0), timeout=kwargs.get('timeout', None))
+
+
+def persist():
+    # rows that could not reach the remote database are journaled, and only replayed here
     try:
-        clean_old_temps_from_local()
+        if journal.pending():
+            journal.replay()
     except Exception as e:
-        logging.error('Encountered an error while removing old temperatures from the local db.')
+        logging.error('Encountered an error while replaying the journal.')
         logging.exception(e)
 
-    for a in available_actions:
-        if a.name == 'HEAT':
-            # Check thermostat / HVAC:
-            try:
-                thermostat.main(structs['HVAC'], verbosity=kwargs.get('verbosity', 0))
-            except Exception as e:
-                logging.error('Uncaught exception in thermostat.main.')
-                structs['HVAC'].turn_heat_off()
-                logging.exception(e)
+    try:
+        retention.local_pruner.prune()  # only deletes when the last prune was long enough ago
+    except Exception as e:
+        logging.error('Encountered an error while removing old temperatures from the local db.')
+        logging.exception(e)
 
 
 @fallback_locally
-def setup(local=False, **kwargs):
-    # Get all available actions and sensors for this unit
-
+def load_config(local=False):
+    """
+    Get all available actions and sensors for this unit
+    :param local: Use the local SQLite database if true
+    :return: (this unit's sensors, every sensor of the user, this unit's actions)
+    """
     session = get_session(local=local)
-    unit = session.query(Unit).filter(Unit.user == local_settings.USER_NUMBER).filter(
+    unit = session.query(Unit.id).filter(Unit.user == local_settings.USER_NUMBER).filter(
         Unit.id == local_settings.UNIT_NUMBER).all()
 
     if len(unit) > 1:
         logging.error('Non-unique unit and user combination')
         raise Exception('Non-unique unit and user combination')
+    elif len(unit) == 0:
+        raise Exception('Unit {0} not found.'.format(local_settings.UNIT_NUMBER))
 
-    unit = unit[0]
-
-    available_sensors = unit.sensors
-    available_actions = unit.actions
+    sensors = session.query(Sensor).filter(Sensor.user == local_settings.USER_NUMBER).all()
+    actions = session.query(Action).filter(Action.unit == local_settings.UNIT_NUMBER).all()
     session.close()
 
-    structs = {}
-    for i in range(len(available_actions)):
-        a = available_actions[i]
-        logging.debug('Action %s' % a.name)
+    return [s for s in sensors if s.unit == local_settings.UNIT_NUMBER], sensors, actions
+
+
+SENSOR_FIELDS = ('serial_number', 'location', 'user', 'unit', 'zone', 'indoors', 'bias')
+ACTION_FIELDS = ('name', 'unit', 'zone', 'enabled')
+
+
+def snapshot(rows, fields):
+    return {row.id: tuple(getattr(row, f) for f in fields) for row in rows}
+
+
+def log_changes(kind, old, new):
+    for i in sorted(set(new) - set(old)):
+        logging.info('Added {0} {1}: {2}'.format(kind, i, new[i]))
+    for i in sorted(set(old) - set(new)):
+        logging.info('Removed {0} {1}.'.format(kind, i))
+    for i in sorted(set(old) & set(new)):
+        if old[i] != new[i]:
+            logging.info('Changed {0} {1}: {2} -> {3}'.format(kind, i, old[i], new[i]))
+
+
+class ConfigWatcher(object):
+    def __init__(self, log=True):
+        """
+        This unit's sensors and actions, and the controllers of its zones. Each refresh compares the configuration in
+        the database with the last one seen and only applies what changed, so a controller (and its schedule, lags and
+        cached state) is kept for as long as its action is.
 
-        if a.enabled == False:
-            logging.debug('Action disabled.')
-            del available_actions[i]
-            continue
+        :param log: passed to the controllers
+        """
+        self.sensors = []  # this unit's sensors
+        self.actions = []  # this unit's enabled actions
+        self.controllers = ZoneControllers(log=log)
 
-        if a.name == 'HEAT':
-            structs['HVAC'] = thermostat.HVAC(a.zone, log=kwargs.get('log', True),
-                                              schedule=kwargs.get('schedule', None))
-            if kwargs.get('initial', False):
-                logging.debug('Testing relays for HVAC.')
-                structs['HVAC'].cycle_relays()
+        self.sensor_snapshot = {}
+        self.action_snapshot = {}
 
-    return available_actions, available_sensors, structs
+    def refresh(self, initial=False):
+        """
+        :param initial: test the relays of newly created controllers
+        :return: True if the configuration changed
+        """
+        local_sensors, all_sensors, actions = load_config()
+        sensor_snapshot = snapshot(all_sensors, SENSOR_FIELDS)
+        action_snapshot = snapshot(actions, ACTION_FIELDS)
+
+        sensors_changed = sensor_snapshot != self.sensor_snapshot
+        actions_changed = action_snapshot != self.action_snapshot
+        if not sensors_changed and not actions_changed:
+            return False
+
+        log_changes('sensor', self.sensor_snapshot, sensor_snapshot)
+        log_changes('action', self.action_snapshot, action_snapshot)
+
+        self.sensors = local_sensors
+        self.actions = [a for a in actions if a.enabled != False]
+
+        self.controllers.sync(self.actions, local_sensors, all_sensors, sensors_changed=sensors_changed,
+                              initial=initial)
+
+        self.sensor_snapshot, self.action_snapshot = sensor_snapshot, action_snapshot
+        return True
 
 
 if __name__ == '__main__':
@@ -88,6 +147,15 @@ if __name__ == '__main__':
     parser.add_argument('--sleep', default=10, type=int)
     parser.add_argument('--boot-sleep', default=0, type=int)
     parser.add_argument('--validate', default=1, type=int)
+    parser.add_argument('--control-offset', default=3., type=float,
+                        help='seconds between the start of each sensor sweep and the following control decision')
+    parser.add_argument('--profile', default=0, type=int, metavar='TICKS',
+                        help='profile the first TICKS control ticks, write the results to --profile-path and exit')
+    parser.add_argument('--profile-path', default=PROFILE_PATH,
+                        help='path and start of the file names of the profiles')
+    parser.add_argument('--profile-interval', default=0.01, type=float, help='seconds between profiler samples')
+    parser.add_argument('--profile-idle', default=False, action='store_true',
+                        help='keep the samples of threads that are waiting')
 
     args = parser.parse_args()
 
@@ -102,35 +170,95 @@ if __name__ == '__main__':
 
     # This is done as a precaution to avoid a runaway furnace. In the event that an uncaught exception causes thermoPi
     # to crash, it is possible that the furnace relay will be in the 'on' position. The script, upon restarting, may
-    # not be able to resume the thermostat control program. This block ensures that the heat relay is switched off
-    # in such a circumstance.
-    if 'HEAT' in local_settings.GPIO_PINS:
-        GPIO.setmode(local_settings.GPIO_MODE)
+    # not be able to resume the thermostat control program. This block ensures that the heat relay (and every other
+    # relay of every zone) is switched off in such a circumstance.
+    GPIO.setmode(local_settings.GPIO_MODE)
+    for pin in thermostat.relay_pins():
         GPIO.setwarnings(False)
-        GPIO.setup(local_settings.GPIO_PINS['HEAT'], GPIO.OUT)
+        GPIO.setup(pin, GPIO.OUT)
         GPIO.setwarnings(True)
-        GPIO.output(local_settings.GPIO_PINS['HEAT'], GPIO.LOW)
+        GPIO.output(pin, GPIO.LOW)
 
     logging.debug('Updating available actions and sensors.')
 
-    available_actions, available_sensors, structs = setup(log=log, verbosity=verbosity, initial=True)
+    config = ConfigWatcher(log=log)
+    config.refresh(initial=True)
+
+    # Sensing, control, persistence and configuration run as independent periodic tasks, so that a slow sensor sweep
+    # or database write cannot hold up the relay decision. Control runs a few seconds after each sweep has started, by
+    # which time the sweep's readings are in the hot tier.
+    scheduler = Scheduler()
+    profiler = SamplingProfiler(interval=args.profile_interval, idle=args.profile_idle)
+
+    def control_tick():
+        control(config.controllers, verbosity=verbosity, timeout=sleep / 2.)
+        if profiler.tick():
+            profiler.write(args.profile_path)
+            if args.profile:
+                scheduler.stopping.set()  # run_forever returns and stops the tasks
+
+    scheduler.add('sense', lambda: sense(config.sensors, verbosity=verbosity, validate=validate),
+                  interval=sleep, deadline=getattr(local_settings, 'SENSOR_SWEEP_TIMEOUT', 2.) + 1.)
+    scheduler.add('control', control_tick, interval=sleep, deadline=2., offset=min(args.control_offset, sleep / 2.))
+    scheduler.add('persist', persist, interval=60, offset=30)
+    scheduler.add('config', config.refresh, interval=max(60, sleep), offset=60)
+
+    # Counters and timings of the loop are served in the Prometheus text format, and summarized to a rotating file
+    metrics.add_collector(scheduler.metrics)
+    metrics_server = None
+    if METRICS['port']:
+        metrics_server = MetricsServer()
+        try:
+            metrics_server.start()
+        except Exception as e:
+            logging.error('Could not serve metrics on port {0}.'.format(METRICS['port']))
+            logging.exception(e)
+            metrics_server = None
 
-    i = 0
-    while True:
-        i += 1
+    if METRICS['summary_path']:
+        summary = SummaryWriter()
+        scheduler.add('metrics', summary.write, interval=METRICS['summary_interval'],
+                      offset=METRICS['summary_interval'])
 
-        if i % (60 / sleep) == 0 or sleep > 60:  # update available sensors and actions every minute
+    # Messages from the web UI (e.g. temperature overrides) are applied as soon as they arrive, and trigger the control
+    # task so that the relay decision is made straight away instead of at its next scheduled run.
+    def on_notification(message):
+        if message.get('type') == 'action changed':
+            if message.get('user') == local_settings.USER_NUMBER:
+                scheduler.trigger('config')
+            return
 
-            logging.debug('Updating available actions and sensors.')
-            try:
-                schedule = structs['HVAC'].schedule  # pass the existing schedule to HVAC if it is set
-            except:
-                schedule = None  # default, otherwise
+        config.controllers.handle_notification(message)
+        scheduler.trigger('control')
 
-            try:
-                available_actions, available_sensors, structs = setup(log=log, verbosity=verbosity, schedule=schedule)
-            except:
-                pass
+    # Sensor batches and relay changes are forwarded to the web UI for its live stream
+    events.publisher.add_listener(lambda event: notify.send(notify.EVENT_SOCKET, event, get_api_key()))
 
-        main(available_actions, available_sensors, structs, log=log, verbosity=verbosity, validate=validate)
-        time.sleep(sleep)
+    # SIGUSR1 (`kill -USR1 <pid>`) writes what the profiler has sampled so far, or, when it is not running, profiles
+    # the next ticks the same way as --profile without stopping afterwards
+    def on_profile_signal(signum, frame):
+        if profiler.running:
+            profiler.write(args.profile_path)
+        else:
+            profiler.start(ticks=args.profile or 30)
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, on_profile_signal)
+
+    if args.profile:
+        profiler.start(ticks=args.profile)
+
+    listener = notify.Listener(notify.CONTROL_SOCKET, on_notification, get_api_key)
+    try:
+        listener.start()
+    except Exception as e:
+        logging.error('Could not listen for notifications from the web UI.')
+        logging.exception(e)
+
+    try:
+        scheduler.run_forever()
+    finally:
+        listener.stop()
+        config.controllers.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
@@ -0,0 +1,203 @@
+import logging
+import math
+import threading
+import time
+
+# time.monotonic is not available on Python 2, where the schedule follows the wall clock instead. The tasks then
+# reschedule themselves when the clock is set, e.g. by NTP shortly after boot.
+monotonic = getattr(time, 'monotonic', time.time)
+# a task that wakes up later than this many intervals assumes that the clock was set forward
+CLOCK_JUMP_INTERVALS = 3
+
+
+def wait(event, timeout, step=0.05):
+    """
+    Wait up to <timeout> seconds for <event>, like Event.wait. Python 2's Event.wait follows the wall clock and would
+    wait for as long as the clock was set back, so there the wait sleeps in short steps and ends early instead.
+    :return: True if the event was set
+    """
+    if hasattr(time, 'monotonic'):
+        return event.wait(timeout)
+
+    start = monotonic()
+    while not event.is_set():
+        elapsed = monotonic() - start
+        if elapsed < 0 or elapsed >= timeout:
+            return event.is_set()
+        time.sleep(min(timeout - elapsed, step))
+    return True
+
+
+class PeriodicTask(object):
+    def __init__(self, name, function, interval, deadline=None, offset=0.):
+        """
+        A function called every <interval> seconds on its own thread.
+
+        Runs are scheduled at a fixed rate from the task's start (start + offset + n * interval), so the period does not
+        drift by the time each run takes. A run that takes longer than <deadline> is reported as an overrun; runs that
+        would already be late when the previous one finishes are skipped rather than run back to back.
+
+        :param name:
+        :param function: called without arguments
+        :param interval: seconds between the starts of consecutive runs
+        :param deadline: seconds a run may take, defaults to <interval>
+        :param offset: seconds after the scheduler starts before the first run
+        """
+        self.name = name
+        self.function = function
+        self.interval = float(interval)
+        self.deadline = float(deadline if deadline is not None else interval)
+        self.offset = float(offset)
+
+        self.wake = threading.Event()
+        self.thread = None
+
+        self.runs = 0
+        self.failures = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.last_duration = None
+        self.max_duration = 0.
+        self.last_lateness = 0.
+
+    def trigger(self):
+        """
+        Run the task as soon as possible, without waiting for its next scheduled time. Later runs keep their schedule.
+        """
+        self.wake.set()
+
+    def run_once(self):
+        start = monotonic()
+        try:
+            self.function()
+        except Exception as e:
+            self.failures += 1
+            logging.error('Task {0} failed.'.format(self.name))
+            logging.exception(e)
+        finally:
+            duration = max(monotonic() - start, 0.)  # negative if the clock was set back during the run
+            self.runs += 1
+            self.last_duration = duration
+            self.max_duration = max(self.max_duration, duration)
+
+            if duration > self.deadline:
+                self.overruns += 1
+                logging.warning('Task {0} overran its {1:.2f} s deadline: {2:.2f} s.'.format(
+                    self.name, self.deadline, duration))
+
+    def loop(self, start, stop):
+        next_run = start + self.offset
+        while not stop.is_set():
+            delay = next_run - monotonic()
+            if delay > max(self.interval, self.offset):
+                # a wait is never longer than an interval (or the first run's offset), unless the clock was set back
+                logging.warning('Clock set back by over {0:.0f} s, rescheduling task {1}.'.format(
+                    delay - max(self.interval, self.offset), self.name))
+                next_run = monotonic()
+                delay = 0.
+
+            triggered = False
+            if delay > 0:
+                triggered = wait(self.wake, delay)
+                self.wake.clear()
+                if stop.is_set():
+                    return
+                if not triggered and next_run - monotonic() > 0:
+                    continue  # woken early by the clock being set back
+
+            lateness = 0. if triggered else max(monotonic() - next_run, 0.)
+            if lateness > CLOCK_JUMP_INTERVALS * self.interval:
+                logging.warning('Clock set forward by {0:.0f} s, rescheduling task {1}.'.format(lateness, self.name))
+                next_run, lateness = monotonic(), 0.
+
+            self.last_lateness = lateness
+            self.run_once()
+
+            if triggered and monotonic() < next_run:
+                continue  # an extra run; the scheduled one still follows
+
+            next_run += self.interval
+            now = monotonic()
+            if now >= next_run:
+                missed = int(math.floor((now - next_run) / self.interval)) + 1
+                self.skipped += missed
+                next_run += missed * self.interval
+                logging.warning('Task {0} fell behind, skipping {1} run(s).'.format(self.name, missed))
+
+    def status(self):
+        return {
+            'interval': self.interval,
+            'deadline': self.deadline,
+            'runs': self.runs,
+            'failures': self.failures,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'last_duration': self.last_duration,
+            'max_duration': self.max_duration,
+            'last_lateness': self.last_lateness,
+        }
+
+
+class Scheduler(object):
+    def __init__(self):
+        """
+        Runs PeriodicTasks independently of one another, each on its own thread, so that a slow task (a sensor sweep,
+        a database write) does not hold up the others.
+        """
+        self.tasks = {}
+        self.stopping = threading.Event()
+
+    def add(self, name, function, interval, deadline=None, offset=0.):
+        """
+        :return: the PeriodicTask
+        """
+        task = PeriodicTask(name, function, interval, deadline=deadline, offset=offset)
+        self.tasks[name] = task
+        return task
+
+    def trigger(self, name):
+        if name in self.tasks:
+            self.tasks[name].trigger()
+
+    def start(self):
+        start = monotonic()
+        for task in self.tasks.values():
+            task.thread = threading.Thread(target=task.loop, args=(start, self.stopping), name='task-' + task.name)
+            task.thread.daemon = True
+            task.thread.start()
+
+    def stop(self, timeout=5.):
+        self.stopping.set()
+        for task in self.tasks.values():
+            task.wake.set()
+        for task in self.tasks.values():
+            if task.thread is not None:
+                task.thread.join(timeout)
+
+    def run_forever(self):
+        """
+        Start the tasks and block until stop() is called or the process is interrupted
+        """
+        self.start()
+        try:
+            # wait in short steps; on Python 2 an untimed wait cannot be interrupted by signals
+            while not self.stopping.wait(1.):
+                pass
+        finally:
+            self.stop()
+
+    def status(self):
+        return {name: task.status() for name, task in self.tasks.items()}
+
+    def metrics(self):
+        """
+        :return: the tasks' counters and durations as samples for thermo.common.metrics
+        """
+        samples = []
+        for name, status in self.status().items():
+            labels = {'task': name}
+            for key in ('runs', 'failures', 'overruns', 'skipped'):
+                samples.append(('task_{0}_total'.format(key), 'counter', labels, status[key]))
+            for key in ('last_duration', 'max_duration', 'last_lateness', 'deadline'):
+                samples.append(('task_{0}_seconds'.format(key), 'gauge', labels, status[key]))
+        return samples
@@ -1,23 +1,148 @@
+import hashlib
 import json
+import threading
 import time
 from datetime import datetime, timedelta
 
 import RPi.GPIO as GPIO
 import numpy as np
-import pandas as pd
 from sqlalchemy import func
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import DBAPIError, OperationalError
 
 from thermo import local_settings
+from thermo.common.events import publisher
+from thermo.common.journal import write_rows
+from thermo.common.metrics import metrics
 from thermo.common.models import *
+from thermo.control.lag import LagLearner, overshoot, zone_series
+from thermo.control.timeline import CompiledSchedule
+from thermo.sensor.recent import recent_temperatures, POWER_ON_RESET_VALUE
 from thermo.sensor.thermal import read_temp_sensor
 
 
-class HVAC():
+def relay_pin(name, zone):
+    """
+    GPIO pin of an action's relay. GPIO_PINS maps each action name to a pin, or, on a unit that controls several
+    zones, to a {zone: pin} dict.
+    :param name: action name, e.g. 'HEAT'
+    :param zone: zone id
+    :return: pin number, or None if the unit has no relay for the action in the zone
+    """
+    pins = local_settings.GPIO_PINS.get(name)
+    if isinstance(pins, dict):
+        return pins.get(zone)
+    return pins
+
+
+def relay_pins():
+    """
+    :return: every relay pin in GPIO_PINS
+    """
+    pins = []
+    for value in local_settings.GPIO_PINS.values():
+        pins.extend(value.values() if isinstance(value, dict) else [value])
+    return pins
+
+
+@fallback_locally
+def get_action_id(unit, name, zone, local=False):
+    session = get_session(local=local)
+    results = session.query(Action) \
+        .filter(Action.unit == unit) \
+        .filter(Action.name == name) \
+        .filter(Action.zone == zone) \
+        .all()
+    session.close()
+    if len(results) == 1:
+        action_id = results[0].id
+    else:
+        action_id = None
+        logging.warning('Could not resolve action ID, action logging is disabled!')
+
+    return action_id
+
+
+class SharedTemperatures(object):
+    def __init__(self, user, max_age=5.):
+        """
+        Recent temperatures of every zone controlled by this unit, read from the database with one query and shared by
+        the zones' controllers, so that zones deciding at the same time do not each query the database.
+
+        :param user: user id
+        :param max_age: seconds a query result is reused for
+        """
+        self.user = user
+        self.max_age = max_age
+        self.zones = set()
+        self.cache = {}  # minutes: (time of the query, {zone: {location: temperature}})
+        self.lock = threading.Lock()
+
+    def watch(self, zones):
+        """
+        :param zones: the zones to query, so that the first query already covers all of them
+        """
+        with self.lock:
+            self.zones = set(zones)
+            self.cache.clear()
+
+    def get(self, zone, minutes=1):
+        """
+        :param zone: zone id; it is included in every later query
+        :param minutes:
+        :return: {location: temperature}
+        """
+        with self.lock:
+            self.zones.add(zone)
+            queried, temperatures = self.cache.get(minutes, (None, {}))
+            if queried is None or time.time() - queried > self.max_age or zone not in temperatures:
+                temperatures = self.query(sorted(self.zones), minutes=minutes)
+                self.cache[minutes] = (time.time(), temperatures)
+
+        return dict(temperatures.get(zone, {}))
+
     @fallback_locally
-    def __init__(self, zone, log=True, schedule=None, local=False):
+    def query(self, zones, minutes=1, local=False):
+        """
+        Get the average temperature over the past <minutes> minutes for each location in <zones>
+        :return: {zone: {location: temperature}}, with an entry for each of <zones>
+        """
+        session = get_session(local=local)
+        indoor_temperatures = session.query(
+            Sensor.zone,
+            Temperature.location,
+            func.sum(Temperature.value - Sensor.bias) / func.count(Temperature.value)
+        ) \
+            .filter(Temperature.record_time > datetime.now() - timedelta(minutes=minutes)) \
+            .filter(Temperature.value != POWER_ON_RESET_VALUE) \
+            .join(Sensor) \
+            .filter(Sensor.user == self.user) \
+            .filter(Sensor.zone.in_(zones)) \
+            .group_by(Sensor.zone, Temperature.location) \
+            .all()
+        session.close()
 
+        temperatures = {zone: {} for zone in zones}
+        for zone, location, temp in indoor_temperatures:
+            temperatures[zone][location] = float(temp)
+        return temperatures
+
+
+class HVAC():
+    # The action this class controls. DIRECTION is 1 if running it raises the temperature, -1 if it lowers it.
+    ACTION = 'HEAT'
+    DIRECTION = 1
+
+    @fallback_locally
+    def __init__(self, zone, log=True, schedule=None, temperatures=None, local=False):
+        """
+        Controls the heating relay of a zone.
+        :param zone: zone id
+        :param log: log relay changes to the action_log table
+        :param schedule: Schedule, loaded for the zone if None
+        :param temperatures: SharedTemperatures to read the zone's recent temperatures from, instead of querying them
+        """
         self.log = log
+        self.temperatures = temperatures
         self.zone = zone
 
         GPIO.setmode(local_settings.GPIO_MODE)
@@ -29,6 +154,8 @@ class HVAC():
             session = get_session(local=local)
             local_sensors = session.query(Sensor).filter(Sensor.unit == self.unit).filter(
                 Sensor.user == self.user).all()
+            zone_sensors = session.query(Sensor).filter(Sensor.zone == self.zone).filter(
+                Sensor.user == self.user).all()
             session.close()
         except:
             local_sensors = [Sensor(
@@ -38,46 +165,30 @@ class HVAC():
                 location=local_settings.FALLBACK['LOCATION'],
                 indoors=True
             )]
+            zone_sensors = None
 
-        self.fallback_sensors = [(s.location, s.serial_number) for s in local_sensors if s.indoors == True]
-        if len(self.fallback_sensors) == 0:
-            logging.warning('No local backup sensors available.')
-
-        if 'HEAT' in local_settings.GPIO_PINS:
-            self.heat_pin = local_settings.GPIO_PINS['HEAT']
+        self.set_sensors(local_sensors, zone_sensors)
 
+        # heat_pin and heat_action_id are the relay and action of ACTION, which is cooling in Cooling
+        self.heat_pin = relay_pin(self.ACTION, self.zone)
+        if self.heat_pin is not None:
             GPIO.setwarnings(False)
             GPIO.setup(self.heat_pin, GPIO.OUT)
             GPIO.setwarnings(True)
 
-            @fallback_locally
-            def get_action_id(local=False):
-                session = get_session(local=local)
-                results = session.query(Action) \
-                    .filter(Action.unit == self.unit) \
-                    .filter(Action.name == 'HEAT') \
-                    .all()
-                session.close()
-                if len(results) == 1:
-                    heat_action_id = results[0].id
-                else:
-                    heat_action_id = None
-                    logging.warning('Could not resolve action ID, action logging is disabled!')
-
-                return heat_action_id
-
             try:
-                self.heat_action_id = get_action_id()
+                self.heat_action_id = get_action_id(self.unit, self.ACTION, self.zone)
             except OperationalError:
                 time.sleep(5)  # possible network interruption, try again in 5 seconds
                 try:
-                    self.heat_action_id = get_action_id()
+                    self.heat_action_id = get_action_id(self.unit, self.ACTION, self.zone)
                 except Exception as e:
                     raise (e)
 
         else:
-            logging.error('No configuration for heating found in thermo.common.local_settings.py')
-            raise Exception('No configuration for heating found in thermo.common.local_settings.py')
+            message = 'No {0} pin for zone {1} found in thermo.common.local_settings.py'.format(self.ACTION, self.zone)
+            logging.error(message)
+            raise Exception(message)
 
         try:
             self.heat_relay_is_on()
@@ -92,83 +203,171 @@ class HVAC():
         else:
             self.schedule = Schedule(self.zone)
 
+    def set_sensors(self, local_sensors, zone_sensors):
+        """
+        :param local_sensors: sensors attached to this unit, used as fallbacks when recent temperatures are unavailable
+        :param zone_sensors: sensors of this HVAC's zone, from every unit, or None if unknown
+        """
+        self.fallback_sensors = [(s.location, s.serial_number) for s in local_sensors if s.indoors == True]
+        if len(self.fallback_sensors) == 0:
+            logging.warning('No local backup sensors available.')
+
+        # Recent temperatures are read from the in-process hot tier when every sensor in the zone is attached to this
+        # unit. Zones that span several units still need the database to see the other units' readings.
+        if zone_sensors is None:
+            self.zone_is_local = False
+        else:
+            self.zone_is_local = all([s.unit == self.unit for s in zone_sensors])
+
     @fallback_locally
     def retrieve_lags(self, local=False):
+        lag_state = None
         try:
             session = get_session(local=local)
             action = session.query(Action).filter(Action.id == self.heat_action_id).all()[0]
-            self.heat_off_lag, self.heat_on_lag = action.expected_overshoot_above, action.expected_overshoot_below
+            above, below = action.expected_overshoot_above, action.expected_overshoot_below
+            try:
+                lag_state = action.lag_state
+            except DBAPIError:
+                logging.warning('No lag_state column in the action table; lag estimates will restart from the '
+                                'expected overshoots.')
             session.close()
         except:
-            self.heat_off_lag, self.heat_on_lag = 0., 0.
+            above, below = 0., 0.
 
-    @duplicate_locally
-    def update_lags(self, num_recent_actions=2, overwrite=False, local=False):
-        above, below = self.check_recent_lag(num_recent_actions=num_recent_actions)
-        session = get_session(local=local)
-        action = session.query(Action).filter(Action.id == self.heat_action_id).all()[0]
-        if overwrite:
-            action.expected_overshoot_above = float(above)
-            action.expected_overshoot_below = float(below)
+        self.lag_learner = LagLearner(above, below, state=lag_state, **getattr(local_settings, 'LAG_LEARNER', {}))
+        self.use_learned_lags()
+
+    def use_learned_lags(self):
+        """
+        Set the lags from the learner's overshoot estimates. The overshoot above the target follows turning heating
+        off, but turning cooling on.
+        """
+        if self.DIRECTION > 0:
+            self.heat_off_lag, self.heat_on_lag = self.lag_learner.above, self.lag_learner.below
         else:
-            action.expected_overshoot_above += float(above)
-            action.expected_overshoot_below += float(below)
-        session.commit()
+            self.heat_off_lag, self.heat_on_lag = self.lag_learner.below, self.lag_learner.above
 
-        self.heat_off_lag, self.heat_on_lag = action.expected_overshoot_above, action.expected_overshoot_below
-        session.close()
+    @duplicate_locally
+    def save_lags(self, local=False):
+        """
+        Store the learned lags (and the learner's state) on this HVAC's heat action
+        """
+        table = Action.__table__
+        values = {
+            'expected_overshoot_above': float(self.lag_learner.above),
+            'expected_overshoot_below': float(self.lag_learner.below),
+            'lag_state': self.lag_learner.state(),
+        }
+
+        engine = get_engine(local=local)
+        try:
+            engine.execute(table.update().where(table.c.id == self.heat_action_id).values(**values))
+        except DBAPIError:
+            del values['lag_state']  # database created before the column was added
+            engine.execute(table.update().where(table.c.id == self.heat_action_id).values(**values))
+
+    def learn_lags(self, now, temp):
+        """
+        Feed the zone temperature to the lag learner, and use and store its estimates when a heat cycle completes
+        """
+        if self.lag_learner.observe(now, temp):
+            self.use_learned_lags()
+            self.save_lags()
+
+    def update_lags(self, num_recent_actions=10, since=None):
+        """
+        Re-estimate the lags from the recorded history of the most recent actions, replacing the learned estimates
+        :param num_recent_actions:
+        :param since: datetime; when given, every action after it is used instead
+        :return: heat off lag, heat on lag
+        """
+        above, below = self.check_recent_lag(num_recent_actions=num_recent_actions, since=since)
+        if np.isnan(above) or np.isnan(below):
+            logging.warning('Not enough history to estimate the lags.')
+            return self.heat_off_lag, self.heat_on_lag
+
+        self.lag_learner = LagLearner(above, below, alpha=self.lag_learner.alpha,
+                                      minutes=self.lag_learner.window.total_seconds() / 60.,
+                                      outlier=self.lag_learner.outlier)
+        self.use_learned_lags()
+        self.save_lags()
 
         return self.heat_off_lag, self.heat_on_lag
 
     def temps_to_heat(self, target, temp, verbose=False, buffer=1.):
+        self.learn_lags(datetime.now(), temp)
+        direction = self.DIRECTION
+        name = self.ACTION.lower()
 
         if self.heat_relay_is_on():
-            target += buffer
+            target += direction * buffer
             target -= self.heat_off_lag  # turn off the heat a little early (target lower) to max out at the right temp
 
         else:
-            target -= buffer
+            target -= direction * buffer
             target -= self.heat_on_lag  # turn on the heat a little early (target higher, heat_on_lag is negative) to bottom out at the right temp
 
-        if temp < target and not self.heat_relay_is_on():
-            logging.info("%s vs target %s. Turning heat on." % (temp, target))
+        # for cooling the lags have the opposite signs, and the relay is on while the temperature is above the target
+        if direction * (target - temp) > 0 and not self.heat_relay_is_on():
+            logging.info("%s vs target %s. Turning %s on." % (temp, target, name))
             self.turn_heat_on(target=target)
 
-        elif temp >= target and self.heat_relay_is_on():
-            logging.info("%s vs target %s. Turning heat off." % (temp, target))
+        elif direction * (target - temp) <= 0 and self.heat_relay_is_on():
+            logging.info("%s vs target %s. Turning %s off." % (temp, target, name))
             self.turn_heat_off(target=target)
 
         else:
             logging.info('Target: %.2f, Measured: %.2f' % (target, temp))
 
-    @duplicate_locally
-    def log_action(self, action, value, target=None, local=False):
+    def log_action(self, action, value, target=None):
         if self.log == False:
             return
 
         elif self.heat_action_id is not None:
-            session = get_session(local=local)
+            row = {
+                'action': action,
+                'value': value,
+                'record_time': datetime.now(),
+                'target': float(target) if target is not None else None,
+            }
             try:
-                new_action = ActionLog(action=action, value=value, record_time=datetime.now(), target=float(target))
-                session.add(new_action)
-                session.commit()
+                write_rows(ActionLog.__table__, [row])
             except Exception as e:
-                session.rollback()
-            finally:
-                session.close()
+                logging.error('Failed to log action.')
+                logging.exception(e)
 
     def turn_heat_on(self, **kwargs):
-        logging.info('Turning heat on.')
-        GPIO.output(self.heat_pin, GPIO.HIGH)
+        logging.info('Turning %s on.' % self.ACTION.lower())
+        with metrics.timer('gpio_seconds', operation='output'):
+            GPIO.output(self.heat_pin, GPIO.HIGH)
+        metrics.increment('relay_switches_total', action=self.ACTION, zone=self.zone, state='on')
+        self.publish_action(self.ACTION, True, kwargs.get('target', None))
+        # the learner's cycles are those of heating: switching cooling on is followed by a rise, as heating off is
+        if self.lag_learner.switch(datetime.now(), True == (self.DIRECTION > 0), kwargs.get('target', None)):
+            self.use_learned_lags()
+            self.save_lags()
         self.log_action(self.heat_action_id, 1, target=kwargs.get('target', None))
 
     def turn_heat_off(self, **kwargs):
-        logging.info('Turning heat off.')
-        GPIO.output(self.heat_pin, GPIO.LOW)
+        logging.info('Turning %s off.' % self.ACTION.lower())
+        with metrics.timer('gpio_seconds', operation='output'):
+            GPIO.output(self.heat_pin, GPIO.LOW)
+        metrics.increment('relay_switches_total', action=self.ACTION, zone=self.zone, state='off')
+        self.publish_action(self.ACTION, False, kwargs.get('target', None))
+        # the learner's cycles are those of heating: switching cooling on is followed by a rise, as heating off is
+        if self.lag_learner.switch(datetime.now(), False == (self.DIRECTION > 0), kwargs.get('target', None)):
+            self.use_learned_lags()
+            self.save_lags()
         self.log_action(self.heat_action_id, 0, target=kwargs.get('target', None))
 
+    def publish_action(self, name, on, target):
+        publisher.publish({'type': 'relay', 'time': datetime.now().isoformat(), 'zone': self.zone, 'action': name,
+                           'on': on, 'target': float(target) if target is not None else None})
+
     def heat_relay_is_on(self):
-        return GPIO.input(self.heat_pin) == 1
+        with metrics.timer('gpio_seconds', operation='input'):
+            return GPIO.input(self.heat_pin) == 1
 
     def cycle_relays(self):
 
@@ -193,8 +392,36 @@ class HVAC():
             except AssertionError:
                 logging.error("Heating relay check failed, did you assign the correct GPIO heat_pin?")
 
+    def check_recent_temperature(self, minutes=1, verbose=False):
+        """
+        Get the average temperature over the past <minutes> minutes for each location in the zone, from the hot tier
+        when it covers the zone, otherwise from the database.
+        :param minutes:
+        :param verbose:
+        :return: {location: temperature}
+        """
+        room_temps = {}
+        if self.zone_is_local:
+            with metrics.timer('recent_temperature_seconds', source='hot_tier'):
+                room_temps = recent_temperatures.averages(self.user, self.zone, minutes=minutes)
+            logging.info('Reading temperatures from hot tier.')
+
+        if len(room_temps) == 0:
+            with metrics.timer('recent_temperature_seconds', source='database'):
+                if self.temperatures is not None:
+                    room_temps = self.temperatures.get(self.zone, minutes=minutes)
+                else:
+                    room_temps = self.query_recent_temperature(minutes=minutes)
+            logging.info('Reading temperatures from database.')
+
+        for location, temp in room_temps.items():
+            logging.debug("%s, %.1f" % (location, temp))
+            room_temps[location] = min(max(temp, 50), 80)
+
+        return room_temps
+
     @fallback_locally
-    def check_recent_temperature(self, minutes=1, verbose=False, local=False):
+    def query_recent_temperature(self, minutes=1, local=False):
         session = get_session(local=local)
 
         # Get the average temperature over the past <minutes> minutes, grouped by Temperature.location
@@ -203,7 +430,7 @@ class HVAC():
             func.sum(Temperature.value - Sensor.bias) / func.count(Temperature.value)
         ) \
             .filter(Temperature.record_time > datetime.now() - timedelta(minutes=minutes)) \
-            .filter(Temperature.value != 185) \
+            .filter(Temperature.value != POWER_ON_RESET_VALUE) \
             .join(Sensor) \
             .filter(Sensor.user == self.user) \
             .filter(Sensor.zone == self.zone) \
@@ -211,104 +438,211 @@ class HVAC():
             .all()
         session.close()
 
-        logging.info('Reading temperatures from database.')
-        for i in indoor_temperatures:
-
-            logging.debug("%s, %.1f" % (i[0], i[1]))
-
-            if i[1] < 50:
-                i[1] = 50
-
-            if i[1] > 80:
-                i[1] = 80
-
-        return {i[0]: i[1] for i in indoor_temperatures}
+        return {i[0]: float(i[1]) for i in indoor_temperatures}
 
     @fallback_locally
-    def check_recent_lag(self, minutes=3, num_recent_actions=10, verbose=False, local=False):
+    def check_recent_lag(self, minutes=3, num_recent_actions=10, since=None, verbose=False, local=False):
         """
-        Check the <num_recent_actions> most recent actions, and calculate the drift in temperature
-        from the action to the local min/max temperature
-        :param minutes:
+        Check the <num_recent_actions> most recent actions of this zone's heat (or every action after <since>), and
+        calculate the drift in temperature from the action to the local min/max temperature
+        :param minutes: window after each action searched for the min/max
         :param num_recent_actions:
+        :param since: datetime; when given, every action after it is used instead
         :param verbose:
-        :return: temp lag off, temp lag on
+        :return: mean overshoot above, below the target (for heating, the temp lag off and temp lag on)
         """
-
         session = get_session(local=local)
-        a = session.query(ActionLog) \
-            .filter(ActionLog.action == 1) \
-            .order_by(ActionLog.record_time.desc()) \
-            .limit(num_recent_actions) \
-            .all()
-        session.close()
+        query = session.query(ActionLog.value, ActionLog.record_time, ActionLog.target) \
+            .filter(ActionLog.action == self.heat_action_id)
+        if since is not None:
+            actions = query.filter(ActionLog.record_time >= since).order_by(ActionLog.record_time).all()
+        else:
+            actions = query.order_by(ActionLog.record_time.desc()).limit(num_recent_actions).all()[::-1]
 
-        actions = [(i.value, i.record_time, i.target) for i in a]
+        if len(actions) == 0:
+            session.close()
+            return np.nan, np.nan
 
-        session = get_session(local=local)
-        t = session.query(Temperature) \
-            .filter(Temperature.record_time >= actions[-1][1]) \
-            .filter(Temperature.record_time <= actions[0][1] + timedelta(minutes=minutes)) \
+        t = session.query(Temperature.record_time, Temperature.location, Temperature.value) \
+            .filter(Temperature.record_time >= actions[0].record_time) \
+            .filter(Temperature.record_time <= actions[-1].record_time + timedelta(minutes=minutes)) \
+            .filter(Temperature.value != POWER_ON_RESET_VALUE) \
             .join(Sensor) \
-            .filter(Sensor.zone == self.zone).all()
+            .filter(Sensor.zone == self.zone) \
+            .all()
         session.close()
 
-        df = pd.DataFrame([(T.record_time, T.location, T.value) for T in t])
-        df.columns = ['record_time', 'location', 'value']
+        if len(t) == 0:
+            return np.nan, np.nan
 
-        df = df.pivot_table(index='record_time', columns='location', values='value')
+        series = zone_series(*zip(*t))
+        # overshoot looks for the minimum after a value of 1, which for cooling follows turning it off
+        values = [a.value if self.DIRECTION > 0 else 1 - a.value for a in actions]
+        df = overshoot(series, [a.record_time for a in actions], values, [a.target for a in actions], minutes=minutes)
 
-        df = df.resample('10S', how='mean')
-        df[np.abs(df.ffill() - pd.rolling_median(df.ffill(), 5)) > 5] = np.nan
-        df = df.interpolate('linear')
+        if verbose:
+            logging.info(df)
 
-        df2 = pd.DataFrame(
-            {
-                'heat': {b: a for a, b, c in actions},
-                'target': {b: c for a, b, c in actions},
-                'temp': df.median(axis=1).resample('S').interpolate('linear')
-            }
-        )
+        return df['overshoot'][df['value'] == 0].mean(), df['overshoot'][df['value'] == 1].mean()
 
-        lag_on = []
-        lag_off = []
 
-        temp_lag_on = []
-        temp_lag_off = []
 
-        for row in df2.dropna(subset=['heat', 'target']).T.iteritems():
-            if row[1]['heat'] == 1:
-                heat_cusp = df2.ix[row[0]:row[0] + timedelta(minutes=minutes)].idxmin()['temp']
-                if not pd.isnull(heat_cusp):
-                    lag_on.append(heat_cusp - row[0])
+class Cooling(HVAC):
+    """
+    Controls the cooling relay of a zone as HVAC controls heating: the relay is on while the zone is above its target,
+    and the lags are learned from the cooling cycles.
+    """
+    ACTION = 'COOL'
+    DIRECTION = -1
 
-                temp_cusp = df2.ix[row[0]:row[0] + timedelta(minutes=minutes)].min()['temp']
-                if not pd.isnull(heat_cusp) and not pd.isnull(temp_cusp) and not pd.isnull(row[1]['target']):
-                    temp_lag_on.append(temp_cusp - row[1]['target'])
 
-            else:
-                heat_cusp = df2.ix[row[0]:row[0] + timedelta(minutes=minutes)].idxmax()['temp']
-                if not pd.isnull(heat_cusp):
-                    lag_off.append(heat_cusp - row[0])
+class Fan(object):
+    ACTION = 'FAN'
 
-                temp_cusp = df2.ix[row[0]:row[0] + timedelta(minutes=minutes)].max()['temp']
-                if not pd.isnull(heat_cusp) and not pd.isnull(temp_cusp) and not pd.isnull(row[1]['target']):
-                    temp_lag_off.append(temp_cusp - row[1]['target'])
+    def __init__(self, zone, log=True):
+        """
+        Controls the fan relay of a zone, which runs while the zone is heated or cooled.
+        :param zone: zone id
+        :param log: log relay changes to the action_log table
+        """
+        self.zone = zone
+        self.log = log
+        self.unit = local_settings.UNIT_NUMBER
 
-        return np.mean(temp_lag_off), np.mean(temp_lag_on)
+        self.pin = relay_pin(self.ACTION, self.zone)
+        if self.pin is None:
+            message = 'No {0} pin for zone {1} found in thermo.common.local_settings.py'.format(self.ACTION, self.zone)
+            logging.error(message)
+            raise Exception(message)
+
+        GPIO.setmode(local_settings.GPIO_MODE)
+        GPIO.setwarnings(False)
+        GPIO.setup(self.pin, GPIO.OUT)
+        GPIO.setwarnings(True)
+
+        self.action_id = get_action_id(self.unit, self.ACTION, self.zone)
+
+    def relay_is_on(self):
+        return GPIO.input(self.pin) == 1
+
+    def update(self, running):
+        """
+        :param running: True if the zone's heating or cooling is on
+        """
+        if running and not self.relay_is_on():
+            self.switch(True)
+        elif not running and self.relay_is_on():
+            self.switch(False)
+
+    def switch(self, on):
+        logging.info('Turning fan {0}.'.format('on' if on else 'off'))
+        with metrics.timer('gpio_seconds', operation='output'):
+            GPIO.output(self.pin, GPIO.HIGH if on else GPIO.LOW)
+        metrics.increment('relay_switches_total', action=self.ACTION, zone=self.zone, state='on' if on else 'off')
+        publisher.publish({'type': 'relay', 'time': datetime.now().isoformat(), 'zone': self.zone,
+                           'action': self.ACTION, 'on': on, 'target': None})
+
+        if self.log and self.action_id is not None:
+            try:
+                write_rows(ActionLog.__table__, [{'action': self.action_id, 'value': 1 if on else 0,
+                                                  'record_time': datetime.now(), 'target': None}])
+            except Exception as e:
+                logging.error('Failed to log action.')
+                logging.exception(e)
 
 
 class Schedule(object):
-    def __init__(self, zone):
+    def __init__(self, zone, refresh_interval=None):
         """
         The Schedule class handles the retrieval and interpretation of temperature scheduling
 
         :param zone: zone number
+        :param refresh_interval: minimum number of seconds between checks of the database for a changed schedule
         """
         self.zone = zone
-        self.schedule, self.schedule_name = self.get_schedule()
+        if refresh_interval is None:
+            refresh_interval = getattr(local_settings, 'SCHEDULE_REFRESH_INTERVAL', 60)
+        self.refresh_interval = refresh_interval
+
+        self.schedule_hash = None
+        self.last_refresh = None
+        self.refresh(force=True)
+
         self.override = None
         self.override_expiration = None
+        self.override_poll_interval = getattr(local_settings, 'OVERRIDE_POLL_INTERVAL', 60)
+        self.last_override_poll = None
+
+    @property
+    def schedule(self):
+        return self._schedule
+
+    @schedule.setter
+    def schedule(self, schedule):
+        # compile the raw schedule once, rather than walking it for every lookup
+        self._schedule = schedule
+        self.compiled = CompiledSchedule(schedule)
+
+    @staticmethod
+    def parse_override(msg_dict):
+        """
+        :param msg_dict: decoded 'temperature override' message
+        :return: (zone, dict<room:target>, expiration datetime)
+        """
+        target = msg_dict['target']
+        try:
+            expiration = datetime.strptime(msg_dict['expiration'], "%Y-%m-%dT%H:%M:%S.%f")
+        except ValueError:
+            expiration = datetime.strptime(msg_dict['expiration'], "%Y-%m-%dT%H:%M:%S")
+        zone = int(msg_dict['zone'])
+
+        return zone, {str(location): float(tgt) for location, tgt in target.items()}, expiration
+
+    def apply_override(self, msg_dict):
+        """
+        :param msg_dict: decoded 'temperature override' message
+        :return: True if the override applies to this schedule's zone
+        """
+        zone, target, expiration = self.parse_override(msg_dict)
+        if zone != self.zone:
+            return False
+
+        self.override, self.override_expiration = target, expiration
+        return True
+
+    def handle_notification(self, message):
+        """
+        Apply a message pushed by the web UI through thermo.common.notify. The override is also stored in the message
+        table, where the next poll marks it as received.
+        :param message: {'type': 'temperature override', 'user': user, 'message': msg_dict}
+                        or {'type': 'schedule changed', 'user': user, 'zone': zone}
+        :return:
+        """
+        if message.get('user') != local_settings.USER_NUMBER:
+            return
+
+        if message['type'] == 'temperature override':
+            if self.apply_override(message['message']):
+                logging.info('Received temperature override.')
+
+        elif message['type'] == 'schedule changed' and int(message['zone']) == self.zone:
+            self.invalidate()
+
+    def poll_override_messages(self, force=False):
+        """
+        Read the messages table for override messages at most once every <override_poll_interval> seconds. Overrides
+        from the web UI are normally delivered immediately by handle_notification; this catches the ones that could
+        not be.
+        :param force: read the messages table now, regardless of when it was last read
+        :return:
+        """
+        if not force and self.last_override_poll is not None \
+                and time.time() - self.last_override_poll < self.override_poll_interval:
+            return
+
+        with metrics.timer('override_poll_seconds'):
+            self.get_override_messages()
+        self.last_override_poll = time.time()
 
     @fallback_locally
     def get_override_messages(self, local=False):
@@ -320,27 +654,13 @@ class Schedule(object):
             session = get_session(local=local)
             results = session.query(Message) \
                 .filter(Message.user == local_settings.USER_NUMBER) \
-                .filter(Message.received == False) \
                 .filter(Message.type == 'temperature override') \
+                .filter(Message.received == False) \
                 .order_by(Message.record_time.asc()) \
                 .all()
 
             for msg in results:
-                msg_dict = json.loads(msg.json)
-                target = msg_dict['target']
-                try:
-                    expiration = datetime.strptime(msg_dict['expiration'], "%Y-%m-%dT%H:%M:%S.%f")
-                except ValueError:
-                    expiration = datetime.strptime(msg_dict['expiration'], "%Y-%m-%dT%H:%M:%S")
-                zone = int(msg_dict['zone'])
-
-                for location, tgt in target.iteritems():
-                    target[str(location)] = float(tgt)
-
-                if zone == self.zone:
-                    self.override = target
-                    self.override_expiration = expiration
-
+                if self.apply_override(json.loads(msg.json)):
                     msg.received = True
 
             session.commit()
@@ -354,10 +674,56 @@ class Schedule(object):
 
         return
 
+    def refresh(self, force=False):
+        """
+        Check the active schedule at most once every <refresh_interval> seconds, and only parse and compile it when its
+        name or content has changed. If the check fails the current schedule is kept, unless there is none yet.
+        :param force: check now, regardless of when the schedule was last checked
+        :return: True if the schedule changed
+        """
+        if not force and self.last_refresh is not None and time.time() - self.last_refresh < self.refresh_interval:
+            return False
+
+        try:
+            with metrics.timer('schedule_query_seconds'):
+                raw, schedule_name = self.get_schedule_source()
+        except Exception as e:
+            if self.schedule_hash is None:
+                raise e
+            logging.error('Failed to check for schedule changes, keeping {0}.'.format(self.schedule_name))
+            return False
+
+        self.last_refresh = time.time()
+
+        if not isinstance(raw, bytes):
+            raw = raw.encode('utf-8')
+        schedule_hash = hashlib.sha1(raw).hexdigest()
+
+        if schedule_hash == self.schedule_hash and schedule_name == self.schedule_name:
+            return False
+
+        logging.info('Loading schedule {0}.'.format(schedule_name))
+        self.schedule, self.schedule_name = json.loads(raw), schedule_name
+        self.schedule_hash = schedule_hash
+        return True
+
+    def invalidate(self):
+        """
+        Check the database for a changed schedule on the next call to refresh.
+        """
+        self.last_refresh = None
+
+    def get_schedule(self):
+        raw, schedule_name = self.get_schedule_source()
+        return json.loads(raw), schedule_name
+
     @fallback_locally
-    def get_schedule(self, local=False):
+    def get_schedule_source(self, local=False):
+        """
+        :return: (raw JSON of the active schedule, schedule name)
+        """
         session = get_session(local=local)
-        results = session.query(ThermostatSchedule) \
+        results = session.query(ThermostatSchedule.schedule, ThermostatSchedule.name) \
             .filter(ThermostatSchedule.zone == self.zone) \
             .filter(ThermostatSchedule.user == local_settings.USER_NUMBER) \
             .filter(ThermostatSchedule.active == 1) \
@@ -366,87 +732,55 @@ class Schedule(object):
         if len(results) > 1:
             logging.warning("Multiple schedules found, using {0}".format(results[0].name))
 
-        schedule = json.loads(results[0].schedule)
-        schedule_name = results[0].name
+        raw, schedule_name = results[0]
 
         session.close()
 
-        return schedule, schedule_name
+        return raw, schedule_name
+
+    def current_target_temps(self, now=None):
+        """
+        Get the target temperature for each room, or the override targets if an override is active.
+        :param now: datetime, defaults to datetime.now()
+        :return: dict<room:target>
+        """
+        if now is None:
+            now = datetime.now()
 
-    def current_target_temps(self):
         if self.override is not None:
-            if datetime.now() >= self.override_expiration:
+            if now >= self.override_expiration:
                 self.override = None
                 self.override_expiration = None
             else:
                 return self.override
 
-        weekday = datetime.now().weekday()
-        current_time = int(datetime.now().strftime('%H%M'))
-        target = {}
-
-        # for each room-day schedule
-        for room, day in self.schedule.iteritems():
-
-            # get today's schedule
-            temp = day[str(weekday)]
+        return self.compiled.current_targets(now)
 
-            # if current time is before the first scheduled target
-            if current_time < int(temp[0][0]):
-                # then, get the last target of the previous day's schedule
-                previous_weekday = (datetime.now() - timedelta(days=1)).weekday()
-                target[room] = day[str(previous_weekday)][-1][1]
-            else:
-                for hour, tgt in temp:
-                    if current_time > int(hour):
-                        target[room] = tgt
-        return target
-
-    def get_next_target_temps(self):
+    def get_next_target_temps(self, now=None):
         """
         Get the next scheduled target temperature for each room.
-        :return: dict<room:dict<datetime:target>>
+        :param now: datetime, defaults to datetime.now()
+        :return: dict<room:(datetime, target)>
         """
-        weekday = datetime.now().weekday()
-        current_time = int(datetime.now().strftime('%H%M'))
-        target = {}
+        if now is None:
+            now = datetime.now()
 
-        tgt_date = lambda x: datetime.now().replace(hour=int(x[:2]), minute=int(x[2:]), second=0, microsecond=0)
+        return self.compiled.next_targets(now)
 
-        # for each room-day schedule
-        for room, day in self.schedule.iteritems():
+    def targets_between(self, start, end, freq='1min'):
+        """
+        Scheduled targets for each room from <start> to <end>, ignoring overrides.
+        :param start: datetime
+        :param end: datetime
+        :param freq: pandas frequency string
+        :return: pandas.DataFrame indexed by time with a column per room
+        """
+        return self.compiled.targets_between(start, end, freq=freq)
 
-            # get today's schedule
-            temp = day[str(weekday)]
 
-            # if current time is before the first scheduled time
-            if current_time < int(temp[0][0]):
-                # then, get the first target of the current day
-                next_date = tgt_date(temp[0][0])
-                target[room] = (next_date, temp[0][1])
-            else:
-                for i in range(len(temp)):
-                    hour, tgt = temp[i]
-                    # if the current time is after the scheduled time
-                    if current_time > int(hour):
-                        # try getting the next target
-                        try:
-                            next_date = tgt_date(temp[i + 1][0])
-                            target[room] = (next_date, temp[i + 1][1])
-
-                        # otherwise, get first target of next day
-                        except IndexError:
-                            next_weekday = (datetime.now() + timedelta(days=1)).weekday()
-                            h = day[str(next_weekday)][0][0]
-                            next_date = tgt_date(h) + timedelta(days=1)
-                            target[room] = (next_date, day[str(next_weekday)][0][1])
-
-        return target
-
-
-def main(hvac, verbosity=0):
-    hvac.schedule.schedule, hvac.schedule.schedule_name = hvac.schedule.get_schedule()
-    hvac.schedule.get_override_messages()
+def main(hvac, verbosity=0, buffer=0.5):
+    hvac.schedule.refresh()
+    hvac.schedule.poll_override_messages()
     current_targets = hvac.schedule.current_target_temps()
 
     try:
@@ -482,7 +816,7 @@ def main(hvac, verbosity=0):
     zone_target = float(np.median([val for key, val in current_targets.iteritems()]))
     zone_temp = float(np.median([val for key, val in room_temps.iteritems()]))
 
-    hvac.temps_to_heat(zone_target, zone_temp, verbose=True if verbosity >= 1 else False, buffer=0.5)
+    hvac.temps_to_heat(zone_target, zone_temp, verbose=True if verbosity >= 1 else False, buffer=buffer)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+from bisect import bisect_left
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+
+def minute_of_week(dt):
+    return dt.weekday() * MINUTES_PER_DAY + dt.hour * 60 + dt.minute
+
+
+class RoomTimeline(object):
+    def __init__(self, days):
+        """
+        A room's weekly schedule as sorted minute-of-week change points.
+
+        A scheduled target takes effect in the minute after its scheduled time, as it always has: at 06:00 the 0600
+        target is still the next target, and it becomes the current target at 06:01.
+
+        :param days: {'<weekday>': [['HHMM', target], ...]} with Monday as '0'
+        """
+        entries = []
+        for day, targets in days.items():
+            for hour, target in targets:
+                entries.append((int(day) * MINUTES_PER_DAY + int(hour[:2]) * 60 + int(hour[2:]), target))
+        entries.sort(key=lambda e: e[0])
+
+        if len(entries) == 0:
+            raise ValueError('Schedule has no targets.')
+
+        self.minutes = [m for m, _ in entries]
+        self.targets = [t for _, t in entries]
+        self.minutes_array = np.array(self.minutes, dtype=np.int64)
+        self.values_array = np.array([np.nan if t is None else float(t) for t in self.targets])
+
+    def current(self, now):
+        """
+        :param now: datetime
+        :return: the target in effect at <now>
+        """
+        # index of the last change point strictly before now; -1 wraps around to the end of the previous week
+        return self.targets[bisect_left(self.minutes, minute_of_week(now)) - 1]
+
+    def next(self, now):
+        """
+        :param now: datetime
+        :return: (datetime, target) of the next change point at or after <now>
+        """
+        m = minute_of_week(now)
+        i = bisect_left(self.minutes, m)
+
+        if i == len(self.minutes):
+            i = 0
+            delta = self.minutes[0] + MINUTES_PER_WEEK - m
+        else:
+            delta = self.minutes[i] - m
+
+        return now.replace(second=0, microsecond=0) + timedelta(minutes=delta), self.targets[i]
+
+    def between(self, times):
+        """
+        :param times: pandas.DatetimeIndex
+        :return: numpy array of the target in effect at each time, NaN where there is no target
+        """
+        m = np.asarray(times.weekday * MINUTES_PER_DAY + times.hour * 60 + times.minute, dtype=np.int64)
+        return self.values_array[np.searchsorted(self.minutes_array, m, side='left') - 1]
+
+
+class CompiledSchedule(object):
+    def __init__(self, schedule):
+        """
+        A thermostat schedule compiled into a RoomTimeline per room.
+
+        :param schedule: {room: {'<weekday>': [['HHMM', target], ...]}}, as stored in thermostat_schedule
+        """
+        self.rooms = {room: RoomTimeline(days) for room, days in schedule.items()}
+
+    def current_targets(self, now):
+        return {room: timeline.current(now) for room, timeline in self.rooms.items()}
+
+    def next_targets(self, now):
+        return {room: timeline.next(now) for room, timeline in self.rooms.items()}
+
+    def targets_between(self, start, end, freq='1min'):
+        """
+        Scheduled targets for every room, sampled every <freq> from <start> to <end>.
+        :param start: datetime
+        :param end: datetime
+        :param freq: pandas frequency string
+        :return: pandas.DataFrame indexed by time with a column per room
+        """
+        times = pd.date_range(start, end, freq=freq)
+        return pd.DataFrame({room: timeline.between(times) for room, timeline in self.rooms.items()}, index=times)
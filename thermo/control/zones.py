@@ -0,0 +1,224 @@
+import logging
+import threading
+
+from thermo import local_settings
+from thermo.common.metrics import metrics
+from thermo.control import thermostat
+from thermo.control.scheduler import monotonic
+
+# The controller class of each action name. Heating and cooling are decided from the zone's temperatures and
+# schedule; the fan follows them.
+CONTROLLERS = {
+    'HEAT': thermostat.HVAC,
+    'COOL': thermostat.Cooling,
+    'FAN': thermostat.Fan,
+}
+CONDITIONING = ('HEAT', 'COOL')
+
+
+class ZoneControllers(object):
+    def __init__(self, log=True):
+        """
+        Registry of the controllers of this unit, one per (zone, action) pair, so that one unit can control the heating,
+        cooling and fan of several zones. The zones share one SharedTemperatures, so the database is queried once for
+        all of them, and each zone's decision runs on its own thread.
+
+        :param log: passed to the controllers
+        """
+        self.log = log
+        self.controllers = {}  # (zone, action name): controller
+        self.temperatures = thermostat.SharedTemperatures(local_settings.USER_NUMBER)
+        self.lock = threading.Lock()
+        self.busy = set()  # zones whose last decision has not finished
+        # held by a zone's decision, and by sync while it stops one of the zone's controllers or changes its sensors, so
+        # that a controller is never changed in the middle of a decision, even one that outlives its control tick
+        self.zone_locks = {}
+
+    def __len__(self):
+        return len(self.controllers)
+
+    def get(self, zone, name):
+        return self.controllers.get((zone, name))
+
+    def zone_lock(self, zone):
+        with self.lock:
+            if zone not in self.zone_locks:
+                self.zone_locks[zone] = threading.Lock()
+            return self.zone_locks[zone]
+
+    def zones(self):
+        """
+        :return: {zone: {action name: controller}}
+        """
+        with self.lock:
+            zones = {}
+            for (zone, name), controller in self.controllers.items():
+                zones.setdefault(zone, {})[name] = controller
+        return zones
+
+    def create(self, zone, name):
+        if name == 'FAN':
+            return thermostat.Fan(zone, log=self.log)
+
+        # heating and cooling of a zone follow the same schedule
+        schedules = [c.schedule for (z, n), c in self.controllers.items() if z == zone and n in CONDITIONING]
+        return CONTROLLERS[name](zone, log=self.log, schedule=schedules[0] if len(schedules) > 0 else None,
+                                 temperatures=self.temperatures)
+
+    def sync(self, actions, local_sensors, zone_sensors, sensors_changed=True, initial=False):
+        """
+        Create the controllers of newly enabled actions and stop those of actions that were removed, disabled or moved
+        to another zone. Controllers of unchanged actions are kept.
+        :param actions: this unit's enabled actions
+        :param local_sensors: this unit's sensors
+        :param zone_sensors: every sensor of the user
+        :param sensors_changed: update the sensors of the kept controllers
+        :param initial: test the relays of the new controllers
+        :return:
+        """
+        wanted = set()
+        for a in actions:
+            if a.name not in CONTROLLERS:
+                logging.warning('No controller for action {0} ({1}).'.format(a.id, a.name))
+                continue
+            wanted.add((a.zone, a.name))
+
+        for key in sorted(set(self.controllers) - wanted):
+            self.remove(*key)
+
+        # a new controller takes part in its zone's decisions once it is added
+        kept = []
+        for zone, name in sorted(wanted):
+            controller = self.get(zone, name)
+            if controller is None:
+                logging.info('Starting {0} control of zone {1}.'.format(name.lower(), zone))
+                try:
+                    controller = self.create(zone, name)
+                except Exception as e:
+                    logging.error('Could not start {0} control of zone {1}.'.format(name.lower(), zone))
+                    logging.exception(e)
+                    continue
+
+                with self.lock:
+                    self.controllers[(zone, name)] = controller
+                if initial and name in CONDITIONING:
+                    logging.debug('Testing relays for {0} of zone {1}.'.format(name.lower(), zone))
+                    controller.cycle_relays()
+
+            else:
+                kept.append((zone, name, controller))
+
+        if sensors_changed:
+            for zone, name, controller in kept:
+                if name in CONDITIONING:
+                    with self.zone_lock(zone):
+                        controller.set_sensors(local_sensors, [s for s in zone_sensors if s.zone == zone])
+
+        self.temperatures.watch(set(zone for zone, name in self.controllers))
+
+    def remove(self, zone, name):
+        """
+        Stop a controller and turn its relay off, once the zone's decision in progress (if any) has finished
+        """
+        logging.info('Stopping {0} control of zone {1}.'.format(name.lower(), zone))
+        with self.zone_lock(zone):
+            with self.lock:
+                controller = self.controllers.pop((zone, name))
+            self.turn_off(name, controller)
+
+    @staticmethod
+    def turn_off(name, controller):
+        if name == 'FAN':
+            controller.update(False)
+        else:
+            controller.turn_heat_off()
+
+    def run_zone(self, zone, verbosity=0):
+        """
+        One control decision for a zone, with the zone's current controllers. Heating and cooling are never on together:
+        while one of them is on, the other may not turn on, so a switch from one to the other takes two decisions.
+        :param zone: zone id
+        :param verbosity:
+        :return:
+        """
+        with self.lock:
+            if zone in self.busy:
+                logging.warning('Skipping control of zone {0}, its last decision is still running.'.format(zone))
+                return
+            self.busy.add(zone)
+
+        try:
+            with self.zone_lock(zone):
+                controllers = self.zones().get(zone, {})
+                with metrics.timer('zone_decision_seconds', zone=zone):
+                    self.decide(zone, controllers, verbosity=verbosity)
+        finally:
+            with self.lock:
+                self.busy.discard(zone)
+
+    def decide(self, zone, controllers, verbosity=0):
+        conditioning = [(name, controllers[name]) for name in CONDITIONING if name in controllers]
+        for name, controller in conditioning:
+            others_on = any(c.heat_relay_is_on() for n, c in conditioning if c is not controller)
+            if others_on and not controller.heat_relay_is_on():
+                continue
+
+            try:
+                thermostat.main(controller, verbosity=verbosity)
+            except Exception as e:
+                logging.error('Uncaught exception in thermostat.main for {0} of zone {1}.'.format(name.lower(), zone))
+                controller.turn_heat_off()
+                logging.exception(e)
+
+        if 'FAN' in controllers:
+            try:
+                controllers['FAN'].update(any(c.heat_relay_is_on() for n, c in conditioning))
+            except Exception as e:
+                logging.error('Failed to update the fan of zone {0}.'.format(zone))
+                logging.exception(e)
+
+    def run(self, verbosity=0, timeout=None):
+        """
+        Run every zone's control decision, each zone on its own thread, so that a zone waiting on the database does not
+        hold up the others.
+        :param verbosity:
+        :param timeout: seconds to wait for the zones to finish; a zone that takes longer carries on in the background
+        :return:
+        """
+        zones = sorted(self.zones())
+        if len(zones) == 1:
+            self.run_zone(zones[0], verbosity=verbosity)
+            return
+
+        threads = []
+        for zone in zones:
+            thread = threading.Thread(target=self.run_zone, args=(zone, verbosity),
+                                      name='zone-{0}'.format(zone))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        deadline = None if timeout is None else monotonic() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(deadline - monotonic(), 0.))
+            if thread.is_alive():
+                logging.warning('Control of {0} did not finish in time.'.format(thread.name))
+
+    def handle_notification(self, message):
+        schedules = {}
+        for (zone, name), controller in list(self.controllers.items()):
+            if name in CONDITIONING:
+                schedules[id(controller.schedule)] = controller.schedule
+
+        for schedule in schedules.values():
+            schedule.handle_notification(message)
+
+    def stop(self):
+        """
+        Turn every relay off
+        """
+        for (zone, name), controller in list(self.controllers.items()):
+            try:
+                self.turn_off(name, controller)
+            except Exception as e:
+                logging.exception(e)
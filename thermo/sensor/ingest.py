@@ -0,0 +1,146 @@
+import atexit
+import logging
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from thermo import local_settings
+from thermo.common.journal import write_rows
+from thermo.common.metrics import metrics
+from thermo.common.models import Temperature
+
+
+class TemperatureQueue(object):
+    def __init__(self, batch_size=50, max_delay=5.):
+        """
+        Write-behind queue for temperature readings. Readings are collected from every sensor and written by a
+        background thread as one multi-row insert per database, whenever <batch_size> readings are waiting or the
+        oldest waiting reading is <max_delay> seconds old.
+
+        :param batch_size: number of readings that triggers a flush
+        :param max_delay: maximum number of seconds a reading waits before it is flushed
+        """
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+
+        self.queue = Queue()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def put(self, record_time, value, location, sensor_id):
+        self.queue.put({'record_time': record_time, 'value': value, 'location': location, 'sensor': sensor_id})
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='temperature-ingest')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=30):
+        """
+        Stop the worker thread after it has flushed everything that is queued.
+        :param timeout: seconds to wait for the final flush
+        :return:
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def flush(self):
+        """
+        Synchronously write everything that is currently queued.
+        :return: number of readings written
+        """
+        rows = self._drain()
+        if len(rows) > 0:
+            self.write(rows)
+        return len(rows)
+
+    def _drain(self, limit=None):
+        rows = []
+        while limit is None or len(rows) < limit:
+            try:
+                rows.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return rows
+
+    def _run(self):
+        batch = []
+        first_arrival = None
+
+        while not self._stop.is_set() or not self.queue.empty() or len(batch) > 0:
+            if self._stop.is_set():
+                timeout = 0.
+            elif len(batch) == 0:
+                timeout = 1.
+            else:
+                timeout = max(0., self.max_delay - (time.time() - first_arrival))
+
+            try:
+                row = self.queue.get(timeout=timeout)
+                if len(batch) == 0:
+                    first_arrival = time.time()
+                batch.append(row)
+                batch.extend(self._drain(limit=self.batch_size - len(batch)))
+            except Empty:
+                pass
+
+            if len(batch) == 0:
+                continue
+
+            if len(batch) >= self.batch_size or time.time() - first_arrival >= self.max_delay or self._stop.is_set():
+                try:
+                    self.write(batch)
+                except Exception as e:
+                    logging.error('Unhandled error while writing temperature batch.')
+                    logging.exception(e)
+                batch = []
+                first_arrival = None
+
+    def write(self, rows):
+        """
+        Insert <rows> into the remote database and the local SQLite database, one executemany per database. Rows that
+        cannot be written to the remote database are journaled and replayed later. A batch that a database rejects is
+        split until the offending rows are found, so only they are dropped.
+        :param rows: list of dicts with record_time, value, location and sensor keys
+        :return:
+        """
+        try:
+            with metrics.timer('temperature_batch_write_seconds'):
+                write_rows(Temperature.__table__, rows)
+            metrics.increment('temperature_rows_total', len(rows))
+        except Exception as e:
+            logging.error('Failed to write {0} temperatures.'.format(len(rows)))
+            logging.exception(e)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """
+    Return the process-wide temperature queue, starting its worker thread on first use.
+    :return: TemperatureQueue
+    """
+    global _queue
+
+    with _queue_lock:
+        if _queue is None:
+            _queue = TemperatureQueue(
+                batch_size=getattr(local_settings, 'INGEST_BATCH_SIZE', 50),
+                max_delay=getattr(local_settings, 'INGEST_MAX_DELAY', 5.),
+            )
+            _queue.start()
+            atexit.register(_queue.stop)
+
+    return _queue
@@ -0,0 +1,72 @@
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+# DS18B20 sensors report 85C (185F) after a power-on reset, before their first conversion
+POWER_ON_RESET_VALUE = 185
+
+
+class RecentTemperatures(object):
+    def __init__(self, retention=10):
+        """
+        In-process hot tier of the most recent readings from this unit's sensors, used for control decisions so that
+        they do not depend on the remote database. Values are stored with the sensor's bias already applied.
+
+        :param retention: minutes of readings to keep
+        """
+        self.retention = timedelta(minutes=retention)
+        self.readings = {}
+        self.lock = threading.Lock()
+
+    def add(self, sensor, record_time, value):
+        """
+        :param sensor: Sensor SQLAlchemy ORM model
+        :param record_time: datetime
+        :param value: raw reading from the sensor
+        :return:
+        """
+        if value == POWER_ON_RESET_VALUE:
+            return
+
+        key = (sensor.user, sensor.zone, sensor.location)
+        with self.lock:
+            if key not in self.readings:
+                self.readings[key] = deque()
+
+            readings = self.readings[key]
+            readings.append((record_time, value - (sensor.bias or 0.)))
+            cutoff = record_time - self.retention
+            while readings[0][0] <= cutoff:
+                readings.popleft()
+
+    def averages(self, user, zone, minutes=1, now=None):
+        """
+        Get the average temperature over the past <minutes> minutes, by location
+        :param user:
+        :param zone:
+        :param minutes:
+        :param now: datetime, defaults to datetime.now()
+        :return: {location: temperature}
+        """
+        if now is None:
+            now = datetime.now()
+        cutoff = now - timedelta(minutes=minutes)
+
+        averages = {}
+        with self.lock:
+            for (u, z, location), readings in self.readings.items():
+                if u != user or z != zone:
+                    continue
+
+                values = [value for record_time, value in readings if record_time > cutoff]
+                if len(values) > 0:
+                    averages[location] = sum(values) / len(values)
+
+        return averages
+
+    def clear(self):
+        with self.lock:
+            self.readings.clear()
+
+
+recent_temperatures = RecentTemperatures()
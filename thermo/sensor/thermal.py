@@ -1,30 +1,43 @@
+import glob
 import logging
+import os
 import re
+import threading
 import time
-from datetime import datetime, timedelta
+from collections import namedtuple
+from datetime import datetime
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 
 import numpy as np
-from sqlalchemy.orm import sessionmaker
 
-from thermo.common.models import Temperature, get_engine, Sensor, get_session, duplicate_locally
+from thermo import local_settings
+from thermo.common.events import publisher
+from thermo.common.metrics import metrics
+from thermo.common.models import Sensor, get_session
+from thermo.sensor.ingest import get_queue
+from thermo.sensor.recent import recent_temperatures
+from thermo.sensor.window import ZoneWindows
 
-try:
-    engine = get_engine()
-    Session = sessionmaker(bind=engine)
-    database_connection = True
-except:
-    database_connection = False
+W1_DEVICES_PATH = '/sys/bus/w1/devices'
 
+# Smallest standard deviation, in degrees F, that a reading is validated against
+VALIDATION_MIN_STD = getattr(local_settings, 'VALIDATION_MIN_STD', 0.5)
 
-def read_temp_sensor(device_id, units='F'):
+
+def read_temp_sensor(device_id, units='F', base_path=W1_DEVICES_PATH):
     """
     Read temperature from the sensor and convert to <units>
     :param device_id:
     :param units:
+    :param base_path: directory containing the 1-Wire devices
     :return:
     """
 
-    path = '/sys/bus/w1/devices/{0}/w1_slave'.format(device_id)
+    path = os.path.join(base_path, device_id, 'w1_slave')
     with open(path, 'r') as f:
         line1 = f.readline().strip()
         line2 = f.readline().strip()
@@ -49,32 +62,159 @@ def read_temp_sensor(device_id, units='F'):
     return is_on, out
 
 
-def validate_temperature(value, sensor, record_time, deviation=3, lookback=5, limit=50, verbosity=0, local=False):
+def trigger_bulk_read(base_path=W1_DEVICES_PATH, timeout=1.5, poll=0.05):
+    """
+    Start a temperature conversion on every sensor of every 1-Wire bus master at once, using the kernel's
+    therm_bulk_read attribute, and wait for it to finish. Afterwards each w1_slave read returns the converted value
+    without another ~750 ms conversion.
+    :param base_path: directory containing the 1-Wire devices
+    :param timeout: seconds to wait for the conversion to finish
+    :param poll: seconds between checks of the conversion status
+    :return: True if the bus masters report that data is available, False if bulk reads are not supported
     """
+    triggers = glob.glob(os.path.join(base_path, 'w1_bus_master*', 'therm_bulk_read'))
+    if len(triggers) == 0:
+        return False
+
+    for path in triggers:
+        with open(path, 'w') as f:
+            f.write('trigger\n')
+
+    deadline = time.time() + timeout
+    pending = list(triggers)
+    while len(pending) > 0 and time.time() < deadline:
+        time.sleep(poll)
+        still_pending = []
+        for path in pending:
+            with open(path, 'r') as f:
+                # -1: conversion in progress, 1: data available, 0: nothing to read
+                if f.read().strip() == '-1':
+                    still_pending.append(path)
+        pending = still_pending
+
+    if len(pending) > 0:
+        logging.warning('Bulk conversion did not finish within {0} seconds.'.format(timeout))
+        return False
+
+    return True
+
+
+SensorReading = namedtuple('SensorReading', ['sensor', 'value'])
+SensorBatch = namedtuple('SensorBatch', ['record_time', 'readings', 'failures'])
+
+
+class SensorSweep(object):
+    def __init__(self, base_path=W1_DEVICES_PATH, timeout=2., bulk=True, units='F'):
+        """
+        Read a set of 1-Wire sensors concurrently, one thread per device, and collect the results into a single
+        timestamped batch. A device that does not answer within <timeout> seconds is reported as failed, and is skipped
+        by later sweeps until its stuck read returns.
+
+        :param base_path: directory containing the 1-Wire devices
+        :param timeout: seconds to wait for all devices in a sweep
+        :param bulk: trigger a simultaneous conversion on all devices through therm_bulk_read when available
+        :param units: 'F' or 'C'
+        """
+        self.base_path = base_path
+        self.timeout = timeout
+        self.bulk = bulk
+        self.units = units
+
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def _read(self, sensor, results):
+        start = time.time()
+        try:
+            _, value = read_temp_sensor(sensor.serial_number, units=self.units, base_path=self.base_path)
+            metrics.observe('sensor_read_seconds', time.time() - start, sensor=sensor.location)
+            results.put((sensor, value, None))
+        except Exception as e:
+            results.put((sensor, None, e))
+        finally:
+            with self._lock:
+                self._in_flight.discard(sensor.serial_number)
+
+    def sweep(self, devices):
+        """
+        :param devices: list of Sensor objects
+        :return: SensorBatch(record_time, [SensorReading(sensor, value), ...], {serial_number: exception})
+        """
+        record_time = datetime.now()
+        failures = {}
+
+        if self.bulk:
+            try:
+                with metrics.timer('sensor_bulk_conversion_seconds'):
+                    trigger_bulk_read(self.base_path, timeout=self.timeout)
+            except Exception as e:
+                logging.warning('Bulk conversion failed, reading sensors individually.')
+                logging.exception(e)
+
+        results = Queue()
+        started = 0
+        for d in devices:
+            with self._lock:
+                if d.serial_number in self._in_flight:
+                    failures[d.serial_number] = Exception('Previous read of {0} has not returned.'.format(
+                        d.serial_number))
+                    continue
+                self._in_flight.add(d.serial_number)
+
+            thread = threading.Thread(target=self._read, args=(d, results), name='w1-' + d.serial_number)
+            thread.daemon = True
+            thread.start()
+            started += 1
+
+        readings = []
+        deadline = time.time() + self.timeout
+        for _ in range(started):
+            try:
+                sensor, value, error = results.get(timeout=max(0., deadline - time.time()))
+            except Empty:
+                break
+
+            if error is None:
+                readings.append(SensorReading(sensor, value))
+            else:
+                failures[sensor.serial_number] = error
+
+        answered = set([r.sensor.serial_number for r in readings]) | set(failures.keys())
+        for d in devices:
+            if d.serial_number not in answered:
+                failures[d.serial_number] = Exception('Timed out reading {0}.'.format(d.serial_number))
+
+        return SensorBatch(record_time, readings, failures)
+
+
+@metrics.timed('validate_temperature_seconds')
+def validate_temperature(value, sensor, record_time, deviation=3, verbosity=0, windows=None,
+                         min_std=VALIDATION_MIN_STD):
+    """
+    Check <value> against the recent readings of the sensor's zone, kept in memory by the sensor sweep.
 
     :param value: float
     :param sensor: Sensor SQLAlchemy ORM model
     :param record_time: datetime
+    :param deviation: number of standard deviations from the mean that is considered invalid
+    :param windows: ZoneWindows holding the recent readings, defaults to the module's windows
+    :param min_std: lower limit of the standard deviation the reading is compared with
     :return:
     """
+    if windows is None:
+        windows = zone_windows
 
-    session = get_session(local=local)
-    results = session.query(Temperature) \
-        .filter(Temperature.record_time > record_time - timedelta(minutes=lookback)) \
-        .filter(Temperature.record_time <= record_time) \
-        .join(Sensor).filter(Temperature.sensor == Sensor.id) \
-        .filter(Sensor.user == sensor.user) \
-        .filter(Sensor.zone == sensor.zone) \
-        .order_by(Temperature.record_time)
+    n, m, s = windows.get(sensor.user, sensor.zone).stats(now=record_time)
 
-    data = np.unique([r.value for r in results[-limit:]])
-    session.close()
+    if n < 5:
+        return True
 
-    if len(data) < 5:
+    # The readings of a steady zone are quantized to a few values with a tiny spread, against which an ordinary step of
+    # a few tenths of a degree would be many standard deviations away.
+    s = max(s, min_std)
+    if s == 0:
         return True
 
-    s = np.std(data)
-    m = np.mean(data)
     z = np.abs(value - m) / s
 
     logging.debug('Std: {0}, Mean: {1}'.format(s, m))
@@ -87,53 +227,68 @@ def validate_temperature(value, sensor, record_time, deviation=3, lookback=5, li
     return True
 
 
-@duplicate_locally
-def record_to_database(record_time, temp, location, sensor_id, local=False):
-    """
-    Insert a record into the temperature table.
-    :param record_time: datetime
-    :param temp: float
-    :param location: string
-    :return:
-    """
-    session = get_session(local)
-
-    new_observation = Temperature(value=temp, record_time=record_time, location=location, sensor=sensor_id)
-    session.add(new_observation)
-    session.commit()
-    session.close()
-
+zone_windows = ZoneWindows(
+    lookback=getattr(local_settings, 'VALIDATION_LOOKBACK', 5),
+    limit=getattr(local_settings, 'VALIDATION_LIMIT', 50),
+)
 
-def record_to_csv(record_time, temp, location, file):
-    with open(file, 'a+') as f:
-        line = "{0},{1},{2}\n".format(
-            str(temp),
-            record_time.strftime('%Y-%m-%d %H:%M:%S'),
-            location
-        )
-        f.write(line)
+default_sweep = SensorSweep(
+    timeout=getattr(local_settings, 'SENSOR_SWEEP_TIMEOUT', 2.),
+    bulk=getattr(local_settings, 'SENSOR_BULK_READ', True),
+)
 
 
 def main(user_id, unit, devices, local=False, **kwargs):
-    verbosity = kwargs.get('verbosity', 0)
-    for d in devices:
-        device_id = d.serial_number
-        location = d.location
-
-        try:
-            _, temperature = read_temp_sensor(device_id)
-            logging.debug('Read thermal sensor: {0}: {1}'.format(location, temperature))
-        except Exception as e:
-            logging.warning('Sensor read failed for {0}: {1}'.format(location, device_id))
-            continue  # there is no data to record.
-
-        try:
-            record_to_database(datetime.now(), temperature, location, d.id)
-        except Exception as e:
-            logging.error('Error during database insert.')
-            logging.exception(e)
-            logging.debug('Writing to CSV.')
-            record_to_csv(datetime.now(), temperature, location, '/home/pi/temperature_log.csv')
+    """
+    Read every sensor in <devices> concurrently and queue the readings for insertion. The database writes happen on
+    the ingest queue's worker thread, so a slow commit does not hold up the sensor sweep.
+    :param user_id:
+    :param unit:
+    :param devices: list of Sensor objects
+    :param queue: TemperatureQueue to write to, defaults to the process-wide queue
+    :param sweep: SensorSweep used to read the devices, defaults to the module's sweep
+    :param validate: check each reading against the recent readings of its zone
+    :return: SensorBatch
+    """
+    validate = kwargs.get('validate', True)
+    queue = kwargs.get('queue', None)
+    if queue is None:
+        queue = get_queue()
+    sweep = kwargs.get('sweep', None)
+    if sweep is None:
+        sweep = default_sweep
+
+    with metrics.timer('sensor_sweep_seconds'):
+        batch = sweep.sweep(devices)
+
+    locations = {d.serial_number: d.location for d in devices}
+    for device_id, error in batch.failures.items():
+        logging.warning('Sensor read failed for {0}: {1} ({2})'.format(locations.get(device_id), device_id, error))
+        metrics.increment('sensor_read_failures_total', sensor=locations.get(device_id))
+
+    readings = []
+    for sensor, temperature in batch.readings:
+        logging.debug('Read thermal sensor: {0}: {1}'.format(sensor.location, temperature))
+        queue.put(batch.record_time, temperature, sensor.location, sensor.id)
+
+        # Validation only flags a reading. Every reading goes into the window, so that a real change of temperature
+        # becomes the new normal instead of being rejected until the window has emptied, and into the hot tier used for
+        # control decisions.
+        valid = True
+        if validate and not validate_temperature(temperature, sensor, batch.record_time):
+            logging.warning('Reading of {0} from {1} failed validation.'.format(temperature, sensor.location))
+            metrics.increment('sensor_validation_failures_total', sensor=sensor.location)
+            valid = False
+
+        zone_windows.add(sensor, batch.record_time, temperature)
+        recent_temperatures.add(sensor, batch.record_time, temperature)
+        readings.append({'sensor': sensor.id, 'location': sensor.location, 'zone': sensor.zone,
+                         'value': temperature - (sensor.bias or 0.), 'valid': valid})
+
+    publisher.publish({'type': 'temperatures', 'time': batch.record_time.isoformat(), 'unit': unit,
+                       'readings': readings})
+
+    return batch
 
 
 if __name__ == '__main__':
@@ -149,7 +304,7 @@ if __name__ == '__main__':
 
 
     def check_sensors(user_id, unit):
-        session = Session()
+        session = get_session()
         devices = session.query(Sensor).filter(
             Sensor.unit == unit,
             Sensor.user == user_id
@@ -0,0 +1,85 @@
+import math
+import threading
+from collections import deque
+from datetime import timedelta
+
+
+class RollingWindow(object):
+    def __init__(self, lookback=5, limit=50):
+        """
+        Recent readings for one zone, with a running mean and variance that are updated as readings are added and
+        evicted. Readings older than <lookback> minutes, or beyond the newest <limit> readings, are dropped.
+
+        :param lookback: minutes of readings to keep
+        :param limit: maximum number of readings to keep
+        """
+        self.lookback = timedelta(minutes=lookback)
+        self.limit = limit
+
+        self.readings = deque()
+        self.total = 0.
+        self.total_squares = 0.
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.readings)
+
+    def add(self, record_time, value):
+        with self.lock:
+            self.readings.append((record_time, value))
+            self.total += value
+            self.total_squares += value * value
+            self._evict(record_time)
+
+    def _evict(self, now):
+        cutoff = now - self.lookback
+        while len(self.readings) > self.limit or (len(self.readings) > 0 and self.readings[0][0] <= cutoff):
+            _, value = self.readings.popleft()
+            self.total -= value
+            self.total_squares -= value * value
+
+        if len(self.readings) == 0:
+            # reset the sums so that rounding error cannot accumulate across empty periods
+            self.total = 0.
+            self.total_squares = 0.
+
+    def stats(self, now=None):
+        """
+        :param now: datetime; readings older than the lookback relative to <now> are evicted first
+        :return: (count, mean, standard deviation)
+        """
+        with self.lock:
+            if now is not None:
+                self._evict(now)
+
+            n = len(self.readings)
+            if n == 0:
+                return 0, None, None
+
+            mean = self.total / n
+            variance = max(0., self.total_squares / n - mean * mean)
+            return n, mean, math.sqrt(variance)
+
+
+class ZoneWindows(object):
+    def __init__(self, lookback=5, limit=50):
+        """
+        A RollingWindow per (user, zone), created on first use.
+        """
+        self.lookback = lookback
+        self.limit = limit
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def get(self, user, zone):
+        key = (user, zone)
+        try:
+            return self.windows[key]
+        except KeyError:
+            with self.lock:
+                if key not in self.windows:
+                    self.windows[key] = RollingWindow(lookback=self.lookback, limit=self.limit)
+                return self.windows[key]
+
+    def add(self, sensor, record_time, value):
+        self.get(sensor.user, sensor.zone).add(record_time, value)